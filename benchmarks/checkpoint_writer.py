@@ -0,0 +1,73 @@
+"""
+Times training steps of a model checkpointed every --save-freq steps with
+synchronous torch.save and with utils.checkpoint.CheckpointWriter.
+
+    python benchmarks/checkpoint_writer.py --model resnet18 --save-freq 1 5 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import load
+from utils import optimize
+from utils.checkpoint import CheckpointWriter
+
+
+def time_steps(ARGS, save_freq, writer):
+    torch.manual_seed(0)
+    input_shape, num_classes = load.dimension(ARGS.dataset)
+    model = load.model(ARGS.model, ARGS.model_class)(
+        input_shape=input_shape, num_classes=num_classes
+    )
+    opt_class, opt_kwargs = load.optimizer("custom_sgd", 0.9, 0.0, False, ["mom"])
+    optimizer = opt_class(model.parameters(), lr=0.1, **opt_kwargs)
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[])
+    loss = nn.CrossEntropyLoss()
+    data = torch.randn(ARGS.batch_size, *input_shape)
+    target = torch.randint(num_classes, (ARGS.batch_size,))
+
+    with tempfile.TemporaryDirectory() as save_path:
+        os.makedirs(f"{save_path}/ckpt")
+        start = time.perf_counter()
+        for step in range(1, ARGS.steps + 1):
+            optimizer.zero_grad()
+            loss(model(data), target).backward()
+            optimizer.step()
+            if step % save_freq == 0:
+                optimize.checkpoint(
+                    model, optimizer, scheduler, 0, step, save_path, 0, writer=writer
+                )
+        seconds = time.perf_counter() - start
+        if writer is not None:
+            writer.close()
+    return seconds / ARGS.steps
+
+
+def main(ARGS):
+    torch.set_num_threads(ARGS.threads)
+    for save_freq in ARGS.save_freq:
+        sync = time_steps(ARGS, save_freq, None)
+        background = time_steps(ARGS, save_freq, CheckpointWriter(ARGS.queue))
+        print(
+            f"{ARGS.model:>10} save every {save_freq:3d} steps: "
+            f"sync {1e3 * sync:8.2f} ms/step, "
+            f"async {1e3 * background:8.2f} ms/step"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checkpoint writer benchmark")
+    parser.add_argument("--model", type=str, default="resnet18")
+    parser.add_argument("--model-class", type=str, default="tinyimagenet")
+    parser.add_argument("--dataset", type=str, default="cifar10")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--save-freq", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--queue", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    main(parser.parse_args())
@@ -0,0 +1,71 @@
+"""
+Compares the throughput of the torchvision DataLoader pipeline of
+load.dataloader with the in-memory tensor_data.TensorLoader on a synthetic
+CIFAR-sized training set.
+
+    python benchmarks/data_loading.py --workers 0 2
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import torch
+from torchvision import datasets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import load
+from utils import tensor_data
+
+MEAN, STD = (0.491, 0.482, 0.447), (0.247, 0.243, 0.262)
+
+
+def make_cifar(size, seed):
+    """
+    Returns a CIFAR10 dataset holding random images, without downloading
+    """
+    rng = np.random.RandomState(seed)
+    dataset = datasets.CIFAR10.__new__(datasets.CIFAR10)
+    dataset.data = rng.randint(0, 256, size=(size, 32, 32, 3), dtype=np.uint8)
+    dataset.targets = list(rng.randint(0, 10, size=size))
+    dataset.transform = load.get_transform(32, 4, MEAN, STD, preprocess=True)
+    dataset.target_transform = None
+    return dataset
+
+
+def images_per_second(loader, batches):
+    count = 0
+    start = time.perf_counter()
+    for i, (data, target) in enumerate(loader):
+        count += len(data)
+        if i + 1 == batches:
+            break
+    return count / (time.perf_counter() - start)
+
+
+def main(ARGS):
+    torch.set_num_threads(ARGS.threads)
+    dataset = make_cifar(ARGS.size, ARGS.seed)
+    for workers in ARGS.workers:
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=ARGS.batch_size, shuffle=True, num_workers=workers
+        )
+        rate = images_per_second(loader, ARGS.batches)
+        print(f"   torchvision, {workers} workers: {rate:10.0f} images/s")
+    data, targets = tensor_data.tensors(dataset)
+    loader = tensor_data.TensorLoader(
+        data, targets, ARGS.batch_size, True, MEAN, STD, padding=4, flip=True
+    )
+    rate = images_per_second(loader, ARGS.batches)
+    print(f"   in memory:                 {rate:10.0f} images/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data loading benchmark")
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    main(parser.parse_args())
@@ -0,0 +1,114 @@
+"""
+Times optimizer.step for custom_sgd.SGD and Lamb with the per-parameter loop
+and with the multi-tensor (foreach) implementation, and checks that both
+produce identical parameters and optimizer state, including every saved
+buffer.
+
+    python benchmarks/optimizer_step.py --models resnet18 vgg16
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import load
+from optimizers.custom_sgd import SGD
+from optimizers.lamb import Lamb
+
+OPTIMIZERS = {
+    "sgd": (SGD, {"lr": 0.1, "weight_decay": 5e-4}),
+    "sgd-buffers": (
+        SGD,
+        {
+            "lr": 0.1,
+            "weight_decay": 5e-4,
+            "momentum": 0.9,
+            "save_buffers": ["sgd", "mom", "grad", "grad_norm"],
+        },
+    ),
+    "lamb": (Lamb, {"lr": 1e-3, "weight_decay": 1e-2}),
+}
+
+
+def make_model(name, dataset):
+    torch.manual_seed(0)
+    input_shape, num_classes = load.dimension(dataset)
+    model_class = "tinyimagenet" if dataset == "tiny-imagenet" else "default"
+    return load.model(name, model_class)(
+        input_shape=input_shape, num_classes=num_classes
+    )
+
+
+def time_steps(model, opt_class, opt_kwargs, foreach, steps, warmup):
+    optimizer = opt_class(model.parameters(), foreach=foreach, **opt_kwargs)
+    generator = torch.Generator().manual_seed(0)
+    for p in model.parameters():
+        p.grad = torch.randn(p.shape, generator=generator) * 1e-2
+    for _ in range(warmup):
+        optimizer.step()
+    start = time.perf_counter()
+    for _ in range(steps):
+        optimizer.step()
+    return (time.perf_counter() - start) / steps, optimizer
+
+
+def equal(x, y):
+    """
+    Returns whether two optimizer state values, possibly nested dicts of
+    tensors such as the saved buffers, are identical
+    """
+    if isinstance(x, dict):
+        return (
+            isinstance(y, dict)
+            and x.keys() == y.keys()
+            and all(equal(x[key], y[key]) for key in x)
+        )
+    if torch.is_tensor(x):
+        return torch.is_tensor(y) and torch.equal(x, y)
+    return x == y
+
+
+def main(ARGS):
+    torch.set_num_threads(ARGS.threads)
+    for model_name in ARGS.models:
+        for opt_name in ARGS.optimizers:
+            opt_class, opt_kwargs = OPTIMIZERS[opt_name]
+            results = {}
+            params = {}
+            states = {}
+            for foreach in [False, True]:
+                model = make_model(model_name, ARGS.dataset)
+                results[foreach], optimizer = time_steps(
+                    model, opt_class, opt_kwargs, foreach, ARGS.steps, ARGS.warmup
+                )
+                params[foreach] = [p.detach().clone() for p in model.parameters()]
+                states[foreach] = [optimizer.state[p] for p in model.parameters()]
+            identical = all(
+                torch.equal(p, q) for p, q in zip(params[False], params[True])
+            ) and all(equal(s, t) for s, t in zip(states[False], states[True]))
+            print(
+                f"{model_name:>10} {opt_name:>12}: "
+                f"loop {1e3 * results[False]:8.2f} ms/step, "
+                f"foreach {1e3 * results[True]:8.2f} ms/step, "
+                f"speedup {results[False] / results[True]:5.2f}x, "
+                f"identical: {identical}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimizer step benchmark")
+    parser.add_argument("--models", type=str, nargs="+", default=["resnet18", "vgg16"])
+    parser.add_argument(
+        "--optimizers",
+        type=str,
+        nargs="+",
+        default=list(OPTIMIZERS.keys()),
+        choices=list(OPTIMIZERS.keys()),
+    )
+    parser.add_argument("--dataset", type=str, default="tiny-imagenet")
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    main(parser.parse_args())
@@ -0,0 +1,319 @@
+"""
+Benchmarks the train/extract/cache/plot pipeline on synthetic experiments.
+Every model of --models is trained for a few steps on random data, with a
+checkpoint at every step, then the suite times custom_sgd.SGD.step with each
+save_buffers option, extract.main, every metric of metric_fns and plot.main,
+reporting their throughput and peak RSS. Results are compared against a
+baseline JSON saved by an earlier run with --save-baseline, and the script
+exits with an error if any case got slower or used more memory than the
+baseline by more than --tolerance.
+
+    python benchmarks/pipeline.py --models conv --save-baseline
+    python benchmarks/pipeline.py --models conv
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+import torch
+import torch.nn as nn
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import cache
+import extract
+import plot
+from metrics import helper
+from metrics import layers
+from metrics.metrics import metric_fns
+from optimizers.custom_sgd import SGD
+from utils import flags
+from utils import load
+from utils import optimize
+
+# (model_class, dataset) of the models the metrics were written for
+MODELS = {
+    "logistic": ("default", "mnist"),
+    "fc": ("default", "mnist"),
+    "fc-bn": ("default", "mnist"),
+    "conv": ("default", "mnist"),
+    "vgg16": ("tinyimagenet", "tiny-imagenet"),
+    "vgg16-bn": ("tinyimagenet", "tiny-imagenet"),
+    "resnet18": ("tinyimagenet", "tiny-imagenet"),
+}
+SAVE_BUFFERS = {
+    "none": [],
+    "sgd": ["sgd"],
+    "mom": ["mom"],
+    "grad": ["grad"],
+    "grad_norm": ["grad_norm"],
+    "all": ["sgd", "mom", "grad", "grad_norm"],
+}
+# metrics plot.py can draw, it only plots conv layers
+PLOTS = ["scale", "rescale", "translation", "gradient", "network", "performance"]
+HYPERPARAMETERS = {"lr": 0.1, "wd": 5e-4, "momentum": 0.9, "dampening": 0.0}
+# differences below this many seconds or MB are noise, not regressions
+MIN_DIFFERENCE = {"seconds": 0.1, "rss_growth_mb": 16}
+
+
+def reset_peak_rss():
+    """
+    Resets the peak RSS of this process where Linux allows it, so that every
+    case reports its own peak
+    """
+    if os.path.isfile("/proc/self/clear_refs"):
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+
+
+def peak_rss():
+    """
+    Returns the peak RSS of this process in MB
+    """
+    if os.path.isfile("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    # kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1 << 20 if sys.platform == "darwin" else 1024)
+
+
+def measure(fn, items, unit, repeats):
+    """
+    Runs fn repeats times and returns its fastest time, throughput in items
+    per second, peak RSS and growth of the RSS over the RSS before the runs,
+    which leaves out memory kept by earlier cases
+    """
+    seconds = float("inf")
+    reset_peak_rss()
+    start_rss = peak_rss()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        seconds = min(seconds, time.perf_counter() - start)
+    return {
+        "seconds": seconds,
+        "throughput": items / seconds,
+        "unit": unit,
+        "peak_rss_mb": peak_rss(),
+        "rss_growth_mb": peak_rss() - start_rss,
+    }
+
+
+def make_model(model_name):
+    torch.manual_seed(0)
+    model_class, dataset = MODELS[model_name]
+    input_shape, num_classes = load.dimension(dataset)
+    model = load.model(model_name, model_class)(
+        input_shape=input_shape, num_classes=num_classes
+    )
+    return model, input_shape, num_classes
+
+
+def make_experiment(ARGS, model_name, save_path):
+    """
+    Trains a model on random batches with every buffer saved and a full
+    checkpoint at every step, as train.py would with --save-freq 1
+    """
+    model, input_shape, num_classes = make_model(model_name)
+    optimizer = SGD(
+        model.parameters(),
+        lr=HYPERPARAMETERS["lr"],
+        weight_decay=HYPERPARAMETERS["wd"],
+        momentum=HYPERPARAMETERS["momentum"],
+        dampening=HYPERPARAMETERS["dampening"],
+        save_buffers=SAVE_BUFFERS["all"],
+    )
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, milestones=[])
+    loss = nn.CrossEntropyLoss()
+    generator = torch.Generator().manual_seed(0)
+
+    os.makedirs(f"{save_path}/ckpt")
+    model_class, dataset = MODELS[model_name]
+    hyperparameters = {"model": model_name, "model_class": model_class}
+    hyperparameters.update(dataset=dataset, seed=0, **HYPERPARAMETERS)
+    with open(f"{save_path}/hyperparameters.json", "w") as f:
+        json.dump(hyperparameters, f)
+    layers.save(layers.layer_map(model), save_path)
+
+    for step in range(ARGS.steps + 1):
+        data = torch.randn((ARGS.batch_size,) + input_shape, generator=generator)
+        target = torch.randint(num_classes, (ARGS.batch_size,), generator=generator)
+        train_loss = 0.0
+        if step > 0:
+            optimizer.zero_grad()
+            output = loss(model(data), target)
+            output.backward()
+            optimizer.step()
+            train_loss = output.item()
+        metric_dict = {"train_loss": train_loss, "test_loss": train_loss}
+        metric_dict.update(accuracy1=0.0, accuracy5=0.0)
+        optimize.checkpoint(
+            model, optimizer, scheduler, 0, step, save_path, 0, metric_dict
+        )
+
+
+def optimizer_case(ARGS, model_name, save_buffers, reduce_buffers=False):
+    model, _, _ = make_model(model_name)
+    optimizer = SGD(
+        model.parameters(),
+        lr=HYPERPARAMETERS["lr"],
+        weight_decay=HYPERPARAMETERS["wd"],
+        momentum=HYPERPARAMETERS["momentum"],
+        save_buffers=save_buffers,
+        reduce_buffers=reduce_buffers,
+    )
+    generator = torch.Generator().manual_seed(0)
+    for p in model.parameters():
+        p.grad = torch.randn(p.shape, generator=generator) * 1e-2
+    for _ in range(ARGS.warmup):
+        optimizer.step()
+
+    def run():
+        for _ in range(ARGS.optimizer_steps):
+            optimizer.step()
+
+    return measure(run, ARGS.optimizer_steps, "steps/s", ARGS.repeats)
+
+
+def run_model(ARGS, model_name, work_dir):
+    """
+    Returns {case: result} for all cases of a model
+    """
+    results = {}
+    for option, save_buffers in SAVE_BUFFERS.items():
+        results[f"sgd-step/{option}"] = optimizer_case(ARGS, model_name, save_buffers)
+    results["sgd-step/all-reduced"] = optimizer_case(
+        ARGS, model_name, SAVE_BUFFERS["all"], reduce_buffers=True
+    )
+
+    exp_path = f"{work_dir}/bench/{model_name}"
+    make_experiment(ARGS, model_name, exp_path)
+    common = ["--save-dir", work_dir, "--experiment", "bench", "--expid", model_name]
+    extract.ARGS = flags.extract().parse_args(
+        common + ["--store"] * ARGS.store + ["--overwrite"]
+    )
+    checkpoints = ARGS.steps + 1
+    results["extract"] = measure(
+        extract.main, checkpoints, "checkpoints/s", ARGS.repeats
+    )
+
+    with open(f"{exp_path}/hyperparameters.json") as f:
+        hyperparameters = json.load(f)
+    hyperparameters.pop("model")
+    layer_map = layers.load(exp_path)
+    feats_dir = f"{exp_path}/feats"
+    steps = helper.get_steps(feats_dir)
+    for metric, metric_fn in metric_fns.items():
+
+        def run():
+            metric_fn(layer_map, feats_dir, steps, **hyperparameters)
+
+        results[f"metric/{metric}"] = measure(run, len(steps), "steps/s", ARGS.repeats)
+
+    if len(helper.get_layers(layer_map, "conv")) == 0:
+        return results
+    for viz in PLOTS:
+        plot_parser = plot.extend_parser(flags.cache())
+        plot_args = plot_parser.parse_args(common + ["--viz", viz])
+        # the cache is computed first so that only loading and plotting is timed
+        helper.close_cache(cache.main(plot_args)[1])
+
+        def run():
+            plot.main(plot_args)
+            plot.plt.close("all")
+
+        results[f"plot/{viz}"] = measure(run, len(steps), "steps/s", ARGS.repeats)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the cases that are slower or use more memory than in baseline by
+    more than tolerance, as printable strings
+    """
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        for key, label in [("seconds", "time"), ("rss_growth_mb", "RSS growth")]:
+            difference = result[key] - baseline[case][key]
+            if difference < MIN_DIFFERENCE[key]:
+                continue
+            if result[key] > (1 + tolerance) * baseline[case][key]:
+                ratio = result[key] / max(baseline[case][key], 1e-9)
+                regressions.append(f"{case}: {label} {ratio:.2f}x the baseline")
+    return regressions
+
+
+def main(ARGS):
+    torch.set_num_threads(ARGS.threads)
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for model_name in ARGS.models:
+            print(f">> Benchmarking {model_name}")
+            model_results = run_model(ARGS, model_name, work_dir)
+            for case, result in model_results.items():
+                results[f"{model_name}/{case}"] = result
+                print(
+                    f"{model_name:>10} {case:>28}: {result['seconds']:8.3f} s, "
+                    f"{result['throughput']:10.2f} {result['unit']}, "
+                    f"peak RSS {result['peak_rss_mb']:8.1f} MB "
+                    f"(+{result['rss_growth_mb']:.1f} MB)"
+                )
+
+    if ARGS.output is not None:
+        with open(ARGS.output, "w") as f:
+            json.dump(results, f, indent=4)
+    if ARGS.save_baseline:
+        baseline = {}
+        if os.path.isfile(ARGS.baseline):
+            with open(ARGS.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(ARGS.baseline, "w") as f:
+            json.dump(baseline, f, indent=4)
+        print(f">> Saved baseline to {ARGS.baseline}")
+        return
+    if not os.path.isfile(ARGS.baseline):
+        print(f">> No baseline at {ARGS.baseline}, rerun with --save-baseline")
+        return
+
+    with open(ARGS.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, ARGS.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if len(regressions) > 0:
+        sys.exit(1)
+    print(f">> No regression against {ARGS.baseline}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline benchmark")
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        default=["fc", "conv"],
+        choices=list(MODELS.keys()),
+    )
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--optimizer-steps", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--store", action="store_true", default=False)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument(
+        "--baseline", type=str, default=f"{REPO_DIR}/benchmarks/baseline.json"
+    )
+    parser.add_argument("--save-baseline", action="store_true", default=False)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--output", type=str, default=None)
+    main(parser.parse_args())
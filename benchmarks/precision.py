@@ -0,0 +1,96 @@
+"""
+Trains a model on a fixed synthetic batch from the same initialisation with
+--precision fp32 and bf16 and reports the throughput of both and the drift of
+the bf16 run: the relative error of the loss and of the per-neuron squared
+weight norms and momentum integral buffers used by the metrics.
+
+    python benchmarks/precision.py --model resnet18 vgg16 --steps 20
+"""
+import argparse
+import os
+import sys
+import time
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics.online import reduce_layer
+from utils import load
+from utils import optimize
+
+
+def train(ARGS, model_name, precision):
+    """
+    Returns the steps per second, the per-step losses and the per-neuron
+    reductions {name: tensor} of a run in the given precision
+    """
+    torch.manual_seed(ARGS.seed)
+    device = torch.device("cpu")
+    input_shape, num_classes = load.dimension(ARGS.dataset)
+    model = load.model(model_name, ARGS.model_class)(
+        input_shape=input_shape, num_classes=num_classes
+    )
+    opt_class, opt_kwargs = load.optimizer("custom_sgd", 0.9, 0.0, False, ["mom"])
+    optimizer = opt_class(model.parameters(), lr=ARGS.lr, **opt_kwargs)
+    loss = nn.CrossEntropyLoss()
+    data = torch.randn(ARGS.batch_size, *input_shape)
+    target = torch.randint(num_classes, (ARGS.batch_size,))
+
+    losses = []
+    start = time.perf_counter()
+    for _ in range(ARGS.steps):
+        optimizer.zero_grad()
+        with optimize.autocast(device, precision):
+            train_loss = loss(model(data), target)
+        train_loss.backward()
+        optimizer.step()
+        losses.append(train_loss.item())
+    rate = ARGS.steps / (time.perf_counter() - start)
+
+    reductions = {}
+    for name, param in model.named_parameters():
+        if param.dim() < 2:
+            continue
+        reductions[f"{name}/in_sq"] = reduce_layer(param, None, "in_sq")
+        buffers = optimizer.state[param]["buffers"]
+        for buffer in ["integral_buffer_1", "integral_buffer_2"]:
+            reductions[f"{name}/{buffer}"] = reduce_layer(buffers[buffer], None, "in")
+    return rate, torch.tensor(losses, dtype=torch.float64), reductions
+
+
+def relative_error(approx, exact):
+    return ((approx - exact).norm() / exact.norm().clamp_min(1e-30)).item()
+
+
+def main(ARGS):
+    torch.set_num_threads(ARGS.threads)
+    for model_name in ARGS.model:
+        fp32_rate, fp32_losses, fp32_reductions = train(ARGS, model_name, "fp32")
+        bf16_rate, bf16_losses, bf16_reductions = train(ARGS, model_name, "bf16")
+        drift = {"in_sq": [], "integral_buffer_1": [], "integral_buffer_2": []}
+        for name, exact in fp32_reductions.items():
+            quantity = name.split("/")[-1]
+            drift[quantity].append(relative_error(bf16_reductions[name], exact))
+        print(
+            f"{model_name:>10}: fp32 {fp32_rate:7.2f} steps/s, "
+            f"bf16 {bf16_rate:7.2f} steps/s ({bf16_rate / fp32_rate:5.2f}x)"
+        )
+        print(f"{'':>10}  loss drift {relative_error(bf16_losses, fp32_losses):.2e}")
+        for quantity, errors in drift.items():
+            print(
+                f"{'':>10}  {quantity:>17} drift: "
+                f"mean {sum(errors) / len(errors):.2e}, max {max(errors):.2e}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mixed precision benchmark")
+    parser.add_argument("--model", type=str, nargs="+", default=["resnet18", "vgg16"])
+    parser.add_argument("--model-class", type=str, default="tinyimagenet")
+    parser.add_argument("--dataset", type=str, default="cifar10")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    main(parser.parse_args())
@@ -0,0 +1,192 @@
+"""
+Checks the accuracy of metrics.helper.compensated_sum against correctly
+rounded math.fsum reductions and compares the throughput of float128 (where
+numpy has it), plain float64 and compensated float64 in/out synapse sums.
+With --check, only runs the deterministic accuracy checks on a
+heavy-cancellation and an empty input, which pre_commit.sh runs on every
+commit.
+
+    python benchmarks/reductions.py
+    python benchmarks/reductions.py --check
+"""
+import argparse
+import math
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from metrics import helper
+
+# (name, weight shape) of typical layers
+SHAPES = [
+    ("conv 64x64x3x3", (64, 64, 3, 3)),
+    ("conv 512x512x3x3", (512, 512, 3, 3)),
+    ("linear 4096x4096", (4096, 4096)),
+]
+# (name, weight shape) of the accuracy checks, including empty layers
+CHECK_SHAPES = [
+    ("conv 32x16x3x3", (32, 16, 3, 3)),
+    ("linear 256x512", (256, 512)),
+    ("empty linear", (0, 3)),
+    ("empty conv", (4, 0, 3, 3)),
+]
+REDUCTIONS = ["in", "out", "in_sq", "out_sq", "out_bias"]
+
+
+def make_buffer(shape, seed):
+    """
+    Returns a float32 array shaped like an integral buffer, spanning several
+    orders of magnitude with alternating signs as in integral_buffer_2
+    """
+    rng = np.random.RandomState(seed)
+    magnitude = 10.0 ** rng.uniform(-8, 2, size=shape)
+    sign = rng.choice([-1.0, 1.0], size=shape)
+    return (sign * magnitude).astype(np.float32)
+
+
+def make_cancelling_buffer(shape, seed):
+    """
+    Returns a float32 array whose in and out sums cancel heavily: large
+    elements on every other row and column of the first half of both synapse
+    axes are negated in the second half, and all other elements are eight
+    orders of magnitude smaller, so plain float64 partial sums lose them
+    """
+    rng = np.random.RandomState(seed)
+    W = 10.0 ** rng.uniform(-8, -4, size=shape) * rng.choice([-1.0, 1.0], size=shape)
+    blocks = tuple(s // 4 for s in shape[:2])
+    large = 10.0 ** rng.uniform(0, 2, size=blocks + shape[2:])
+    for corner in np.ndindex(*(2,) * len(blocks)):
+        index = [
+            c * s // 2 + 2 * np.arange(b) for c, s, b in zip(corner, shape, blocks)
+        ]
+        W[np.ix_(*index)] = (-1) ** sum(corner) * large
+    return W.astype(np.float32)
+
+
+def fsum(x, axes, extra=None):
+    """
+    Returns the correctly rounded sums of x over axes, with the values of
+    extra, shaped like the result, added to the sums
+    """
+    x = np.asarray(x, dtype=np.float64)
+    keep = [a for a in range(x.ndim) if a not in axes]
+    shape = tuple(x.shape[a] for a in keep)
+    size = int(np.prod([x.shape[a] for a in axes]))
+    rows = np.transpose(x, keep + list(axes)).reshape((int(np.prod(shape)), size))
+    if extra is not None:
+        rows = np.concatenate([rows, np.reshape(extra, (-1, 1))], axis=1)
+    return np.array([math.fsum(row) for row in rows]).reshape(shape)
+
+
+def exact_reduction(W, b, reduction):
+    """
+    Returns helper.reduce_layer(W, b, reduction) computed with exact sums
+    """
+    in_axes, out_axes = helper.synapse_axes(W)
+    if reduction in ["in_sq", "out_sq"]:
+        W, b = W ** 2, None if b is None else b ** 2
+    if reduction.startswith("in"):
+        return fsum(W, in_axes, b)
+    out = fsum(W, out_axes)
+    if reduction == "out_bias":
+        return np.append(out, fsum(b, [0]))
+    return out
+
+
+def relative_error(value, reference):
+    if np.size(reference) == 0:
+        return 0.0
+    scale = np.maximum(np.abs(reference), np.finfo(np.float64).tiny)
+    error = np.abs(np.asarray(value, dtype=np.float64) - reference) / scale
+    return float(np.max(error))
+
+
+def check_accuracy(ARGS):
+    """
+    Compares every reduction with precise=True to the exact reduction,
+    returns whether all of them are within --tolerance
+    """
+    passed = True
+    for name, shape in CHECK_SHAPES:
+        W = make_cancelling_buffer(shape, ARGS.seed)
+        b = make_cancelling_buffer(shape[:1], ARGS.seed + 1)
+        for reduction in REDUCTIONS:
+            reference = exact_reduction(W, b, reduction)
+            value = helper.reduce_layer(W, b, reduction, precise=True)
+            if np.shape(value) != np.shape(reference):
+                error = np.inf
+            else:
+                error = relative_error(np.asarray(value), reference)
+            if error > ARGS.tolerance:
+                print(f"{name:>18} {reduction:>8}: rel. err. {error:.1e}")
+                passed = False
+    return passed
+
+
+def timed(fn, repeats):
+    """
+    Returns the fastest of repeats calls of fn, in seconds
+    """
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(ARGS):
+    failed = not check_accuracy(ARGS)
+    if ARGS.check:
+        if failed:
+            print(
+                f"FAILED: compensated sums differ from exact sums by > {ARGS.tolerance}"
+            )
+            sys.exit(1)
+        return
+    for name, shape in SHAPES:
+        W = make_buffer(shape, ARGS.seed)
+        b = make_buffer(shape[:1], ARGS.seed + 1)
+        for reduction in ["in", "out"]:
+            fns = {
+                "float64": lambda: helper.reduce_layer(
+                    W, b, reduction, dtype=np.float64
+                ),
+                "compensated": lambda: helper.reduce_layer(
+                    W, b, reduction, precise=True
+                ),
+            }
+            if hasattr(np, "float128"):
+                # numpy has no float128 on some platforms, e.g. Windows
+                fns["float128"] = lambda: helper.reduce_layer(
+                    W, b, reduction, dtype=np.float128
+                )
+            reference = exact_reduction(W, b, reduction)
+            line = f"{name:>18} {reduction:>3}:"
+            for key, fn in fns.items():
+                seconds = timed(fn, ARGS.repeats)
+                error = relative_error(fn(), reference)
+                line += f"  {key} {1e3 * seconds:8.2f} ms (rel. err. {error:.1e})"
+                if key == "compensated" and error > ARGS.tolerance:
+                    failed = True
+            print(line)
+    if failed:
+        print(f"FAILED: compensated sums differ from exact sums by > {ARGS.tolerance}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synapse reduction benchmark")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=1e-13)
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        default=False,
+        help="only run the accuracy checks",
+    )
+    main(parser.parse_args())
@@ -1,54 +1,211 @@
 import os
-import deepdish as dd
-import glob
+import numbers
+import time
+import numpy as np
 import json
+import torch
+import extract
 from utils import flags
 from metrics import helper
-from metrics.metrics import metric_fns
+from metrics import layers
+from metrics import store
+from metrics.metrics import metric_fns, compute_metrics, FULL_TENSOR_METRICS
+
+# options of the network metric, stored with its cache so that a cache computed
+# with other options is recomputed instead of being returned or updated
+NETWORK_OPTIONS = ["subset", "seed", "quantiles", "bins"]
 
 
 def main(args=None):
     if args is not None:
         ARGS = args
 
-    # load hyperparameters
-    with open(
-        f"{ARGS.save_dir}/{ARGS.experiment}/{ARGS.expid}/hyperparameters.json"
-    ) as f:
+    # load hyperparameters and the layers of the model
+    exp_path = f"{ARGS.save_dir}/{ARGS.experiment}/{ARGS.expid}"
+    with open(f"{exp_path}/hyperparameters.json") as f:
         hyperparameters = json.load(f)
-    model = hyperparameters.pop("model")
+    model = layers.load(exp_path, hyperparameters)
+    hyperparameters.pop("model")
+    # options of the network metric
+    for key in NETWORK_OPTIONS:
+        if getattr(ARGS, key, None) is not None:
+            hyperparameters[key] = getattr(ARGS, key)
+    options = {"network": {key: hyperparameters.get(key) for key in NETWORK_OPTIONS}}
 
     # load cache or run metrics
     print(">> Loading weights...")
-    cache_path = f"{ARGS.save_dir}/{ARGS.experiment}/{ARGS.expid}/cache"
+    cache_path = f"{exp_path}/cache"
     helper.makedir_quiet(cache_path)
 
+    feats_dir = f"{exp_path}/feats"
+    # without extracted features, only metrics of per-neuron reductions can
+    # be computed from the online store
+    reader = helper.FeatureReader(feats_dir, model)
+    reduced = reader.reduced
+    reader.close()
     if len(ARGS.metrics) == 0:
-        ARGS.metrics = list(metric_fns.keys())
+        ARGS.metrics = [
+            metric
+            for metric in metric_fns.keys()
+            if not (reduced and metric in FULL_TENSOR_METRICS)
+        ]
+    unreducible = [metric for metric in ARGS.metrics if metric in FULL_TENSOR_METRICS]
+    assert not (reduced and len(unreducible) > 0), (
+        f"{','.join(unreducible)} need full tensors, but {exp_path} only has the "
+        f"per-neuron reductions of {store.ONLINE_FILENAME}, run extract.py first"
+    )
+    steps = helper.get_steps(feats_dir)
+    caches = {}
+    # metrics to compute, grouped by the steps they are computed over so that
+    # each group is computed in a single pass over the extracted features
+    plan = {}
     for metric in ARGS.metrics:
         cache_file = f"{cache_path}/{metric}{ARGS.suffix}.h5"
+        outdated = False
         if os.path.isfile(cache_file) and not ARGS.overwrite:
-            print(f"   Loading {metric} from cache...")
-            steps, metrics = dd.io.load(cache_file)
-        else:
-            step_names = glob.glob(
-                f"{ARGS.save_dir}/{ARGS.experiment}/{ARGS.expid}/feats/*.h5"
-            )
-            steps = sorted(
-                [int(s.split(".h5")[0].split("step")[1]) for s in step_names]
-            )
-            print(f"   Computing {metric} from extracted features...")
-            metrics = metric_fns[metric](
-                model=model,
-                feats_dir=f"{ARGS.save_dir}/{ARGS.experiment}/{ARGS.expid}/feats",
-                steps=steps,
-                **(hyperparameters),
-            )  # TODO: pass subset and seed for network plot
+            outdated = helper.cache_options(cache_file) != options.get(metric, {})
+        if outdated:
+            print(f"   Cache of {metric} was computed with other options")
+        elif os.path.isfile(cache_file) and not ARGS.overwrite:
+            # only the steps are needed, the cache is read whole to be updated
+            cached_steps, metrics = helper.load_cache(cache_file)
+            helper.close_cache(metrics)
+            cached_steps = list(cached_steps)
+            covered = set(cached_steps)
+            missing = [step for step in steps if step not in covered]
+            if len(missing) == 0:
+                print(f"   Loading {metric} from cache...")
+                continue
+            if len(cached_steps) > 0 and missing[0] > cached_steps[0]:
+                # the theory only depends on the first step and on the buffers
+                # at each step, so the missing steps can be computed on their own
+                print(f"   Updating {metric} with {len(missing)} new steps...")
+                metrics = helper.load_cache(cache_file, lazy=False)[1]
+                caches[metric] = (cached_steps, metrics)
+                plan.setdefault(tuple([cached_steps[0]] + missing), []).append(metric)
+                continue
+
+        print(f"   Computing {metric} from extracted features...")
+        plan.setdefault(tuple(steps), []).append(metric)
+
+    errors = []
+    for plan_steps, plan_metrics in plan.items():
+        results = compute_metrics(
+            model=model,
+            feats_dir=feats_dir,
+            steps=list(plan_steps),
+            metrics=plan_metrics,
+            array_dirs={
+                metric: helper.array_dir(f"{cache_path}/{metric}{ARGS.suffix}.h5")
+                for metric in plan_metrics
+            },
+            **(hyperparameters),
+        )
+        for metric, metrics in results.items():
+            if isinstance(metrics, Exception):
+                print(f"   Computing {metric} failed: {metrics!r}")
+                errors.append(metrics)
+                continue
+            if metric in caches:
+                cached_steps, cached_metrics = caches[metric]
+                metrics = merge_metrics(cached_metrics, metrics)
+                caches[metric] = (sorted(set(cached_steps).union(plan_steps)), metrics)
+            else:
+                caches[metric] = (steps, metrics)
+            cache_file = f"{cache_path}/{metric}{ARGS.suffix}.h5"
             print(f"   Caching features to {cache_file}")
-            dd.io.save(cache_file, (steps, metrics))
+            helper.save_cache(cache_file, caches[metric], options.get(metric))
+    if len(errors) > 0:
+        raise errors[0]
+
+    # NOTE: this will only return the last one, for use with plot.py, read
+    # lazily from the cache file
+    return helper.load_cache(f"{cache_path}/{ARGS.metrics[-1]}{ARGS.suffix}.h5")
+
 
-    # NOTE: this will only return the last one, for use with plot.py
-    return steps, metrics
+def follow(ARGS):
+    """
+    Extracts the checkpoints of a running experiment as they are written and
+    updates the caches with the new steps, until no checkpoint was written
+    for --idle-timeout seconds. The extracted steps are recorded in
+    cache/follow.json so that an interrupted run picks up where it stopped.
+    """
+    exp_path = f"{ARGS.save_dir}/{ARGS.experiment}/{ARGS.expid}"
+    feats_dir = f"{exp_path}/feats"
+    state_file = f"{exp_path}/cache/follow.json"
+    helper.makedir_quiet(feats_dir)
+    helper.makedir_quiet(f"{exp_path}/cache")
+    extracted = set()
+    if os.path.isfile(state_file) and not ARGS.overwrite:
+        with open(state_file) as f:
+            extracted = set(json.load(f)["extracted"])
+
+    last_update = time.time()
+    while True:
+        # checkpoints are renamed into ckpt/ once completely written
+        new = sorted(
+            (step, filename)
+            for step, filename in extract.find_checkpoints(exp_path).items()
+            if step not in extracted
+        )
+        if len(new) == 0:
+            if ARGS.idle_timeout is not None:
+                if time.time() - last_update > ARGS.idle_timeout:
+                    print(f">> No new checkpoint for {ARGS.idle_timeout}s, stopping")
+                    return
+            time.sleep(ARGS.interval)
+            continue
+
+        print(f">> Extracting {len(new)} new checkpoints...")
+        feature_store = None
+        if os.path.isfile(store.store_path(feats_dir)):
+            feature_store = store.FeatureStore(store.store_path(feats_dir), mode="a")
+        for step, filename in new:
+            task = (filename, step, f"{feats_dir}/step{step}.h5", torch.device("cpu"))
+            if feature_store is not None:
+                task = task[:2] + (None,) + task[3:]
+                feature_store.write(step, extract.extract_step(task)[1])
+            else:
+                extract.extract_step(task)
+            extracted.add(step)
+        if feature_store is not None:
+            feature_store.close()
+        with open(f"{state_file}.tmp", "w") as f:
+            json.dump({"extracted": sorted(extracted)}, f)
+        os.replace(f"{state_file}.tmp", state_file)
+
+        try:
+            # close the cache main returns so that the next update can rewrite it
+            helper.close_cache(main(ARGS)[1])
+        except Exception as error:
+            # caches of the other metrics are saved, retry at the next update
+            print(f"   Updating caches failed: {error!r}")
+        # later updates only compute the new steps
+        ARGS.overwrite = False
+        last_update = time.time()
+
+
+def merge_metrics(cached, new, order=None):
+    """
+    Merges metrics computed over new steps into cached metrics. Dicts keyed by
+    step are merged and kept sorted, arrays under a dict with a "steps" entry
+    (as returned by weights_grads) are concatenated and sorted along the step
+    axis, out of core if they are memory-mapped
+    """
+    if order is None and "steps" in new:
+        order = np.argsort(np.concatenate([cached["steps"], new["steps"]]))
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(cached.get(key), dict):
+            merge_metrics(cached[key], value, order)
+        elif order is not None and key in cached:
+            cached[key] = helper.concatenate([cached[key], value], order)
+        else:
+            cached[key] = value
+    if len(cached) > 0 and all(isinstance(key, numbers.Integral) for key in cached):
+        items = sorted(cached.items())
+        cached.clear()
+        cached.update(items)
+    return cached
 
 
 def validate_cache(parsed_args):
@@ -56,6 +213,10 @@ def validate_cache(parsed_args):
         assert m in list(
             metric_fns.keys()
         ), f"--metrics must be a comma separated list of these options: {','.join(list(metric_fns.keys()))}"
+    assert (
+        parsed_args.quantiles is None or parsed_args.quantiles >= 2
+    ), "--quantiles must be at least 2, for the minimum and maximum"
+    assert parsed_args.bins is None or parsed_args.bins >= 1, "--bins must be positive"
 
 
 if __name__ == "__main__":
@@ -63,4 +224,7 @@ if __name__ == "__main__":
     ARGS = parser.parse_args()
     validate_cache(ARGS)
 
-    main(ARGS)
+    if ARGS.follow:
+        follow(ARGS)
+    else:
+        main(ARGS)
@@ -1,72 +1,167 @@
 import glob
 import os
+import multiprocessing
 import deepdish as dd
 import numpy as np
 import torch
 from tqdm import tqdm
 from utils import load
 from utils import flags
+from utils.checkpoint import load_dynamics
+from metrics import store
+
+
+def extract_features(in_filename, device):
+    """
+    Loads a checkpoint and returns the metrics, weights, biases and optimizer
+    buffers used by the metrics as a dict of {group: {name: np.array}}
+    """
+    if in_filename.endswith(".h5"):
+        # dynamics checkpoints already hold the features, see utils.checkpoint
+        return load_dynamics(in_filename)
+    checkpoint = torch.load(in_filename, map_location=device)
+    # Metrics
+    metrics = {}
+    for m in ["train_loss", "test_loss", "accuracy1", "accuracy5"]:
+        if m in checkpoint.keys():
+            metrics[m] = np.array([checkpoint[m]], dtype=np.float64)
+    # Weights
+    params = {}
+    for name, tensor in checkpoint["model_state_dict"].items():
+        if "weight" in name or "bias" in name:
+            params[name] = tensor.cpu().numpy()
+    # Buffers
+    buffers = {}
+    # this assumes the same order of model state dict as optimize state dict
+    param_names = [
+        name
+        for name in checkpoint["model_state_dict"].keys()
+        if ("weight" in name or "bias" in name)
+    ]
+    for name, param_state in zip(
+        param_names, checkpoint["optimizer_state_dict"]["state"].values()
+    ):
+        if "buffers" in param_state.keys():
+            buffer_dict = param_state["buffers"]
+            # Cannot nest dictionaries deeper: load function assumes only 2
+            # nested keys: one for the group, one for feat name
+            for k, v in buffer_dict.items():
+                buffers[f"{name}.{k}"] = v.cpu().numpy()
+    return {"metrics": metrics, "params": params, "buffers": buffers}
+
+
+def save_features(out_filename, feats):
+    """
+    Writes features to a temporary file in the same directory and renames it
+    into place, so a step file is either complete or absent
+    """
+    dirname, basename = os.path.split(out_filename)
+    tmp_filename = f"{dirname}/.{basename}.tmp"
+    dd.io.save(tmp_filename, feats)
+    os.replace(tmp_filename, out_filename)
+
+
+def extract_step(task):
+    """
+    Extracts a single checkpoint. Saves the features to out_filename when
+    given, otherwise returns them so the caller can write them
+    """
+    in_filename, step, out_filename, device = task
+    feats = extract_features(in_filename, device)
+    if out_filename is None:
+        return step, feats
+    save_features(out_filename, feats)
+    return step, None
+
+
+def find_checkpoints(exp_path):
+    """
+    Returns the {step: filename} of the full (.tar) and dynamics (.h5)
+    checkpoints of an experiment, the full one taking precedence if both were
+    saved at the same step
+    """
+    checkpoints = {}
+    for extension in ["h5", "tar"]:
+        for filename in glob.glob(f"{exp_path}/ckpt/*.{extension}"):
+            step = int(os.path.basename(filename).split(".")[0].split("step")[1])
+            checkpoints[step] = filename
+    return checkpoints
 
 
 def main():
     exp_path = f"{ARGS.save_dir}/{ARGS.experiment}/{ARGS.expid}"
-    step_names = glob.glob(f"{exp_path}/ckpt/*.tar")
-    step_list = [int(s.split(".tar")[0].split("step")[1]) for s in step_names]
+    checkpoints = find_checkpoints(exp_path)
+    step_list = list(checkpoints.keys())
+    step_names = list(checkpoints.values())
     device = load.device(ARGS.gpu)
 
     save_path = f"{exp_path}/feats"
     try:
         os.makedirs(save_path)
     except FileExistsError:
-        if not ARGS.overwrite:
+        # the consolidated store is written incrementally and step files are
+        # written atomically, so extraction can skip the steps already written
+        if not (ARGS.overwrite or ARGS.resume or ARGS.store):
             print(
-                "Feature directory exists and no-overwrite specified. Rerun with --overwrite"
+                "Feature directory exists and no-overwrite specified. Rerun with --overwrite or --resume"
             )
             quit()
 
-    for in_filename, step in tqdm(
-        sorted(list(zip(step_names, step_list)), key=lambda x: x[1])
+    feature_store = None
+    if ARGS.store:
+        feature_store = store.FeatureStore(store.store_path(save_path), mode="a")
+
+    tasks = []
+    for in_filename, step in sorted(
+        list(zip(step_names, step_list)), key=lambda x: x[1]
     ):
-        out_filename = f"{save_path}/step{step}.h5"
+        if feature_store is not None:
+            out_filename = f"{feature_store.path}:step{step}"
+            exists = step in feature_store
+        else:
+            out_filename = f"{save_path}/step{step}.h5"
+            exists = os.path.isfile(out_filename)
 
-        if os.path.isfile(out_filename) and not ARGS.overwrite:
+        if exists and not ARGS.overwrite:
             print(f"\t{out_filename} already exists, skipping")
             continue
 
-        checkpoint = torch.load(in_filename, map_location=device)
-        # Metrics
-        metrics = {}
-        for m in ["train_loss", "test_loss", "accuracy1", "accuracy5"]:
-            if m in checkpoint.keys():
-                metrics[m] = np.array([checkpoint[m]])
-        # Weights
-        params = {}
-        for name, tensor in checkpoint["model_state_dict"].items():
-            if "weight" in name or "bias" in name:
-                params[name] = tensor.cpu().numpy()
-        # Buffers
-        buffers = {}
-        # this assumes the same order of model state dict as optimize state dict
-        param_names = [
-            name
-            for name in checkpoint["model_state_dict"].keys()
-            if ("weight" in name or "bias" in name)
-        ]
-        for name, param_state in zip(
-            param_names, checkpoint["optimizer_state_dict"]["state"].values()
-        ):
-            if "buffers" in param_state.keys():
-                buffer_dict = param_state["buffers"]
-                # Cannot nest dictionaries deeper: load function assumes only 2
-                # nested keys: one for the group, one for feat name
-                for k, v in buffer_dict.items():
-                    buffers[f"{name}.{k}"] = v.cpu().numpy()
-        dd.io.save(
-            out_filename, {"metrics": metrics, "params": params, "buffers": buffers}
+        # the store is not safe for concurrent writes: workers hand the
+        # features back and they are written here, in step order
+        if feature_store is not None:
+            out_filename = None
+        tasks.append((in_filename, step, out_filename, device))
+
+    pool = None
+    if ARGS.jobs > 1:
+        # features end up in numpy anyway, keep workers on CPU with one thread
+        # each so that N jobs use N cores. Workers are spawned rather than
+        # forked so they do not inherit CUDA or HDF5 handles.
+        tasks = [task[:3] + (torch.device("cpu"),) for task in tasks]
+        pool = multiprocessing.get_context("spawn").Pool(
+            ARGS.jobs, initializer=torch.set_num_threads, initargs=(1,)
         )
+        results = pool.imap(extract_step, tasks)
+    else:
+        results = map(extract_step, tasks)
+
+    try:
+        for step, feats in tqdm(results, total=len(tasks)):
+            if feats is not None:
+                feature_store.write(step, feats)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        # workers do not outlive a failed or interrupted extraction
+        if pool is not None:
+            pool.terminate()
+        if feature_store is not None:
+            feature_store.close()
 
 
 if __name__ == "__main__":
     parser = flags.extract()
     ARGS = parser.parse_args()
+    flags.validate_extract(ARGS)
     main()
@@ -1,155 +1,134 @@
 import os
 import numpy as np
 import pprint
+import glob
+import tempfile
 import h5py
+import deepdish as dd
+from metrics import store
 
-# This mapping dict needs to be coded manually for every different model we
-# want to plot for, and is done via manual, interactive checkpoint inspection.
-# This is just meant to identify the layers in the checkpoints
-# and map them to pretty, sequential names
-MODELS = {
-    "logistic": {"1": "classifier",},
-    "fc": {
-        "1": "fc1",
-        "3": "fc2",
-        "5": "fc3",
-        "7": "fc4",
-        "9": "fc5",
-        "11": "classifier",
-    },
-    "fc-bn": {
-        "1": "fc1",
-        "2": "bn1",
-        "4": "fc2",
-        "5": "bn2",
-        "7": "fc3",
-        "8": "bn3",
-        "10": "fc4",
-        "11": "bn4",
-        "13": "fc5",
-        "14": "bn5",
-        "16": "classifier",
-    },
-    "conv": {"0": "conv1", "2": "conv2", "5": "classifier",},
-    "vgg16": {
-        "features.0": "conv1",
-        "features.2": "conv2",
-        "features.5": "conv3",
-        "features.7": "conv4",
-        "features.10": "conv5",
-        "features.12": "conv6",
-        "features.14": "conv7",
-        "features.17": "conv8",
-        "features.19": "conv9",
-        "features.21": "conv10",
-        "features.24": "conv11",
-        "features.26": "conv12",
-        "features.28": "conv13",
-        "classifier.0": "fc1",
-        "classifier.3": "fc2",
-        "classifier.6": "classifier",
-    },
-    "vgg16-bn": {
-        "features.0": "conv1",
-        "features.1": "bn1",
-        "features.3": "conv2",
-        "features.4": "bn2",
-        "features.7": "conv3",
-        "features.8": "bn3",
-        "features.10": "conv4",
-        "features.11": "bn4",
-        "features.14": "conv5",
-        "features.15": "bn5",
-        "features.17": "conv6",
-        "features.18": "bn6",
-        "features.20": "conv7",
-        "features.21": "bn7",
-        "features.24": "conv8",
-        "features.25": "bn8",
-        "features.27": "conv9",
-        "features.28": "bn9",
-        "features.30": "conv10",
-        "features.31": "bn10",
-        "features.34": "conv11",
-        "features.35": "bn11",
-        "features.37": "conv12",
-        "features.38": "bn12",
-        "features.40": "conv13",
-        "features.41": "bn13",
-        "classifier.0": "fc1",
-        "classifier.3": "fc2",
-        "classifier.6": "classifier",
-    },
-    "resnet18": {
-        "conv1.0": "conv1_0", # no bias
-        # "conv1.1": "conv1_1",
-        "conv2_x.0.residual_function.0": "conv2_0_0",  # no bias
-        # "conv2_x.0.residual_function.1": "conv2_0_1",
-        "conv2_x.0.residual_function.3": "conv2_0_3",  # no bias
-        # "conv2_x.0.residual_function.4": "conv2_0_4",
-        "conv2_x.1.residual_function.0": "conv2_1_0",  # no bias
-        # "conv2_x.1.residual_function.1": "conv2_1_1",
-        "conv2_x.1.residual_function.3": "conv2_1_3",  # no bias
-        # "conv2_x.1.residual_function.4": "conv2_1_4",
-        "conv3_x.0.residual_function.0": "conv3_0_0",  # no bias
-        # "conv3_x.0.residual_function.1": "conv3_0_1",
-        "conv3_x.0.residual_function.3": "conv3_0_3",  # no bias
-        # "conv3_x.0.residual_function.4": "conv3_0_4",
-        "conv3_x.0.shortcut.0": "conv3_0_s_0",  # no bias
-        # "conv3_x.0.shortcut.1": "conv3_0_s_1",
-        "conv3_x.1.residual_function.0": "conv3_1_0",  # no bias
-        # "conv3_x.1.residual_function.1": "conv3_1_1",
-        "conv3_x.1.residual_function.3": "conv3_1_3",  # no bias
-        # "conv3_x.1.residual_function.4": "conv3_1_4",
-        "conv4_x.0.residual_function.0": "conv4_0_0",  # no bias
-        # "conv4_x.0.residual_function.1": "conv4_0_1",
-        "conv4_x.0.residual_function.3": "conv4_0_3",  # no bias
-        # "conv4_x.0.residual_function.4": "conv4_0_4",
-        "conv4_x.0.shortcut.0": "conv4_0_s_0",  # no bias
-        # "conv4_x.0.shortcut.1": "conv4_0_s_1",
-        "conv4_x.1.residual_function.0": "conv4_1_0",  # no bias
-        # "conv4_x.1.residual_function.1": "conv4_1_1",
-        "conv4_x.1.residual_function.3": "conv4_1_3",  # no bias
-        # "conv4_x.1.residual_function.4": "conv4_1_4",
-        "conv5_x.0.residual_function.0": "conv5_0_0",  # no bias
-        # "conv5_x.0.residual_function.1": "conv5_0_1",
-        "conv5_x.0.residual_function.3": "conv5_0_3",  # no bias
-        # "conv5_x.0.residual_function.4": "conv5_0_4",
-        "conv5_x.0.shortcut.0": "conv5_0_s_0",  # no bias
-        # "conv5_x.0.shortcut.1": "conv5_0_s_1",
-        "conv5_x.1.residual_function.0": "conv5_1_0",  # no bias
-        # "conv5_x.1.residual_function.1": "conv5_1_1",
-        "conv5_x.1.residual_function.3": "conv5_1_3",  # no bias
-        # "conv5_x.1.residual_function.4": "conv5_1_4",
-        "fc": "classifier",
-    },
-}
-
-
-def in_synapses(W, b=None, dtype=None):
-    """
-    Computes sum of in synapses to next layer
-    """
-    if np.ndim(W) == 4:
-        in_sum = np.sum(W, axis=(1, 2, 3), dtype=dtype)
+# (group, suffix) pairs commonly requested from a FeatureReader
+PARAMS = [("params", "weight"), ("params", "bias")]
+GRAD_BUFFERS = [("buffers", "weight.grad_buffer"), ("buffers", "bias.grad_buffer")]
+
+
+def compensated_sum(x, axis):
+    """
+    Sums x over axis in float64 with an error-free split of every element
+    into a high part on a grid of (n + 2) * max|x|, whose sum is exact even in
+    the input precision, and a low part of magnitude below that grid, which
+    is summed in float64 as a correction (Rump's ExtractScalar). The result
+    stays within a float64 ulp or so of the exact sum even under heavy
+    cancellation, which makes it a vectorised replacement for float128
+    accumulation
+    """
+    x = np.asarray(x)
+    axis = tuple(sorted(a % x.ndim for a in np.atleast_1d(axis)))
+    keep = tuple(a for a in range(x.ndim) if a not in axis)
+    shape = tuple(x.shape[a] for a in keep)
+    n = int(np.prod([x.shape[a] for a in axis]))
+    if n == 0 or x.size == 0:
+        return np.zeros(shape)
+
+    # a 2d view reduced over contiguous rows or over its leading axis, which
+    # numpy reduces much faster than interleaved axes
+    if axis == tuple(range(x.ndim - len(axis), x.ndim)):
+        x, reduce_axis = x.reshape((-1, n)), 1
     else:
-        in_sum = np.sum(W, axis=1, dtype=dtype)
+        x, reduce_axis = np.transpose(x, axis + keep).reshape((n, -1)), 0
+    if x.dtype.kind != "f" or x.dtype.itemsize > 4:
+        x = x.astype(np.float64, copy=False)
+    elif x.dtype.itemsize < 4:
+        x = x.astype(np.float32)
+
+    x_max = np.maximum(
+        x.max(axis=reduce_axis, keepdims=True), -x.min(axis=reduce_axis, keepdims=True)
+    )
+    bound = x_max.astype(np.float64) * (n + 2)
+    finite = np.isfinite(bound) & (bound < np.finfo(x.dtype).max / 4)
+    sigma = np.ldexp(1.0, np.frexp(np.where(finite & (bound > 0), bound, 1.0))[1])
+    sigma = sigma.astype(x.dtype)
+
+    high = x + sigma
+    high -= sigma
+    total = np.sum(high, axis=reduce_axis).astype(np.float64)
+    np.subtract(x, high, out=high)
+    total += np.sum(high, axis=reduce_axis, dtype=np.float64)
+    if not np.all(finite):
+        fallback = np.sum(x, axis=reduce_axis, dtype=np.float64)
+        total = np.where(finite.ravel(), total, fallback)
+    return total.reshape(shape)
+
+
+def _sum(W, axis, dtype=None, precise=False):
+    if precise:
+        return compensated_sum(W, axis)
+    return np.sum(W, axis=axis, dtype=dtype)
+
+
+def synapse_axes(W):
+    """
+    Returns the (in_axes, out_axes) of a weight: the axes summed over for the
+    in synapses of an output neuron and the out synapses of an input neuron
+    """
+    ndim = len(np.shape(W))
+    return list(range(1, ndim)), [0] + list(range(2, ndim))
+
+
+def in_synapses(W, b=None, dtype=None, precise=False, axes=None):
+    """
+    Computes sum of in synapses to next layer over axes, by default the in
+    axes of synapse_axes, with compensated_sum if precise
+    """
+    if axes is None:
+        axes = synapse_axes(W)[0]
+    in_sum = _sum(W, tuple(axes), dtype, precise)
     if b is not None:
         in_sum += b
     return in_sum
 
 
-def out_synapses(W, b=None, dtype=None):
+def out_synapses(W, b=None, dtype=None, precise=False, axes=None):
     """
-    Computes sum of out synapses from last layer
+    Computes sum of out synapses from last layer over axes, by default the
+    out axes of synapse_axes, with compensated_sum if precise
     """
-    if np.ndim(W) == 4:
-        out_sum = np.sum(W, axis=(0, 2, 3), dtype=dtype)
-    else:
-        out_sum = np.sum(W, axis=0, dtype=dtype)
+    if axes is None:
+        axes = synapse_axes(W)[1]
+    out_sum = _sum(W, tuple(axes), dtype, precise)
     return out_sum
 
 
+def reduce_layer(W, b, reduction, dtype=None, precise=False, axes=None):
+    """
+    Reduces a layer's weight W and bias b to a per-neuron quantity
+
+        in: sum of in synapses plus bias
+        out: sum of out synapses
+        in_sq: sum of squared in synapses plus squared bias
+        out_sq: sum of squared out synapses
+        out_bias: sum of out synapses with the sum of biases appended
+
+    axes are the (in_axes, out_axes) of the layer map entry of the layer (see
+    metrics.layers), derived from the dimensions of W if not given
+    """
+    in_axes, out_axes = synapse_axes(W) if axes is None else axes
+    kwargs = {"dtype": dtype, "precise": precise}
+    if reduction == "in":
+        return in_synapses(W, b, axes=in_axes, **kwargs)
+    if reduction == "out":
+        return out_synapses(W, axes=out_axes, **kwargs)
+    if reduction == "in_sq":
+        b_sq = None if b is None else b ** 2
+        return in_synapses(W ** 2, b_sq, axes=in_axes, **kwargs)
+    if reduction == "out_sq":
+        return out_synapses(W ** 2, axes=out_axes, **kwargs)
+    if reduction == "out_bias":
+        out_sum = out_synapses(W, axes=out_axes, **kwargs)
+        return np.append(out_sum, _sum(b, 0, dtype, precise))
+    raise ValueError(f"Unknown reduction: {reduction}")
+
+
 def makedir_quiet(d):
     """
     Convenience util to create a directory if it doesn't exist
@@ -158,6 +137,136 @@ def makedir_quiet(d):
         os.makedirs(d)
 
 
+# Arrays too large to be held in memory, such as the weights and gradients of
+# weights_grads, are written step by step to memory-mapped .npy files in the
+# array directory of their cache. The cache file holds their filenames, tagged
+# with store.MEMMAP_TAG and relative to the cache directory, in place of the
+# arrays.
+
+
+def array_dir(cache_file):
+    """
+    Returns the directory of the memory-mapped arrays of a cache file
+    """
+    return os.path.splitext(cache_file)[0]
+
+
+def open_array(out_dir, name, shape, dtype):
+    """
+    Returns a new memory-mapped array stored in out_dir as {name}.*.npy, under
+    a unique filename so that arrays still mapped elsewhere are never
+    overwritten
+    """
+    makedir_quiet(out_dir)
+    fd, filename = tempfile.mkstemp(suffix=".npy", prefix=f"{name}.", dir=out_dir)
+    os.close(fd)
+    return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=shape)
+
+
+def concatenate(arrays, order):
+    """
+    Returns np.concatenate(arrays)[order], written row by row to a new
+    memory-mapped array next to the last one if any of them is memory-mapped
+    """
+    if not any(isinstance(array, np.memmap) for array in arrays):
+        return np.concatenate(arrays)[order]
+    memmap = [array for array in arrays if isinstance(array, np.memmap)][-1]
+    name = os.path.basename(memmap.filename).rsplit(".", 2)[0]
+    shape = (sum(len(array) for array in arrays),) + arrays[0].shape[1:]
+    out = open_array(os.path.dirname(memmap.filename), name, shape, arrays[0].dtype)
+    offsets = np.cumsum([0] + [len(array) for array in arrays])
+    for row, index in enumerate(order):
+        i = np.searchsorted(offsets, index, side="right") - 1
+        out[row] = arrays[i][index - offsets[i]]
+    out.flush()
+    return out
+
+
+def save_cache(cache_file, cache, options=None):
+    """
+    Saves the (steps, metrics) of a cache column-wise (see
+    store.write_cache) with the options it was computed with, storing
+    memory-mapped arrays by filename, and deletes the arrays of its array
+    directory it no longer refers to
+    """
+    cache_dir = os.path.dirname(cache_file)
+    filenames = set()
+
+    def _replace(x):
+        if isinstance(x, dict):
+            return {key: _replace(value) for key, value in x.items()}
+        if isinstance(x, np.memmap):
+            x.flush()
+            filenames.add(os.path.abspath(x.filename))
+            return store.MEMMAP_TAG + os.path.relpath(x.filename, cache_dir)
+        return x
+
+    steps, metrics = cache
+    store.write_cache(cache_file, steps, _replace(metrics), options)
+    for filename in glob.glob(f"{array_dir(cache_file)}/*.npy"):
+        if os.path.abspath(filename) not in filenames:
+            os.remove(filename)
+
+
+def load_cache(cache_file, lazy=True):
+    """
+    Loads the (steps, metrics) of a cache, opening its memory-mapped arrays
+    read-only. If lazy, metrics is a mapping that only reads the columns that
+    are accessed (see store.CacheGroup) and keeps the cache file open until
+    it is closed with close_cache, otherwise nested dicts. Caches saved with
+    deepdish before are read whole.
+    """
+    if store.is_cache(cache_file):
+        steps, metrics = store.open_cache(cache_file)
+        if lazy:
+            return steps, metrics
+        with metrics:
+            return steps, metrics.load()
+
+    cache_dir = os.path.dirname(cache_file)
+
+    def _replace(x):
+        if isinstance(x, dict):
+            return {key: _replace(value) for key, value in x.items()}
+        if isinstance(x, (list, tuple)):
+            return type(x)(_replace(value) for value in x)
+        if isinstance(x, str) and x.startswith(store.MEMMAP_TAG):
+            filename = x[len(store.MEMMAP_TAG) :]
+            return np.load(f"{cache_dir}/{filename}", mmap_mode="r")
+        return x
+
+    return _replace(dd.io.load(cache_file))
+
+
+def close_cache(metrics):
+    """
+    Closes the cache file of metrics loaded lazily by load_cache, metrics
+    read whole hold no open file
+    """
+    if isinstance(metrics, store.CacheGroup):
+        metrics.close()
+
+
+def cache_options(cache_file):
+    """
+    Returns the options a cache was computed with, {} for caches saved
+    without options or with deepdish
+    """
+    if store.is_cache(cache_file):
+        return store.cache_options(cache_file)
+    return {}
+
+
+def column(values):
+    """
+    Returns the steps and the (steps x ...) array of values of a {step: value}
+    dict of a cache, directly for a store.Column
+    """
+    if isinstance(values, store.Column):
+        return values.steps, values.array
+    return np.array(list(values.keys())), np.array(list(values.values()))
+
+
 def make_iterable(x):
     """
     If x is not already array_like, turn it into a list or np.array
@@ -167,8 +276,29 @@ def make_iterable(x):
     return x
 
 
-def get_layers(model):
-    return MODELS[model].values()
+def get_layers(layer_map, kind=None):
+    """
+    Returns the names of the layers of a layer map (see metrics.layers), or
+    of its layers of a kind ("conv", "linear" or "bn")
+    """
+    return [layer["name"] for layer in layer_map if kind in [None, layer["kind"]]]
+
+
+def get_pairs(layer_map, kind):
+    """
+    Returns the (layer_in, layer) pairs of layers of a kind where the neurons
+    of layer_in only feed into layer, whose in and out synapses are coupled
+    by the rescale symmetry
+    """
+    layers = {layer["name"]: layer for layer in layer_map}
+    return [
+        (layer["previous"][0], layer["name"])
+        for layer in layer_map
+        if layer["kind"] == kind
+        and len(layer["previous"]) == 1
+        and layers[layer["previous"][0]]["kind"] == kind
+        and layers[layer["previous"][0]]["next"] == [layer["name"]]
+    ]
 
 
 def get_features(
@@ -210,31 +340,289 @@ def get_features(
     return out
 
 
-def load_features(steps, feats_dir, model, suffix, group, verbose=False):
-    """ Loops over steps, fetches features from every checkpoint file
-    and assenbles it into a single dict
+class FeatureReader:
+    """
+    Reads extracted features for a model, opening each step file once and
+    serving every requested (group, suffix) pair from that single handle.
+    If the feats directory holds a consolidated store (see metrics.store),
+    features are read from it instead of the per-step files. If there are no
+    extracted features but training wrote an online store of per-neuron
+    reductions (see metrics.online), only read_reduced is available.
 
-    layers: is the output keys for the layer feats, or computed quantities
-    keys: is the actual keys to be read from the h5 file
-    feats: is the output dict
+    Inputs
+        feats_dir (str): directory holding the step{N}.h5 feature files
+        layer_map (list): layer map of the model (see metrics.layers), mapping
+            checkpoint names to layers
     """
 
-    names = [f"{name}.{suffix}" for name in MODELS[model].keys()]
-    layers = list(MODELS[model].values())
+    def __init__(self, feats_dir, layer_map, verbose=False):
+        self.feats_dir = feats_dir
+        self.names = [layer["prefix"] for layer in layer_map]
+        self.layers = [layer["name"] for layer in layer_map]
+        self.biases = {layer["name"]: layer["bias"] for layer in layer_map}
+        # layer maps saved before axes were recorded leave them to reduce_layer
+        self.axes = {
+            layer["name"]: (layer["in_axes"], layer["out_axes"])
+            if "in_axes" in layer
+            else None
+            for layer in layer_map
+        }
+        self.verbose = verbose
+        self.store = None
+        if os.path.isfile(store.store_path(feats_dir)):
+            self.store = store.FeatureStore(store.store_path(feats_dir))
+        elif not glob.glob(f"{feats_dir}/step*.h5") and os.path.isfile(
+            store.online_path(feats_dir)
+        ):
+            self.store = store.FeatureStore(store.online_path(feats_dir))
+        self.reduced = self.store is not None and self.store.reduced
+        self.reduced_buffers = None
+        # the file, features and reductions of the last step read are kept
+        # open or in memory, so that metrics computed together (see
+        # metrics.planner) and reductions of the same tensors at different
+        # precisions only read each step once
+        self._last_step = None
+        self._last_feats = {}
+        self._last_reduced = {}
+        self._open_file = None
+        self._unpickled = {}
+
+    def path(self, step):
+        return f"{self.feats_dir}/step{step}.h5"
+
+    def exists(self, step):
+        if self.store is not None:
+            return step in self.store
+        return os.path.isfile(self.path(step))
+
+    def close(self):
+        self._close_file()
+        if self.store is not None:
+            self.store.close()
 
-    feats = {layer: {} for layer in layers}
+    def read(self, step, keys, layers=None):
+        """
+        Returns a dict mapping each (group, suffix) pair in keys to a dict of
+        {layer: array} for the given step
+        """
+        if layers is None:
+            layers = self.layers
+        self._remember(step)
+        missing = [
+            key
+            for key in keys
+            if key not in self._last_feats
+            or any(layer not in self._last_feats[key] for layer in layers)
+        ]
+        if len(missing) > 0:
+            readable, requests = [], []
+            for group, suffix in missing:
+                # layers without bias have no bias features, read as None
+                readable.append(
+                    [
+                        layer
+                        for layer in layers
+                        if self.biases[layer] or not suffix.startswith("bias")
+                    ]
+                )
+                names = [self.names[self.layers.index(l)] for l in readable[-1]]
+                requests.append((group, [f"{name}.{suffix}" for name in names]))
+            for key, key_layers, arrays in zip(
+                missing, readable, self._read(step, requests)
+            ):
+                feats = self._last_feats.setdefault(key, {})
+                feats.update((layer, None) for layer in layers)
+                feats.update(zip(key_layers, arrays))
+        return {
+            key: {layer: self._last_feats[key][layer] for layer in layers}
+            for key in keys
+        }
 
-    for step in steps:
-        feats_path = f"{feats_dir}/step{step}.h5"
+    def read_reduced(self, step, keys, layers=None, precise=False):
+        """
+        Returns a dict mapping each (group, reduction) pair in keys to a dict
+        of {layer: array} of per-neuron reductions (see reduce_layer). Params
+        are requested as e.g. ("params", "in_sq"), buffers as e.g.
+        ("buffers", "integral_buffer.in"). With precise, reductions are
+        float64 compensated sums.
+        """
+        if layers is None:
+            layers = self.layers
+        if self.reduced:
+            out = self.read(step, keys, layers)
+            if precise:
+                for arrays in out.values():
+                    arrays.update({l: a.astype(float) for l, a in arrays.items()})
+            return out
 
-        if os.path.isfile(feats_path):
-            feature_dict = get_features(
-                feats_path=feats_path,
-                group=group,
-                keys=names,
-                out_keys=layers,
-                verbose=verbose,
-            )
+        if self.reduced_buffers is None and any(g == "buffers" for g, _ in keys):
+            # buffers saved by custom_sgd.SGD with reduce_buffers are already
+            # reduced to "{buffer}.in" and "{buffer}.out" per parameter
+            names = self._keys(step, "buffers")
+            self.reduced_buffers = any(name.endswith(".in") for name in names)
+
+        raw_keys = []
+        for key in keys:
+            raw_keys += [k for k in self._raw_keys(*key) if k not in raw_keys]
+        self.read(step, raw_keys, layers)
+
+        out = {}
+        for group, reduction in keys:
+            weight_key, bias_key = self._raw_keys(group, reduction)
+            weights = self._last_feats[weight_key]
+            biases = self._last_feats[bias_key]
+            reduced = self._last_reduced.setdefault((group, reduction, precise), {})
             for layer in layers:
-                feats[layer][f"step_{step}"] = feature_dict[layer]
-    return feats
+                if layer in reduced:
+                    continue
+                if group == "buffers" and self.reduced_buffers:
+                    reduced[layer] = np.asarray(
+                        weights[layer], np.float64 if precise else None
+                    )
+                    if reduction.endswith(".in") and biases[layer] is not None:
+                        reduced[layer] = reduced[layer] + biases[layer]
+                else:
+                    reduced[layer] = reduce_layer(
+                        weights[layer],
+                        biases[layer],
+                        reduction.split(".")[-1],
+                        precise=precise,
+                        axes=self.axes[layer],
+                    )
+            out[(group, reduction)] = {layer: reduced[layer] for layer in layers}
+        return out
+
+    def shapes(self, step, key, layers=None):
+        """
+        Returns a dict of {layer: shape} of a (group, suffix) key at the given
+        step without reading it, None for layers without bias features
+        """
+        if layers is None:
+            layers = self.layers
+        group, suffix = key
+        shapes = {}
+        for layer in layers:
+            if suffix.startswith("bias") and not self.biases[layer]:
+                shapes[layer] = None
+                continue
+            name = f"{self.names[self.layers.index(layer)]}.{suffix}"
+            if self.store is not None:
+                shapes[layer] = self.store.shape(group, name)
+            else:
+                shapes[layer] = np.shape(self._group(step, group)[name])
+        return shapes
+
+    def read_sample(self, step, key, indices):
+        """
+        Returns a dict of {layer: array} of the elements at the flat
+        indices[layer] of a (group, suffix) key at the given step. Only those
+        elements are read, in sorted order so that each chunk is visited once,
+        and returned in the order of indices.
+        """
+        group, suffix = key
+        out = {}
+        for layer, layer_indices in indices.items():
+            name = f"{self.names[self.layers.index(layer)]}.{suffix}"
+            order = np.argsort(layer_indices, kind="stable")
+            sorted_indices = np.asarray(layer_indices)[order]
+            if self.store is not None:
+                sample = self.store.read_sample(step, group, name, sorted_indices)
+            else:
+                dataset = self._group(step, group)[name]
+                if isinstance(dataset, h5py.Dataset):
+                    coords = np.unravel_index(sorted_indices, dataset.shape)
+                    sample = store.read_points(dataset, np.stack(coords, axis=1))
+                else:
+                    sample = np.reshape(dataset, -1)[sorted_indices]
+            out[layer] = np.empty_like(sample)
+            out[layer][order] = sample
+        return out
+
+    def read_group(self, step, group, keys):
+        """
+        Returns a dict of {key: array} for keys that are not tied to a layer,
+        e.g. the "metrics" group
+        """
+        return dict(zip(keys, self._read(step, [(group, keys)])[0]))
+
+    def _remember(self, step):
+        if step != self._last_step:
+            self._close_file()
+            self._last_step = step
+            self._last_feats, self._last_reduced = {}, {}
+            self._unpickled = {}
+
+    def _close_file(self):
+        if self._open_file is not None:
+            self._open_file.close()
+            self._open_file = None
+
+    def _raw_keys(self, group, reduction):
+        """
+        Returns the (group, suffix) keys of the weight and bias a reduction
+        is computed from
+        """
+        if group == "params":
+            return [("params", "weight"), ("params", "bias")]
+        buffer = reduction.rsplit(".", 1)[0]
+        if self.reduced_buffers:
+            return [(group, f"weight.{reduction}"), (group, f"bias.{buffer}.in")]
+        return [(group, f"weight.{buffer}"), (group, f"bias.{buffer}")]
+
+    def _keys(self, step, group):
+        """
+        Returns the dataset names in a group of a step
+        """
+        if self.store is not None:
+            return self.store.keys(group)
+        return list(self._group(step, group).keys())
+
+    def _group(self, step, group):
+        """
+        Returns a group of the file of a step, kept open. deepdish pickles
+        dicts of 256 or more arrays, such as the buffers of resnet18, into a
+        single dataset, which is unpickled into a dict once per step
+        """
+        self._remember(step)
+        if self._open_file is None:
+            feats_path = self.path(step)
+            assert os.path.isfile(feats_path), f"{feats_path} is not a file"
+            self._open_file = h5py.File(feats_path, "r")
+        if isinstance(self._open_file[group], h5py.Dataset):
+            if group not in self._unpickled:
+                self._unpickled[group] = dd.io.load(self.path(step), f"/{group}")
+            return self._unpickled[group]
+        return self._open_file[group]
+
+    def _read(self, step, requests):
+        """
+        Reads a list of (group, [dataset names]) requests for a step and
+        returns a list of lists of arrays, in the same order
+        """
+        if self.store is not None:
+            return [
+                list(self.store.read(step, group, names).values())
+                for group, names in requests
+            ]
+
+        groups = {group: self._group(step, group) for group, _ in requests}
+        if self.verbose:
+            for group in groups:
+                print(f"Keys in {group}:")
+                pprint.pprint(list(groups[group].keys()))
+
+        return [[groups[group][name][:] for name in names] for group, names in requests]
+
+
+def get_steps(feats_dir):
+    """
+    Returns the sorted list of steps with extracted features in feats_dir,
+    falling back to the steps of the online store if nothing was extracted
+    """
+    step_names = glob.glob(f"{feats_dir}/step*.h5")
+    online_path = store.online_path(feats_dir)
+    for path in [store.store_path(feats_dir), online_path]:
+        if os.path.isfile(path) and (len(step_names) == 0 or path != online_path):
+            with store.FeatureStore(path) as feature_store:
+                return feature_store.steps
+    return sorted([int(s.split(".h5")[0].split("step")[-1]) for s in step_names])
@@ -0,0 +1,139 @@
+import json
+import os
+import torch
+import torch.nn as nn
+from metrics import helper
+
+# The layer map of a model lists its conv, linear and batch norm layers in
+# forward order, mapping the prefix of their parameters in the checkpoints to
+# pretty sequential names (conv1, conv2, ..., fc1, ..., classifier for the last
+# linear layer, bn1, ...), and is saved as layers.json next to
+# hyperparameters.json. Each entry is a dict of
+#     name (str): pretty name used as key in the caches
+#     prefix (str): prefix of the weight and bias in the state dict
+#     kind (str): "conv", "linear" or "bn"
+#     in_axes, out_axes (list): weight axes summed over for the in and out
+#         synapses of a neuron (see metrics.helper.reduce_layer)
+#     bias (bool): whether the layer has a bias
+#     previous, next (list): for conv and linear layers, the conv and linear
+#         layers feeding into and fed by this one, through any number of
+#         parameter free or batch norm layers
+LAYER_MAP_FILE = "layers.json"
+KINDS = [
+    ("conv", nn.modules.conv._ConvNd),
+    ("linear", nn.Linear),
+    ("bn", nn.modules.batchnorm._BatchNorm),
+]
+
+
+def layer_map(model):
+    """
+    Returns the layer map of an nn.Module, tracing its forward pass with
+    torch.fx to find the neighbours of every layer, or taking consecutive
+    layers as neighbours if the model cannot be traced
+    """
+    modules = []
+    for prefix, module in model.named_modules():
+        for kind, module_class in KINDS:
+            if isinstance(module, module_class) and module.weight is not None:
+                modules.append((prefix, kind, module))
+    counts = {}
+    linear = [prefix for prefix, kind, _ in modules if kind == "linear"]
+    layers = []
+    for prefix, kind, module in modules:
+        counts[kind] = counts.get(kind, 0) + 1
+        name = f"{'fc' if kind == 'linear' else kind}{counts[kind]}"
+        if len(linear) > 0 and prefix == linear[-1]:
+            name = "classifier"
+        in_axes, out_axes = helper.synapse_axes(module.weight)
+        layers.append(
+            {
+                "name": name,
+                "prefix": prefix,
+                "kind": kind,
+                "in_axes": in_axes,
+                "out_axes": out_axes,
+                "bias": module.bias is not None,
+                "previous": [],
+                "next": [],
+            }
+        )
+
+    names = {layer["prefix"]: layer["name"] for layer in layers}
+    weighted = [layer["prefix"] for layer in layers if layer["kind"] != "bn"]
+    for prefix, previous in _previous(model, weighted).items():
+        for layer_in in previous:
+            layers[_index(layers, layer_in)]["next"].append(names[prefix])
+            layers[_index(layers, prefix)]["previous"].append(names[layer_in])
+    return layers
+
+
+def save(layers, save_path):
+    with open(f"{save_path}/{LAYER_MAP_FILE}", "w") as f:
+        json.dump(layers, f, indent=4)
+
+
+def load(exp_path, hyperparameters=None):
+    """
+    Returns the layer map saved with an experiment. Experiments trained
+    before layer maps were saved get theirs built from the model described
+    by hyperparameters, and saved
+    """
+    filename = f"{exp_path}/{LAYER_MAP_FILE}"
+    if not os.path.isfile(filename):
+        from utils import load as load_utils
+
+        # defaults of the train flags
+        dataset = hyperparameters.get("dataset", "mnist")
+        model_class = hyperparameters.get("model_class", "default")
+        input_shape, num_classes = load_utils.dimension(dataset)
+        model = load_utils.model(hyperparameters["model"], model_class)(
+            input_shape=input_shape, num_classes=num_classes
+        )
+        save(layer_map(model), exp_path)
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _index(layers, prefix):
+    return [layer["prefix"] for layer in layers].index(prefix)
+
+
+def _previous(model, weighted):
+    """
+    Returns {prefix: [prefixes]} of the weighted layers directly upstream of
+    every weighted layer
+    """
+    try:
+        graph = _Tracer().trace(model)
+    except Exception:
+        # e.g. data dependent control flow, assume a sequential model
+        return {layer: [layer_in] for layer_in, layer in zip(weighted, weighted[1:])}
+
+    upstream = {}
+    previous = {}
+    for node in graph.nodes:
+        inputs = set()
+        for input_node in node.all_input_nodes:
+            if input_node.op == "call_module" and input_node.target in weighted:
+                inputs.add(input_node.target)
+            else:
+                inputs |= upstream[input_node]
+        upstream[node] = inputs
+        if node.op == "call_module" and node.target in weighted:
+            previous[node.target] = sorted(inputs, key=weighted.index)
+    return previous
+
+
+class _Tracer(torch.fx.Tracer):
+    """
+    Traces through modules created in forward, such as the
+    nn.ReLU(inplace=True)(...) of the residual blocks, instead of failing
+    """
+
+    def call_module(self, m, forward, args, kwargs):
+        try:
+            self.path_of_module(m)
+        except NameError:
+            return forward(*args, **kwargs)
+        return super().call_module(m, forward, args, kwargs)
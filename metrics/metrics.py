@@ -1,107 +1,195 @@
 import os
-from tqdm import tqdm
 import metrics.helper as utils
+import metrics.planner as planner
 import numpy as np
 
-from metrics.scale import scale, scale_momentum
-from metrics.rescale import rescale, rescale_momentum
-from metrics.translation import translation, translation_momentum
-from metrics.phase import phase
-from metrics.weights_grads import weights_grads
+from metrics.scale import scale_kernel, scale_momentum_kernel
+from metrics.rescale import rescale_kernel, rescale_momentum_kernel
+from metrics.translation import translation_kernel, translation_momentum_kernel
+from metrics.phase import phase_kernel
+from metrics.weights_grads import weights_grads_kernel
 
 
-def gradient(model, feats_dir, steps, **kwargs):
-    layers = [layer for layer in utils.get_layers(model) if "conv" in layer]
+def gradient_kernel(model, reader, steps, **kwargs):
+    layers = utils.get_layers(model, "conv")
 
     empirical = {layer: {} for layer in layers}
-    for i in tqdm(range(len(steps))):
+    for i in range(len(steps)):
         step = steps[i]
-        if step == 0:
-            continue
-        weight_buffers = utils.load_features(
-            steps=[str(step)],
-            feats_dir=feats_dir,
-            model=model,
-            suffix="weight.grad_norm_buffer",
-            group="buffers",
-        )
-        bias_buffers = utils.load_features(
-            steps=[str(step)],
-            feats_dir=feats_dir,
-            model=model,
-            suffix="bias.grad_norm_buffer",
-            group="buffers",
-        )
-        for layer in layers:
-            wl_t = weight_buffers[layer][f"step_{step}"]
-            bl_t = bias_buffers[layer][f"step_{step}"]
-            empirical[layer][step] = utils.in_synapses(wl_t, bl_t)
+        if step != 0:
+            key = ("buffers", "grad_norm_buffer.in")
+            feats = reader.read_reduced(step, [key], layers)
+            for layer in layers:
+                empirical[layer][step] = feats[key][layer]
+        yield
 
     return {"empirical": empirical}
 
 
-def network(model, feats_dir, steps, **kwargs):
+def sample_indices(sizes, subset, seed):
+    """
+    Returns {layer: indices} of subset parameters of every layer drawn without
+    replacement, the same indices as drawing them at every step after
+    seeding np.random with seed
+    """
+    np.random.seed(seed)
+    return {
+        layer: np.random.choice(size, size=min(subset, size), replace=False)
+        for layer, size in sizes.items()
+    }
+
+
+def gather(reader, step, indices, weight_sizes):
+    """
+    Returns {layer: parameters} at indices of every layer's flattened weight
+    followed by its bias, reading only those parameters
+    """
+    in_weight = {layer: idx < weight_sizes[layer] for layer, idx in indices.items()}
+    weights = reader.read_sample(
+        step,
+        ("params", "weight"),
+        {layer: idx[in_weight[layer]] for layer, idx in indices.items()},
+    )
+    biases = reader.read_sample(
+        step,
+        ("params", "bias"),
+        {
+            layer: idx[~in_weight[layer]] - weight_sizes[layer]
+            for layer, idx in indices.items()
+            if not in_weight[layer].all()
+        },
+    )
+    sample = {}
+    for layer, idx in indices.items():
+        sample[layer] = np.empty(len(idx), dtype=weights[layer].dtype)
+        sample[layer][in_weight[layer]] = weights[layer]
+        if layer in biases:
+            sample[layer][~in_weight[layer]] = biases[layer]
+    return sample
+
+
+def network_kernel(model, reader, steps, **kwargs):
+    # parameters cached per layer and step: all of them, or a random subset
+    # drawn once and gathered at every step. Quantiles and histograms of all
+    # parameters summarise their distribution in constant size instead, and
+    # only those are cached if requested without a subset. Full tensors are
+    # only read if something is computed from all parameters.
     subset = kwargs.get("subset", None)
     seed = kwargs.get("seed", 0)
-    layers = [layer for layer in utils.get_layers(model)]
+    quantiles = kwargs.get("quantiles", None)
+    bins = kwargs.get("bins", None)
+    layers = utils.get_layers(model)
+    cache_empirical = subset is not None or (quantiles is None and bins is None)
+    read_all = subset is None or quantiles is not None or bins is not None
+
     empirical = {layer: {} for layer in layers}
+    quantile_sketch = {layer: {} for layer in layers}
+    histogram = {layer: {} for layer in layers}
+    bin_edges = {layer: {} for layer in layers}
+    indices = None
     for i in range(len(steps)):
         step = steps[i]
-        weights = utils.load_features(
-            steps=[str(step)],
-            feats_dir=feats_dir,
-            model=model,
-            suffix="weight",
-            group="params",
-        )
-        biases = utils.load_features(
-            steps=[str(step)],
-            feats_dir=feats_dir,
-            model=model,
-            suffix="bias",
-            group="params",
-        )
-        np.random.seed(seed)
+        if subset is not None:
+            if indices is None:
+                weight_shapes = reader.shapes(step, ("params", "weight"), layers)
+                bias_shapes = reader.shapes(step, ("params", "bias"), layers)
+                weight_sizes = {
+                    layer: int(np.prod(shape)) for layer, shape in weight_shapes.items()
+                }
+                sizes = {
+                    layer: weight_sizes[layer]
+                    + (
+                        0
+                        if bias_shapes[layer] is None
+                        else int(np.prod(bias_shapes[layer]))
+                    )
+                    for layer in layers
+                }
+                indices = sample_indices(sizes, subset, seed)
+            sample = gather(reader, step, indices, weight_sizes)
+            for layer in layers:
+                empirical[layer][step] = sample[layer]
+        if not read_all:
+            yield
+            continue
+
+        feats = reader.read(step, utils.PARAMS)
+        weights = feats["params", "weight"]
+        biases = feats["params", "bias"]
         for layer in layers:
-            Wl_t = weights[layer][f"step_{step}"]
-            bl_t = biases[layer][f"step_{step}"]
-            all_weights = np.concatenate((Wl_t.reshape(-1), bl_t.reshape(-1)))
-            if subset is None:
-                random_subset_idx = np.arange(len(all_weights))
-            else:
-                random_subset_idx = np.random.choice(
-                    len(all_weights), size=min(subset, len(all_weights)), replace=False
+            Wl_t = weights[layer]
+            bl_t = biases[layer]
+            all_weights = None
+            if subset is None or quantiles is not None:
+                all_weights = Wl_t.reshape(-1)
+                if bl_t is not None:
+                    all_weights = np.concatenate((all_weights, bl_t.reshape(-1)))
+            if cache_empirical and subset is None:
+                empirical[layer][step] = all_weights
+            if quantiles is not None:
+                quantile_sketch[layer][step] = np.quantile(
+                    all_weights, np.linspace(0, 1, quantiles)
                 )
-            empirical[layer][step] = all_weights[random_subset_idx]
+            if bins is not None:
+                params = [Wl_t] if bl_t is None else [Wl_t, bl_t]
+                extent = (min(p.min() for p in params), max(p.max() for p in params))
+                counts, edges = np.histogram(Wl_t, bins=bins, range=extent)
+                if bl_t is not None:
+                    counts += np.histogram(bl_t, bins=bins, range=extent)[0]
+                histogram[layer][step] = counts
+                bin_edges[layer][step] = edges
+        yield
 
-    return {"empirical": empirical}
+    network = {"empirical": empirical} if cache_empirical else {}
+    if quantiles is not None:
+        network["quantiles"] = quantile_sketch
+    if bins is not None:
+        network["histogram"] = histogram
+        network["bin_edges"] = bin_edges
+    return network
 
 
-def performance(model, feats_dir, steps, **kwargs):
+def performance_kernel(model, reader, steps, **kwargs):
     metrics = {}
-    for i in tqdm(range(len(steps))):
+    for i in range(len(steps)):
         step = steps[i]
-        feats_path = f"{feats_dir}/step{step}.h5"
-        if os.path.isfile(feats_path):
-            feature_dict = utils.get_features(
-                feats_path=feats_path,
-                group="metrics",
-                keys=["accuracy1", "accuracy5", "train_loss", "test_loss"],
+        if reader.exists(step):
+            feature_dict = reader.read_group(
+                step, "metrics", ["accuracy1", "accuracy5", "train_loss", "test_loss"],
             )
             metrics[step] = feature_dict
+        yield
     return {"performance": metrics}
 
 
+metric_kernels = {
+    "scale": scale_kernel,
+    "rescale": rescale_kernel,
+    "translation": translation_kernel,
+    "scale-momentum": scale_momentum_kernel,
+    "rescale-momentum": rescale_momentum_kernel,
+    "translation-momentum": translation_momentum_kernel,
+    "gradient": gradient_kernel,
+    "performance": performance_kernel,
+    "network": network_kernel,
+    "phase": phase_kernel,
+    "weights_grads": weights_grads_kernel,
+}
+
+# metrics computed from full weights and gradients, which a reduced online
+# store (see metrics.online) does not hold
+FULL_TENSOR_METRICS = ["network", "weights_grads"]
+
 metric_fns = {
-    "scale": scale,
-    "rescale": rescale,
-    "translation": translation,
-    "scale-momentum": scale_momentum,
-    "rescale-momentum": rescale_momentum,
-    "translation-momentum": translation_momentum,
-    "gradient": gradient,
-    "performance": performance,
-    "network": network,
-    "phase": phase,
-    "weights_grads": weights_grads,
+    metric: planner.metric_fn(kernel) for metric, kernel in metric_kernels.items()
 }
+
+
+def compute_metrics(model, feats_dir, steps, metrics, **kwargs):
+    """
+    Computes several metrics of metric_kernels in a single pass over the
+    extracted features and returns {metric: result}
+    """
+    kernels = [metric_kernels[metric] for metric in metrics]
+    results = planner.run(model, feats_dir, steps, kernels, **kwargs)
+    return dict(zip(metrics, results))
@@ -0,0 +1,105 @@
+import numpy as np
+import torch
+from metrics import store
+
+# Per-neuron reductions of the weights and optimizer buffers used by the scale,
+# rescale, translation, phase and gradient metrics (see
+# metrics.helper.reduce_layer)
+PARAM_REDUCTIONS = ["in_sq", "out_sq", "out_bias"]
+BUFFER_REDUCTIONS = ["in", "out"]
+BUFFERS = [
+    "integral_buffer",
+    "integral_buffer_1",
+    "integral_buffer_2",
+    "grad_norm_buffer",
+]
+METRICS = ["train_loss", "test_loss", "accuracy1", "accuracy5"]
+
+
+def reduce_layer(W, b, reduction):
+    """
+    Torch counterpart of metrics.helper.reduce_layer, computed in float64 on
+    the device holding the layer
+    """
+    W = W.detach().double()
+    b = None if b is None else b.detach().double()
+    in_dims = tuple(range(1, W.dim()))
+    out_dims = (0,) + tuple(range(2, W.dim()))
+    if reduction == "in":
+        out = W.sum(in_dims)
+        return out if b is None else out + b
+    if reduction == "out":
+        return W.sum(out_dims)
+    if reduction == "in_sq":
+        out = (W ** 2).sum(in_dims)
+        return out if b is None else out + b ** 2
+    if reduction == "out_sq":
+        return (W ** 2).sum(out_dims)
+    if reduction == "out_bias":
+        return torch.cat([W.sum(out_dims), b.sum().view(1)])
+    raise ValueError(f"Unknown reduction: {reduction}")
+
+
+class OnlineMetrics:
+    """
+    Computes the per-neuron quantities of the reduction based metrics during
+    training and appends them to a reduced FeatureStore at
+    {save_path}/online.h5, which cache.py reads in place of extracted features.
+
+    Inputs
+        save_path (str): experiment directory
+        model (nn.Module): model being trained
+        optimizer (Optimizer): optimizer holding the integral buffers, if any
+    """
+
+    def __init__(self, save_path, model, optimizer):
+        self.path = f"{save_path}/{store.ONLINE_FILENAME}"
+        self.optimizer = optimizer
+        params = dict(model.named_parameters())
+        self.layers = []
+        for name, param in params.items():
+            if name.endswith(".weight") and param.dim() > 1:
+                prefix = name[: -len(".weight")]
+                self.layers.append((prefix, param, params.get(f"{prefix}.bias")))
+
+    @torch.no_grad()
+    def update(self, step, metric_dict={}):
+        """
+        Appends the reductions of the current weights and buffers at step,
+        along with any evaluation metrics in metric_dict
+        """
+        feats = {"params": {}, "buffers": {}}
+        for prefix, W, b in self.layers:
+            for reduction in PARAM_REDUCTIONS:
+                if reduction == "out_bias" and b is None:
+                    continue
+                feats["params"][f"{prefix}.{reduction}"] = reduce_layer(W, b, reduction)
+
+            W_buffers = self.optimizer.state[W].get("buffers", {})
+            b_buffers = {} if b is None else self.optimizer.state[b].get("buffers", {})
+            for buffer in BUFFERS:
+                for reduction in BUFFER_REDUCTIONS:
+                    key = f"{prefix}.{buffer}.{reduction}"
+                    if buffer in W_buffers:
+                        feats["buffers"][key] = reduce_layer(
+                            W_buffers[buffer], b_buffers.get(buffer), reduction
+                        )
+                    elif f"{buffer}.{reduction}" in W_buffers:
+                        # buffers already reduced by the optimizer
+                        value = W_buffers[f"{buffer}.{reduction}"].double()
+                        if reduction == "in" and f"{buffer}.in" in b_buffers:
+                            value = value + b_buffers[f"{buffer}.in"]
+                        feats["buffers"][key] = value
+
+        for group in ["params", "buffers"]:
+            feats[group] = {
+                key: value.cpu().numpy() for key, value in feats[group].items()
+            }
+        metrics = [m for m in METRICS if m in metric_dict]
+        if len(metrics) > 0:
+            feats["metrics"] = {
+                m: np.array([metric_dict[m]], dtype=np.float64) for m in metrics
+            }
+
+        with store.FeatureStore(self.path, "a", reduced=True) as online_store:
+            online_store.write(step, feats)
@@ -1,65 +1,39 @@
-from tqdm import tqdm
 import metrics.helper as utils
+import metrics.planner as planner
 import numpy as np
 
 
-def compute_pos_vel(step, layers, load_kwargs, position, velocity, **kwargs):
+def compute_pos_vel(step, layers, feats, position, velocity, **kwargs):
     lr = kwargs.get("lr")
     wd = kwargs.get("wd")
 
-    weights = utils.load_features(
-            steps=[str(step)],
-            suffix="weight",
-            group="params",
-            **load_kwargs,
-        )
-    biases = utils.load_features(
-            steps=[str(step)],
-            suffix="bias",
-            group="params",
-            **load_kwargs,
-        )
-
-    weight_buffers = utils.load_features(
-            steps=[str(step)],
-            suffix="weight.grad_norm_buffer",
-            group="buffers",
-            **load_kwargs,
-        )
-    bias_buffers = utils.load_features(
-            steps=[str(step)],
-            suffix="bias.grad_norm_buffer",
-            group="buffers",
-            **load_kwargs,
-        )
+    in_sq = feats["params", "in_sq"]
+    buffers = feats["buffers", "grad_norm_buffer.in"]
 
     for layer in layers:
-        Wl_t = weights[layer][f"step_{step}"]
-        bl_t = biases[layer][f"step_{step}"]
-        position[layer][step] = utils.in_synapses(Wl_t ** 2, bl_t ** 2)
-
-        g_Wl_t = weight_buffers[layer][f"step_{step}"]
-        g_bl_t = bias_buffers[layer][f"step_{step}"]
+        position[layer][step] = in_sq[layer]
         # -2lambda |\theta|^2 + \eta(|g|^2 - \lambda^2|\theta|^2)
-        velocity[layer][step] = lr*utils.in_synapses(g_Wl_t, g_bl_t)
+        velocity[layer][step] = lr*buffers[layer]
         velocity[layer][step] -= (2*wd + lr*wd**2)*position[layer][step]
 
 
-def phase(model, feats_dir, steps, **kwargs):
+def phase_kernel(model, reader, steps, **kwargs):
     lr = kwargs.get("lr")
     wd = kwargs.get("wd")
 
-    layers = [layer for layer in utils.get_layers(model) if "conv" in layer]
-
-    load_kwargs = {
-        "model": model,
-        "feats_dir": feats_dir,
-    }
+    layers = utils.get_layers(model, "conv")
 
     position = {layer: {} for layer in layers}
     velocity = {layer: {} for layer in layers}
-    for i in tqdm(range(1, len(steps))):
+    for i in range(len(steps)):
         step = steps[i]
-        compute_pos_vel(step, layers, load_kwargs, position, velocity, **kwargs)
+        if i > 0:
+            keys = [("params", "in_sq"), ("buffers", "grad_norm_buffer.in")]
+            feats = reader.read_reduced(step, keys, layers)
+            compute_pos_vel(step, layers, feats, position, velocity, **kwargs)
+        yield
 
     return {"position": position, "velocity": velocity}
+
+
+phase = planner.metric_fn(phase_kernel)
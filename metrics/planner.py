@@ -0,0 +1,61 @@
+from tqdm import tqdm
+import metrics.helper as utils
+
+# A metric kernel is a generator function kernel(model, reader, steps, **kwargs),
+# where model is the layer map of the model (see metrics.layers). It reads the
+# features of steps[i] from reader, yields once it is done with that step and
+# returns the metric once all steps have been processed. Running several
+# kernels in lockstep over a shared FeatureReader, which keeps the features of
+# the current step in memory, reads every feature file only once.
+
+
+def run(model, feats_dir, steps, kernels, **kwargs):
+    """
+    Computes the metrics of a list of kernels in a single pass over steps and
+    returns their results, in the same order. A kernel raising an exception
+    is stopped without affecting the others and its result is the exception.
+    """
+    reader = utils.FeatureReader(feats_dir, model)
+    running = [kernel(model, reader, steps, **kwargs) for kernel in kernels]
+    results = [None] * len(kernels)
+    try:
+        for _ in tqdm(range(len(steps))):
+            for i, generator in enumerate(running):
+                if generator is not None:
+                    running[i], results[i] = _advance(generator, results[i])
+        for i, generator in enumerate(running):
+            while generator is not None:
+                generator, results[i] = _advance(generator, results[i])
+    finally:
+        reader.close()
+    return results
+
+
+def metric_fn(kernel):
+    """
+    Returns the metric function metric(model, feats_dir, steps, **kwargs) that
+    runs a single kernel
+    """
+
+    def metric(model, feats_dir, steps, **kwargs):
+        result = run(model, feats_dir, steps, [kernel], **kwargs)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    metric.__name__ = kernel.__name__.replace("_kernel", "")
+    return metric
+
+
+def _advance(generator, result):
+    """
+    Runs a kernel until its next step, returning (None, metric) once it is done
+    or (None, exception) if it failed
+    """
+    try:
+        next(generator)
+        return generator, result
+    except StopIteration as stop:
+        return None, stop.value
+    except Exception as error:
+        return None, error
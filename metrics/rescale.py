@@ -1,283 +1,161 @@
-from tqdm import tqdm
 import metrics.helper as utils
+import metrics.planner as planner
+import metrics.theory as theory
 import numpy as np
 
+PARAMS = [("params", "in_sq"), ("params", "out_sq")]
+SGD_BUFFERS = [("buffers", "integral_buffer.in"), ("buffers", "integral_buffer.out")]
+MOM_BUFFERS = [
+    ("buffers", "integral_buffer_1.in"),
+    ("buffers", "integral_buffer_1.out"),
+    ("buffers", "integral_buffer_2.in"),
+    ("buffers", "integral_buffer_2.out"),
+]
+
+
+def compute_empirical(step, pairs, feats, empirical):
+    in_sq = feats["params", "in_sq"]
+    out_sq = feats["params", "out_sq"]
+    for layer_in, layer in pairs:
+        empirical[layer][step] = out_sq[layer] - in_sq[layer_in]
+
+
+def buffer_differences(pairs, feats, buffer):
+    """
+    Returns {layer: out sum of the buffer at layer minus in sum at the layer
+    before} for (layer_in, layer) pairs, the buffer term of the rescale
+    dynamics
+    """
+    buffers_in = feats["buffers", f"{buffer}.in"]
+    buffers_out = feats["buffers", f"{buffer}.out"]
+    return {
+        layer: buffers_out[layer] - buffers_in[layer_in]
+        for layer_in, layer in pairs
+    }
 
-def compute_empirical(step, layers, load_kwargs, empirical):
-    weights = utils.load_features(steps=[str(step)], suffix="weight", **load_kwargs,)
-    biases = utils.load_features(steps=[str(step)], suffix="bias", **load_kwargs,)
-    W_in = weights[layers[0]][f"step_{step}"] ** 2
-    b_in = biases[layers[0]][f"step_{step}"] ** 2
-    for layer in layers[1:]:
-        W_out = weights[layer][f"step_{step}"] ** 2
-        b_out = biases[layer][f"step_{step}"] ** 2
-        empirical[layer][step] = utils.out_synapses(W_out) - utils.in_synapses(
-            W_in, b_in
-        )
-        W_in = W_out
-        b_in = b_out
 
+def compute_theoretical(steps, pairs, buffers, lr, wd, in_sq_0, out_sq_0):
+    t = lr * np.asarray(steps)
+    decay = theory.sgd_decay(t, wd, 2)[:, None]
 
-def compute_theoretical(
-    step, layers, load_kwargs, theoretical, i, step_0, lr, wd, W_0, b_0,
-):
-    t = lr * step
-    if i > 0:
-        weight_buffers = utils.load_features(
-            steps=[str(step)], suffix="weight.integral_buffer", **load_kwargs,
-        )
-        bias_buffers = utils.load_features(
-            steps=[str(step)], suffix="bias.integral_buffer", **load_kwargs,
-        )
-
-    W_in = np.exp(-2 * wd * t) * W_0[layers[0]][f"step_{step_0}"] ** 2
-    b_in = np.exp(-2 * wd * t) * b_0[layers[0]][f"step_{step_0}"] ** 2
-    if i > 0:
-        g_W = weight_buffers[layers[0]][f"step_{step}"]
-        g_b = bias_buffers[layers[0]][f"step_{step}"]
-        W_in += (lr ** 2) * np.exp(-2 * wd * t) * g_W
-        b_in += (lr ** 2) * np.exp(-2 * wd * t) * g_b
-    for layer in layers[1:]:
-        W_out = np.exp(-2 * wd * t) * W_0[layer][f"step_{step_0}"] ** 2
-        b_out = np.exp(-2 * wd * t) * b_0[layer][f"step_{step_0}"] ** 2
-        if i > 0:
-            g_W = weight_buffers[layer][f"step_{step}"]
-            g_b = bias_buffers[layer][f"step_{step}"]
-            W_out += (lr ** 2) * np.exp(-2 * wd * t) * g_W
-            b_out += (lr ** 2) * np.exp(-2 * wd * t) * g_b
-        theoretical[layer][step] = utils.out_synapses(W_out) - utils.in_synapses(
-            W_in, b_in
-        )
-        W_in = W_out
-        b_in = b_out
+    theoretical = {}
+    for layer_in, layer in pairs:
+        rescale_0 = out_sq_0[layer] - in_sq_0[layer_in]
+        g = theory.stack(rescale_0, buffers[layer])
+        values = decay * rescale_0 + (lr ** 2) * decay * g
+        theoretical[layer] = theory.unstack(steps, values)
+    return theoretical
 
 
 def compute_theoretical_momentum(
-    step,
-    layers,
-    load_kwargs,
-    theoretical,
-    i,
-    step_0,
+    steps,
+    pairs,
+    buffers,
     lr,
     wd,
     momentum,
     dampening,
     omega,
     gamma,
-    W_0,
-    b_0,
+    in_sq_0,
+    out_sq_0,
 ):
-    t = lr * (1 - dampening) * step
-    if i > 0:
-        weight_buffers_1 = utils.load_features(
-            steps=[str(step)], suffix="weight.integral_buffer_1", **load_kwargs,
-        )
-        bias_buffers_1 = utils.load_features(
-            steps=[str(step)], suffix="bias.integral_buffer_1", **load_kwargs,
-        )
-        weight_buffers_2 = utils.load_features(
-            steps=[str(step)], suffix="weight.integral_buffer_2", **load_kwargs,
-        )
-        bias_buffers_2 = utils.load_features(
-            steps=[str(step)], suffix="bias.integral_buffer_2", **load_kwargs,
-        )
-
-    W_in = W_0[layers[0]][f"step_{step_0}"] ** 2
-    b_in = b_0[layers[0]][f"step_{step_0}"] ** 2
-    if i > 0:
-        g_W_in_1 = weight_buffers_1[layers[0]][f"step_{step}"]
-        g_b_in_1 = bias_buffers_1[layers[0]][f"step_{step}"]
-        g_W_in_2 = weight_buffers_2[layers[0]][f"step_{step}"]
-        g_b_in_2 = bias_buffers_2[layers[0]][f"step_{step}"]
-
-    for layer in layers[1:]:
-        W_out = W_0[layer][f"step_{step_0}"] ** 2
-        b_out = b_0[layer][f"step_{step_0}"] ** 2
-
-        # Homogenous solution
-        if gamma < omega:
-            cos = np.cos(np.sqrt(omega ** 2 - gamma ** 2) * t)
-            sin = np.sin(np.sqrt(omega ** 2 - gamma ** 2) * t)
-            scale = np.exp(-gamma * t) * (
-                cos + gamma / np.sqrt(omega ** 2 - gamma ** 2) * sin
-            )
-        elif gamma == omega:
-            scale = np.exp(-gamma * t) * (1 + gamma * t)
-        else:
-            alpha_p = -gamma + np.sqrt(gamma ** 2 - omega ** 2)
-            alpha_m = -gamma - np.sqrt(gamma ** 2 - omega ** 2)
-            numer = alpha_p * np.exp(alpha_m * t) - alpha_m * np.exp(alpha_p * t)
-            denom = alpha_p - alpha_m
-            scale = numer / denom
-
-        theoretical[layer][step] = scale * (
-            utils.out_synapses(W_out, dtype=np.float128)
-            - utils.in_synapses(W_in, b_in, dtype=np.float128)
-        )
-        W_in = W_out
-        b_in = b_out
-
-        if i > 0:
-            g_W_out_1 = weight_buffers_1[layer][f"step_{step}"]
-            g_b_out_1 = bias_buffers_1[layer][f"step_{step}"]
-            g_W_out_2 = weight_buffers_2[layer][f"step_{step}"]
-            g_b_out_2 = bias_buffers_2[layer][f"step_{step}"]
-
-            # Inhomogenous solution
-            if gamma < omega:
-                sqrt = np.sqrt(omega ** 2 - gamma ** 2)
-                scale_1 = np.exp(-gamma * t) * np.sin(sqrt * t) / sqrt
-                scale_2 = -np.exp(-gamma * t) * np.cos(sqrt * t) / sqrt
-
-            elif gamma == omega:
-                scale_1 = np.exp(-gamma * t) * t
-                scale_2 = -np.exp(-gamma * t)
-
-            else:
-                sqrt = np.sqrt(gamma ** 2 - omega ** 2)
-                alpha_p = -gamma + sqrt
-                alpha_m = -gamma - sqrt
-                scale_1 = np.exp(alpha_p * t) / (alpha_p - alpha_m)
-                scale_2 = -np.exp(alpha_m * t) / (alpha_p - alpha_m)
-
-            scale = (lr * (1 - dampening)) * 2
-
-            if (
-                np.all(np.isfinite(g_W_out_1))
-                and np.all(np.isfinite(g_W_in_1))
-                and np.all(np.isfinite(g_b_in_1))
-            ):
-                theoretical[layer][step] += (
-                    scale
-                    * scale_1
-                    * (
-                        utils.out_synapses(g_W_out_1, dtype=np.float128)
-                        - utils.in_synapses(g_W_in_1, g_b_in_1, dtype=np.float128)
-                    )
-                )
-            if (
-                np.all(np.isfinite(g_W_out_2))
-                and np.all(np.isfinite(g_W_in_2))
-                and np.all(np.isfinite(g_b_in_2))
-            ):
-                theoretical[layer][step] += (
-                    scale
-                    * scale_2
-                    * (
-                        utils.out_synapses(g_W_out_2, dtype=np.float128)
-                        - utils.in_synapses(g_W_in_2, g_b_in_2, dtype=np.float128)
-                    )
-                )
-
-            g_W_in_1 = g_W_out_1
-            g_b_in_1 = g_b_out_1
-            g_W_in_2 = g_W_out_2
-            g_b_in_2 = g_b_out_2
-
-
-def rescale(model, feats_dir, steps, **kwargs):
+    t = lr * (1 - dampening) * np.asarray(steps)
+    # Homogenous solution
+    homogeneous = theory.momentum_homogeneous(t, gamma, omega)[:, None]
+    # Inhomogenous solution
+    scale_1, scale_2 = theory.momentum_inhomogeneous(t, gamma, omega)
+    scale = (lr * (1 - dampening)) * 2
+
+    theoretical = {}
+    for layer_in, layer in pairs:
+        rescale_0 = out_sq_0[layer] - in_sq_0[layer_in]
+        g_1 = theory.stack(rescale_0, buffers[layer, 1])
+        g_2 = theory.stack(rescale_0, buffers[layer, 2])
+        values = homogeneous * rescale_0
+        values += theory.masked(scale * scale_1, g_1)
+        values += theory.masked(scale * scale_2, g_2)
+        theoretical[layer] = theory.unstack(steps, values)
+    return theoretical
+
+
+def rescale_kernel(model, reader, steps, **kwargs):
     lr = kwargs.get("lr")
     wd = kwargs.get("wd")
 
-    layers = [layer for layer in utils.get_layers(model) if "conv" in layer]
-    W_0 = utils.load_features(
-        steps=[str(steps[0])],
-        feats_dir=feats_dir,
-        model=model,
-        suffix="weight",
-        group="params",
-    )
-    b_0 = utils.load_features(
-        steps=[str(steps[0])],
-        feats_dir=feats_dir,
-        model=model,
-        suffix="bias",
-        group="params",
-    )
+    layers = utils.get_layers(model, "conv")
+    pairs = utils.get_pairs(model, "conv")
+    init = reader.read_reduced(steps[0], PARAMS, layers)
 
-    load_kwargs = {
-        "model": model,
-        "feats_dir": feats_dir,
-    }
-    theory_kwargs = {
-        "lr": lr,
-        "wd": wd,
-        "W_0": W_0,
-        "b_0": b_0,
-        "step_0": steps[0],
-    }
-
-    theoretical = {layer: {} for layer in layers[1:]}
-    empirical = {layer: {} for layer in layers[1:]}
-    for i in tqdm(range(len(steps))):
+    empirical = {layer: {} for _, layer in pairs}
+    buffers = {layer: [] for _, layer in pairs}
+    for i in range(len(steps)):
         step = steps[i]
-        theory_kwargs["i"] = i
-        load_kwargs["group"] = "buffers"
-        compute_theoretical(step, layers, load_kwargs, theoretical, **theory_kwargs)
-        load_kwargs["group"] = "params"
-        compute_empirical(step, layers, load_kwargs, empirical)
-
+        keys = PARAMS + (SGD_BUFFERS if i > 0 else [])
+        feats = reader.read_reduced(step, keys, layers)
+        compute_empirical(step, pairs, feats, empirical)
+        if i > 0:
+            for layer, g in buffer_differences(
+                pairs, feats, "integral_buffer"
+            ).items():
+                buffers[layer].append(g)
+        yield
+
+    theoretical = compute_theoretical(
+        steps,
+        pairs,
+        buffers,
+        lr,
+        wd,
+        init["params", "in_sq"],
+        init["params", "out_sq"],
+    )
     return {"empirical": empirical, "theoretical": theoretical}
 
 
-def rescale_momentum(model, feats_dir, steps, **kwargs):
-    lr = kwargs.get("lr")
-    wd = kwargs.get("wd")
-    momentum = kwargs.get("momentum")
-    dampening = kwargs.get("dampening")
-
-    lr = np.array(lr, dtype=np.float128)
-    wd = np.array(wd, dtype=np.float128)
-    momentum = np.array(momentum, dtype=np.float128)
-    dampening = np.array(dampening, dtype=np.float128)
-
-    denom = lr * (1 - dampening) * (1 + momentum)
-    gamma = (1 - momentum) / denom
-    omega = np.sqrt(4 * wd / denom)
-
-    layers = [layer for layer in utils.get_layers(model) if "conv" in layer]
-    W_0 = utils.load_features(
-        steps=[str(steps[0])],
-        feats_dir=feats_dir,
-        model=model,
-        suffix="weight",
-        group="params",
-    )
-    b_0 = utils.load_features(
-        steps=[str(steps[0])],
-        feats_dir=feats_dir,
-        model=model,
-        suffix="bias",
-        group="params",
+def rescale_momentum_kernel(model, reader, steps, **kwargs):
+    lr, wd, momentum, dampening, gamma, omega = theory.momentum_constants(
+        kwargs.get("lr"),
+        kwargs.get("wd"),
+        kwargs.get("momentum"),
+        kwargs.get("dampening"),
+        order=2,
     )
 
-    load_kwargs = {
-        "model": model,
-        "feats_dir": feats_dir,
-    }
-    theory_kwargs = {
-        "lr": lr,
-        "wd": wd,
-        "momentum": momentum,
-        "dampening": dampening,
-        "gamma": gamma,
-        "omega": omega,
-        "W_0": W_0,
-        "b_0": b_0,
-        "step_0": steps[0],
-    }
+    layers = utils.get_layers(model, "conv")
+    pairs = utils.get_pairs(model, "conv")
+    init = reader.read_reduced(steps[0], PARAMS, layers, precise=True)
 
-    theoretical = {layer: {} for layer in layers[1:]}
-    empirical = {layer: {} for layer in layers[1:]}
-    for i in tqdm(range(len(steps))):
+    empirical = {layer: {} for _, layer in pairs}
+    buffers = {(layer, j): [] for _, layer in pairs for j in [1, 2]}
+    for i in range(len(steps)):
         step = steps[i]
-        theory_kwargs["i"] = i
-        load_kwargs["group"] = "buffers"
-        compute_theoretical_momentum(
-            step, layers, load_kwargs, theoretical, **theory_kwargs
-        )
-        load_kwargs["group"] = "params"
-        compute_empirical(step, layers, load_kwargs, empirical)
-
+        feats = reader.read_reduced(step, PARAMS, layers)
+        compute_empirical(step, pairs, feats, empirical)
+        if i > 0:
+            feats = reader.read_reduced(step, MOM_BUFFERS, layers, precise=True)
+            for j in [1, 2]:
+                for layer, g in buffer_differences(
+                    pairs, feats, f"integral_buffer_{j}"
+                ).items():
+                    buffers[layer, j].append(g)
+        yield
+
+    theoretical = compute_theoretical_momentum(
+        steps,
+        pairs,
+        buffers,
+        lr,
+        wd,
+        momentum,
+        dampening,
+        omega,
+        gamma,
+        init["params", "in_sq"],
+        init["params", "out_sq"],
+    )
     return {"empirical": empirical, "theoretical": theoretical}
+
+
+rescale = planner.metric_fn(rescale_kernel)
+rescale_momentum = planner.metric_fn(rescale_momentum_kernel)
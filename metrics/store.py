@@ -0,0 +1,463 @@
+import json
+import os
+import numpy as np
+import h5py
+from collections.abc import Mapping
+
+# Name of the consolidated store inside an experiment's feats directory
+STORE_FILENAME = "store.h5"
+# Name of the store of per-neuron reductions written during training, which
+# sits next to the feats directory (see metrics.online)
+ONLINE_FILENAME = "online.h5"
+
+# Target size of a single chunk: small per-step arrays get many steps per
+# chunk so that consecutive steps are read from the same chunk, large arrays
+# get one step per chunk so that reading a single step stays cheap
+CHUNK_BYTES = 1 << 20
+MAX_CHUNK_STEPS = 256
+
+# Chunk cache for reading, large enough to hold a few chunks of the largest
+# layers so that sequential per-step reads of multi-step chunks hit the cache
+CACHE_BYTES = 64 << 20
+
+
+def store_path(feats_dir):
+    return f"{feats_dir}/{STORE_FILENAME}"
+
+
+def online_path(feats_dir):
+    exp_path = os.path.dirname(os.path.normpath(feats_dir))
+    return f"{exp_path}/{ONLINE_FILENAME}"
+
+
+class FeatureStore:
+    """
+    Consolidated per-experiment feature store
+
+    Holds one chunked dataset per (group, key), e.g. ("params",
+    "features.0.weight"), with the step as the leading axis, and a "steps"
+    dataset mapping rows to training steps. Rows are appended in the order
+    steps are written; quantities missing at a step (e.g. optimizer buffers at
+    step 0) are filled with NaN. A store marked as reduced holds per-neuron
+    reductions (see metrics.helper.reduce_layer) instead of full tensors.
+
+    Inputs
+        path (str): location of the HDF5 file
+        mode (str): "r" to read, "a" to read and write incrementally
+        reduced (bool): marks a newly created store as holding reductions
+    """
+
+    def __init__(self, path, mode="r", reduced=False):
+        self.path = path
+        self.mode = mode
+        self.file = h5py.File(path, mode, rdcc_nbytes=CACHE_BYTES)
+        if "steps" not in self.file:
+            self.file.create_dataset(
+                "steps", shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(1024,)
+            )
+            self.file.attrs["reduced"] = reduced
+        self._index = {int(s): row for row, s in enumerate(self.file["steps"][:])}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def reduced(self):
+        return bool(self.file.attrs.get("reduced", False))
+
+    @property
+    def steps(self):
+        return sorted(self._index.keys())
+
+    def __contains__(self, step):
+        return int(step) in self._index
+
+    def row(self, step):
+        assert step in self, f"step {step} is not in {self.path}"
+        return self._index[int(step)]
+
+    def keys(self, group):
+        if group not in self.file:
+            return []
+        return list(self.file[group].keys())
+
+    def write(self, step, feats):
+        """
+        Writes the features of a single step, overwriting the step's row if it
+        is already in the store
+
+        Inputs
+            step (int): training step of the features
+            feats (dict): {group: {key: array}} as produced by extract.py
+        """
+        new = step not in self
+        row = len(self._index) if new else self.row(step)
+        num_rows = len(self._index) + new
+        written = set(
+            f"{group}/{key}" for group, arrays in feats.items() for key in arrays
+        )
+
+        # keep every dataset aligned with the step index. Rows left by a write
+        # that was interrupted before its step was indexed are reset, so that
+        # quantities missing at this step read as NaN
+        def _resize(name, obj):
+            if not isinstance(obj, h5py.Dataset) or name == "steps":
+                return
+            if obj.shape[0] < num_rows:
+                obj.resize(num_rows, axis=0)
+            elif new and name not in written:
+                obj[row] = obj.fillvalue
+
+        self.file.visititems(_resize)
+
+        for group, arrays in feats.items():
+            for key, value in arrays.items():
+                value = np.asarray(value)
+                name = f"{group}/{key}"
+                if name not in self.file:
+                    self._create(name, value, num_rows)
+                self.file[name][row] = value
+        self.file.flush()
+
+        # the step is indexed once all of its data is written, so that a
+        # crash mid-write does not leave it marked as extracted
+        if new:
+            self.file["steps"].resize((num_rows,))
+            self.file["steps"][row] = step
+            self._index[int(step)] = row
+            self.file.flush()
+
+    def _create(self, name, value, num_rows):
+        row_bytes = max(value.nbytes, 1)
+        chunk_steps = int(np.clip(CHUNK_BYTES // row_bytes, 1, MAX_CHUNK_STEPS))
+        fillvalue = np.nan if np.issubdtype(value.dtype, np.floating) else 0
+        self.file.create_dataset(
+            name,
+            shape=(num_rows,) + value.shape,
+            maxshape=(None,) + value.shape,
+            chunks=(chunk_steps,) + value.shape,
+            dtype=value.dtype,
+            fillvalue=fillvalue,
+        )
+
+    def read(self, step, group, keys):
+        """
+        Returns a dict of {key: array} for the given step
+        """
+        row = self.row(step)
+        return {key: self.file[group][key][row] for key in keys}
+
+    def shape(self, group, key):
+        """
+        Returns the shape of key at a single step, without reading it
+        """
+        return self.file[group][key].shape[1:]
+
+    def read_sample(self, step, group, key, indices):
+        """
+        Returns the elements at the flat indices of key at the given step,
+        reading only those elements
+        """
+        dataset = self.file[group][key]
+        coords = np.unravel_index(indices, dataset.shape[1:])
+        row = np.full(len(indices), self.row(step))
+        return read_points(dataset, np.stack((row,) + coords, axis=1))
+
+
+def read_points(dataset, coords):
+    """
+    Returns the elements of an HDF5 dataset at coords, an (N, rank) array of
+    element coordinates, reading only those elements. h5py's fancy indexing
+    selects whole hyperslabs along a single axis instead.
+    """
+    out = np.empty(len(coords), dtype=dataset.dtype)
+    if len(coords) == 0:
+        return out
+    space = dataset.id.get_space()
+    space.select_elements(np.asarray(coords, dtype=np.uint64))
+    dataset.id.read(h5py.h5s.create_simple((len(coords),)), space, out)
+    return out
+
+
+# Caches of computed metrics (see cache.py) are stored column-wise: a shared
+# "steps" dataset holds the steps the cache covers, and every {step: value}
+# dict of a metric, e.g. metrics["empirical"]["conv1"], is stored as a single
+# (steps x ...) dataset with a row per step, so that a layer is read in one
+# contiguous read without touching the other layers. Rows of steps missing
+# from a dict are marked in a "{name}.rows" mask next to it. {step: dict}
+# dicts (e.g. performance) are stored as a group of columns, one per key, and
+# other values as they are. Strings starting with MEMMAP_TAG are filenames of
+# memory-mapped arrays relative to the cache directory (see
+# metrics.helper.save_cache).
+CACHE_FORMAT = "columns"
+MEMMAP_TAG = "memmap:"
+
+
+def is_cache(path):
+    """
+    Returns whether path holds a column-wise cache, as opposed to a cache
+    saved with deepdish before
+    """
+    with h5py.File(path, "r") as f:
+        return f.attrs.get("format") == CACHE_FORMAT
+
+
+def cache_options(path):
+    """
+    Returns the options a cache was computed with (see write_cache), {} if
+    none were stored
+    """
+    with h5py.File(path, "r") as f:
+        return json.loads(f.attrs.get("options", "{}"))
+
+
+def write_cache(path, steps, metrics, options=None):
+    """
+    Writes the (steps, metrics) of a cache column-wise, to a temporary file
+    renamed once complete so that readers of the previous cache are not
+    affected. options, a JSON serialisable dict of the options the metrics
+    were computed with, are stored in the attributes of the file
+    """
+    steps = [int(step) for step in steps]
+    index = {step: row for row, step in enumerate(steps)}
+    with h5py.File(f"{path}.tmp", "w") as f:
+        f.attrs["format"] = CACHE_FORMAT
+        f.attrs["options"] = json.dumps(options or {}, sort_keys=True)
+        f.create_dataset("steps", data=np.array(steps, dtype=np.int64))
+        _write_group(f.create_group("metrics", track_order=True), metrics, index)
+    os.replace(f"{path}.tmp", path)
+
+
+def open_cache(path):
+    """
+    Returns the (steps, metrics) of a column-wise cache, where metrics is a
+    read-only mapping that reads a column from the file when it is first
+    accessed. The file stays open until metrics is closed, with
+    metrics.close() or by using it as a context manager
+    """
+    f = h5py.File(path, "r")
+    steps = f["steps"][:]
+    return [int(step) for step in steps], CacheGroup(f["metrics"], steps)
+
+
+def _is_step_dict(value):
+    return len(value) > 0 and all(
+        isinstance(key, (int, np.integer)) and not isinstance(key, bool)
+        for key in value
+    )
+
+
+def _write_group(group, tree, index):
+    for key, value in tree.items():
+        if isinstance(value, dict) and _is_step_dict(value):
+            _write_column(group, str(key), value, index)
+        elif isinstance(value, dict):
+            _write_group(group.create_group(str(key), track_order=True), value, index)
+        else:
+            _write_value(group, str(key), value)
+        if not isinstance(key, str):
+            # e.g. integer keys of dicts that are not columns
+            group[str(key)].attrs["key"] = key
+
+
+def _write_column(group, name, column, index):
+    steps = sorted(column.keys())
+    values = [column[step] for step in steps]
+    if all(isinstance(value, dict) for value in values):
+        records = group.create_group(name, track_order=True)
+        records.attrs["kind"] = "records"
+        keys = []
+        for value in values:
+            keys += [key for key in value if key not in keys]
+        for key in keys:
+            field = {step: column[step][key] for step in steps if key in column[step]}
+            _write_column(records, str(key), field, index)
+        return
+
+    arrays = [np.asarray(value) for value in values]
+    if (
+        any(step not in index for step in steps)
+        or any(array.dtype.kind not in "biuf" for array in arrays)
+        or any(array.shape != arrays[0].shape for array in arrays)
+    ):
+        # not a column, stored as a group with a dataset per step
+        ragged = group.create_group(name, track_order=True)
+        _write_group(ragged, column, index)
+        return
+
+    dtype = np.result_type(*arrays)
+    data = np.zeros((len(index),) + arrays[0].shape, dtype=dtype)
+    if dtype.kind == "f":
+        data[:] = np.nan
+    rows = np.array([index[step] for step in steps], dtype=np.int64)
+    data[rows] = arrays
+    group.create_dataset(name, data=data).attrs["kind"] = "column"
+    if len(rows) < len(index):
+        mask = np.zeros(len(index), dtype=bool)
+        mask[rows] = True
+        group.create_dataset(f"{name}.rows", data=mask)
+
+
+def _write_value(group, name, value):
+    if value is None:
+        group.create_dataset(name, data=h5py.Empty("f")).attrs["kind"] = "none"
+    elif isinstance(value, str):
+        group.create_dataset(name, data=value).attrs["kind"] = "str"
+    elif isinstance(value, (list, tuple)):
+        dataset = group.create_dataset(name, data=np.asarray(value))
+        dataset.attrs["kind"] = type(value).__name__
+    else:
+        group.create_dataset(name, data=np.asarray(value))
+
+
+class CacheGroup(Mapping):
+    """
+    Read-only mapping over a group of a column-wise cache, whose values are
+    nested CacheGroups, Columns for {step: value} dicts, Records for
+    {step: dict} dicts, or values read when accessed
+
+    Inputs
+        group (h5py.Group): group of the cache file
+        steps (np.ndarray): steps of the cache, indexing the rows of columns
+    """
+
+    def __init__(self, group, steps):
+        self.group = group
+        self.file = group.file
+        self.steps = steps
+        self._keys = {}
+        # columns keep their values once read
+        self._children = {}
+        for name, obj in group.items():
+            if name.endswith(".rows") and name[: -len(".rows")] in group:
+                continue
+            key = obj.attrs.get("key", name)
+            self._keys[key.item() if isinstance(key, np.generic) else key] = name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Closes the cache file, shared with every group, column and record of
+        the cache. Values already read stay valid
+        """
+        if self.file:
+            self.file.close()
+
+    def __getitem__(self, key):
+        if key not in self._children:
+            self._children[key] = self._read(key)
+        return self._children[key]
+
+    def _read(self, key):
+        obj = self.group[self._keys[key]]
+        kind = obj.attrs.get("kind")
+        if isinstance(obj, h5py.Group):
+            if kind == "records":
+                return Records(obj, self.steps)
+            return CacheGroup(obj, self.steps)
+        if kind == "column":
+            mask = None
+            if f"{obj.name}.rows" in self.group.file:
+                mask = self.group.file[f"{obj.name}.rows"][:]
+            return Column(obj, self.steps, mask)
+        if kind == "none":
+            return None
+        if kind == "str":
+            value = obj.asstr()[()]
+            if value.startswith(MEMMAP_TAG):
+                cache_dir = os.path.dirname(self.group.file.filename)
+                return np.load(f"{cache_dir}/{value[len(MEMMAP_TAG):]}", mmap_mode="r")
+            return value
+        if kind in ["list", "tuple"]:
+            return {"list": list, "tuple": tuple}[kind](obj[()].tolist())
+        return obj[()]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def load(self):
+        """
+        Returns the group read into nested dicts
+        """
+        return {
+            key: value.load() if hasattr(value, "load") else value
+            for key, value in self.items()
+        }
+
+
+class Column(Mapping):
+    """
+    Read-only {step: value} mapping over a column of a cache, read in a
+    single read when first accessed. steps and array give the steps and the
+    (steps x ...) array of values directly
+    """
+
+    def __init__(self, dataset, steps, mask=None):
+        self.dataset = dataset
+        self.mask = mask
+        self.steps = steps if mask is None else steps[mask]
+        self._array = None
+        self._rows = {int(step): row for row, step in enumerate(self.steps)}
+
+    @property
+    def array(self):
+        if self._array is None:
+            self._array = self.dataset[:]
+            if self.mask is not None:
+                self._array = self._array[self.mask]
+        return self._array
+
+    def __getitem__(self, step):
+        return self.array[self._rows[step]]
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def load(self):
+        return dict(zip(self._rows, self.array))
+
+
+class Records(Mapping):
+    """
+    Read-only {step: {key: value}} mapping over a group of columns of a cache
+    """
+
+    def __init__(self, group, steps):
+        self.columns = CacheGroup(group, steps)
+        self._step_set = set()
+        for column in self.columns.values():
+            self._step_set.update(column.keys())
+        self._steps = sorted(self._step_set)
+
+    def __getitem__(self, step):
+        if step not in self._step_set:
+            raise KeyError(step)
+        return {
+            key: column[step] for key, column in self.columns.items() if step in column
+        }
+
+    def __iter__(self):
+        return iter(self._steps)
+
+    def __len__(self):
+        return len(self._steps)
+
+    def load(self):
+        return {step: self[step] for step in self}
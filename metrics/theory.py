@@ -0,0 +1,99 @@
+import numpy as np
+
+# Closed-form SGD and SGDM solutions of the scale, rescale and translation
+# dynamics, evaluated over a whole vector of steps at once. Every function
+# returns one value per step, to be broadcast against per-layer arrays of
+# shape (steps, neurons).
+
+
+def momentum_constants(lr, wd, momentum, dampening, order):
+    """
+    Returns the damping gamma and frequency omega of the SGDM dynamics, for
+    quantities quadratic (order 2: scale, rescale) or linear (order 1:
+    translation) in the weights
+    """
+    lr = np.array(lr, dtype=np.float64)
+    wd = np.array(wd, dtype=np.float64)
+    momentum = np.array(momentum, dtype=np.float64)
+    dampening = np.array(dampening, dtype=np.float64)
+
+    denom = lr * (1 - dampening) * (1 + momentum)
+    gamma = (1 - momentum) / denom
+    omega = np.sqrt(2 * order * wd / denom)
+    return lr, wd, momentum, dampening, gamma, omega
+
+
+def sgd_decay(t, wd, order):
+    """
+    Homogeneous SGD solution exp(-order * wd * t)
+    """
+    return np.exp(-order * wd * t)
+
+
+def momentum_homogeneous(t, gamma, omega):
+    """
+    Homogeneous SGDM solution for the underdamped, critically damped and
+    overdamped regimes
+    """
+    if gamma < omega:
+        cos = np.cos(np.sqrt(omega ** 2 - gamma ** 2) * t)
+        sin = np.sin(np.sqrt(omega ** 2 - gamma ** 2) * t)
+        return np.exp(-gamma * t) * (
+            cos + gamma / np.sqrt(omega ** 2 - gamma ** 2) * sin
+        )
+    elif gamma == omega:
+        return np.exp(-gamma * t) * (1 + gamma * t)
+    else:
+        alpha_p = -gamma + np.sqrt(gamma ** 2 - omega ** 2)
+        alpha_m = -gamma - np.sqrt(gamma ** 2 - omega ** 2)
+        numer = alpha_p * np.exp(alpha_m * t) - alpha_m * np.exp(alpha_p * t)
+        denom = alpha_p - alpha_m
+        return numer / denom
+
+
+def momentum_inhomogeneous(t, gamma, omega):
+    """
+    Returns the factors multiplying integral_buffer_1 and integral_buffer_2 in
+    the inhomogeneous SGDM solution
+    """
+    if gamma < omega:
+        sqrt = np.sqrt(omega ** 2 - gamma ** 2)
+        scale_1 = np.exp(-gamma * t) * np.sin(sqrt * t) / sqrt
+        scale_2 = -np.exp(-gamma * t) * np.cos(sqrt * t) / sqrt
+    elif gamma == omega:
+        scale_1 = np.exp(-gamma * t) * t
+        scale_2 = -np.exp(-gamma * t)
+    else:
+        sqrt = np.sqrt(gamma ** 2 - omega ** 2)
+        alpha_p = -gamma + sqrt
+        alpha_m = -gamma - sqrt
+        scale_1 = np.exp(alpha_p * t) / (alpha_p - alpha_m)
+        scale_2 = -np.exp(alpha_m * t) / (alpha_p - alpha_m)
+    return scale_1, scale_2
+
+
+def stack(template, rows):
+    """
+    Stacks per-step buffer rows read from steps[1:] into a (steps, neurons)
+    array whose first row, at steps[0] where there are no buffers yet, is a
+    row of zeros like template
+    """
+    return np.stack([np.zeros_like(template)] + list(rows))
+
+
+def masked(scale, buffers):
+    """
+    Returns scale * buffers with rows that are not entirely finite, and the
+    first row, set to 0
+    """
+    finite = np.all(np.isfinite(buffers), axis=1)
+    finite[0] = False
+    with np.errstate(invalid="ignore", over="ignore"):
+        return np.where(finite[:, None], scale[:, None] * buffers, 0)
+
+
+def unstack(steps, values):
+    """
+    Returns {step: row} from a (steps, neurons) array
+    """
+    return dict(zip(steps, values))
@@ -1,170 +1,89 @@
-from tqdm import tqdm
 import metrics.helper as utils
+import metrics.planner as planner
+import metrics.theory as theory
 import numpy as np
 
 
-def compute_empirical(step, layers, load_kwargs, empirical):
-    weights = utils.load_features(steps=[str(step)], suffix="weight", **load_kwargs,)
-    biases = utils.load_features(steps=[str(step)], suffix="bias", **load_kwargs,)
+def compute_empirical(step, layers, feats, empirical):
+    out_bias = feats["params", "out_bias"]
     for layer in layers:
-        wl_t = weights[layer][f"step_{step}"]
-        bl_t = biases[layer][f"step_{step}"]
-        Wl_t = np.column_stack((wl_t, bl_t))
-        empirical[layer][step] = utils.out_synapses(Wl_t)
+        empirical[layer][step] = out_bias[layer]
 
 
-def compute_theoretical(
-    step, layers, load_kwargs, theoretical, i, step_0, lr, wd, W_0, b_0,
-):
-    t = lr * step
-    for layer in layers:
-        wl_0 = W_0[layer][f"step_{step_0}"]
-        bl_0 = b_0[layer][f"step_{step_0}"]
-        Wl_0 = np.column_stack((wl_0, bl_0))
-        theoretical[layer][step] = np.exp(-wd * t) * utils.out_synapses(Wl_0)
+def compute_theoretical(steps, layers, lr, wd, out_bias_0):
+    t = lr * np.asarray(steps)
+    decay = theory.sgd_decay(t, wd, 1)[:, None]
+    return {
+        layer: theory.unstack(steps, decay * out_bias_0[layer]) for layer in layers
+    }
 
 
 def compute_theoretical_momentum(
-    step,
-    layers,
-    load_kwargs,
-    theoretical,
-    i,
-    step_0,
-    lr,
-    wd,
-    momentum,
-    dampening,
-    omega,
-    gamma,
-    W_0,
-    b_0,
+    steps, layers, lr, wd, momentum, dampening, omega, gamma, out_bias_0,
 ):
-    t = lr * (1 - dampening) * step
-    for layer in layers:
-        wl_0 = W_0[layer][f"step_{step_0}"]
-        bl_0 = b_0[layer][f"step_{step_0}"]
-        Wl_0 = np.column_stack((wl_0, bl_0))
-        if gamma < omega:
-            cos = np.cos(np.sqrt(omega ** 2 - gamma ** 2) * t)
-            sin = np.sin(np.sqrt(omega ** 2 - gamma ** 2) * t)
-            scale = np.exp(-gamma * t) * (
-                cos + gamma / np.sqrt(omega ** 2 - gamma ** 2) * sin
-            )
-        elif gamma == omega:
-            scale = np.exp(-gamma * t) * (1 + gamma * t)
-        else:
-            alpha_p = -gamma + np.sqrt(gamma ** 2 - omega ** 2)
-            alpha_m = -gamma - np.sqrt(gamma ** 2 - omega ** 2)
-            numer = alpha_p * np.exp(alpha_m * t) - alpha_m * np.exp(alpha_p * t)
-            denom = alpha_p - alpha_m
-            scale = numer / denom
-
-        theoretical[layer][step] = scale * utils.out_synapses(Wl_0, dtype=np.float128)
-
-
-def translation(model, feats_dir, steps, **kwargs):
+    t = lr * (1 - dampening) * np.asarray(steps)
+    scale = theory.momentum_homogeneous(t, gamma, omega)[:, None]
+    return {
+        layer: theory.unstack(steps, scale * out_bias_0[layer]) for layer in layers
+    }
+
+
+def translation_kernel(model, reader, steps, **kwargs):
     lr = kwargs.get("lr")
     wd = kwargs.get("wd")
 
     layers = [layer for layer in utils.get_layers(model) if "classifier" in layer]
-    W_0 = utils.load_features(
-        steps=[str(steps[0])],
-        feats_dir=feats_dir,
-        model=model,
-        suffix="weight",
-        group="params",
-    )
-    b_0 = utils.load_features(
-        steps=[str(steps[0])],
-        feats_dir=feats_dir,
-        model=model,
-        suffix="bias",
-        group="params",
-    )
+    init = reader.read_reduced(steps[0], [("params", "out_bias")], layers, precise=True)
 
-    load_kwargs = {
-        "model": model,
-        "feats_dir": feats_dir,
-    }
-    theory_kwargs = {
-        "lr": lr,
-        "wd": wd,
-        "W_0": W_0,
-        "b_0": b_0,
-        "step_0": steps[0],
-    }
-
-    theoretical = {layer: {} for layer in layers}
     empirical = {layer: {} for layer in layers}
-    for i in tqdm(range(len(steps))):
+    for i in range(len(steps)):
         step = steps[i]
-        theory_kwargs["i"] = i
-        load_kwargs["group"] = "buffers"
-        compute_theoretical(step, layers, load_kwargs, theoretical, **theory_kwargs)
-        load_kwargs["group"] = "params"
-        compute_empirical(step, layers, load_kwargs, empirical)
+        feats = reader.read_reduced(
+            step, [("params", "out_bias")], layers, precise=True
+        )
+        compute_empirical(step, layers, feats, empirical)
+        yield
 
+    theoretical = compute_theoretical(
+        steps, layers, lr, wd, init["params", "out_bias"]
+    )
     return {"empirical": empirical, "theoretical": theoretical}
 
 
-def translation_momentum(model, feats_dir, steps, **kwargs):
-    lr = kwargs.get("lr")
-    wd = kwargs.get("wd")
-    momentum = kwargs.get("momentum")
-    dampening = kwargs.get("dampening")
-
-    lr = np.array(lr, dtype=np.float128)
-    wd = np.array(wd, dtype=np.float128)
-    momentum = np.array(momentum, dtype=np.float128)
-    dampening = np.array(dampening, dtype=np.float128)
-
-    denom = lr * (1 - dampening) * (1 + momentum)
-    gamma = (1 - momentum) / denom
-    omega = np.sqrt(2 * wd / denom)
-
-    layers = [layer for layer in utils.get_layers(model) if "classifier" in layer]
-    W_0 = utils.load_features(
-        steps=[str(steps[0])],
-        feats_dir=feats_dir,
-        model=model,
-        suffix="weight",
-        group="params",
-    )
-    b_0 = utils.load_features(
-        steps=[str(steps[0])],
-        feats_dir=feats_dir,
-        model=model,
-        suffix="bias",
-        group="params",
+def translation_momentum_kernel(model, reader, steps, **kwargs):
+    lr, wd, momentum, dampening, gamma, omega = theory.momentum_constants(
+        kwargs.get("lr"),
+        kwargs.get("wd"),
+        kwargs.get("momentum"),
+        kwargs.get("dampening"),
+        order=1,
     )
 
-    load_kwargs = {
-        "model": model,
-        "feats_dir": feats_dir,
-    }
-    theory_kwargs = {
-        "lr": lr,
-        "wd": wd,
-        "momentum": momentum,
-        "dampening": dampening,
-        "gamma": gamma,
-        "omega": omega,
-        "W_0": W_0,
-        "b_0": b_0,
-        "step_0": steps[0],
-    }
+    layers = [layer for layer in utils.get_layers(model) if "classifier" in layer]
+    init = reader.read_reduced(steps[0], [("params", "out_bias")], layers, precise=True)
 
-    theoretical = {layer: {} for layer in layers}
     empirical = {layer: {} for layer in layers}
-    for i in tqdm(range(len(steps))):
+    for i in range(len(steps)):
         step = steps[i]
-        theory_kwargs["i"] = i
-        load_kwargs["group"] = "buffers"
-        compute_theoretical_momentum(
-            step, layers, load_kwargs, theoretical, **theory_kwargs
+        feats = reader.read_reduced(
+            step, [("params", "out_bias")], layers, precise=True
         )
-        load_kwargs["group"] = "params"
-        compute_empirical(step, layers, load_kwargs, empirical)
-
+        compute_empirical(step, layers, feats, empirical)
+        yield
+
+    theoretical = compute_theoretical_momentum(
+        steps,
+        layers,
+        lr,
+        wd,
+        momentum,
+        dampening,
+        omega,
+        gamma,
+        init["params", "out_bias"],
+    )
     return {"empirical": empirical, "theoretical": theoretical}
+
+
+translation = planner.metric_fn(translation_kernel)
+translation_momentum = planner.metric_fn(translation_momentum_kernel)
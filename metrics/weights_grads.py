@@ -1,75 +1,68 @@
-from tqdm import tqdm
 import metrics.helper as utils
+import metrics.planner as planner
 import numpy as np
 
+# (group, suffix) pairs of the weights and gradients, biases are ignored
+WEIGHTS_GRADS = [("params", "weight"), ("buffers", "weight.grad_buffer")]
 
-def extract_weights_and_grads(step, layers, load_kwargs, weights_and_grads, **kwargs):
-    lr = kwargs.get("lr")
-    wd = kwargs.get("wd")
 
-    weights = utils.load_features(
-            steps=[str(step)],
-            suffix="weight",
-            group="params",
-            **load_kwargs,
-        )
-    biases = utils.load_features(
-            steps=[str(step)],
-            suffix="bias",
-            group="params",
-            **load_kwargs,
-        )
-
-    weight_buffers = utils.load_features(
-            steps=[str(step)],
-            suffix="weight.grad_buffer",
-            group="buffers",
-            **load_kwargs,
-        )
-    bias_buffers = utils.load_features(
-            steps=[str(step)],
-            suffix="bias.grad_buffer",
-            group="buffers",
-            **load_kwargs,
-        )
+def extract_weights_and_grads(row, layers, feats, weights_and_grads, **kwargs):
+    weights = feats["params", "weight"]
+    weight_buffers = feats["buffers", "weight.grad_buffer"]
 
     for layer in layers:
         # Ignoring biases for now
-        Wl_t = weights[layer][f"step_{step}"]
-        bl_t = biases[layer][f"step_{step}"]
-        weights_and_grads[layer]["weight"].append(
-            Wl_t
-        )
+        weights_and_grads[layer]["weight"][row] = weights[layer]
+        weights_and_grads[layer]["grad"][row] = weight_buffers[layer]
 
-        g_Wl_t = weight_buffers[layer][f"step_{step}"]
-        g_bl_t = bias_buffers[layer][f"step_{step}"]
-        weights_and_grads[layer]["grad"].append(
-            g_Wl_t
-        )
 
+def allocate(layers, feats, num_steps, out_dir=None):
+    """
+    Returns {layer: {"weight": array, "grad": array}} of arrays of shape
+    (num_steps, *weight.shape), memory-mapped from out_dir if given
+    """
+    arrays = {"weight": feats["params", "weight"]}
+    arrays["grad"] = feats["buffers", "weight.grad_buffer"]
+    allocated = {layer: {} for layer in layers}
+    for layer in layers:
+        for quantity, values in arrays.items():
+            shape = (num_steps,) + np.shape(values[layer])
+            dtype = np.asarray(values[layer]).dtype
+            if out_dir is None:
+                allocated[layer][quantity] = np.empty(shape, dtype=dtype)
+            else:
+                name = f"{layer}.{quantity}"
+                allocated[layer][quantity] = utils.open_array(
+                    out_dir, name, shape, dtype
+                )
+    return allocated
 
-def weights_grads(model, feats_dir, steps, **kwargs):
-    lr = kwargs.get("lr")
-    wd = kwargs.get("wd")
 
-    layers = [layer for layer in utils.get_layers(model) if "conv" in layer]
+def weights_grads_kernel(model, reader, steps, **kwargs):
+    # weights and gradients are streamed to memory-mapped arrays in the array
+    # directory of the cache when cache.py provides one
+    out_dir = kwargs.get("array_dirs", {}).get("weights_grads")
 
-    load_kwargs = {
-        "model": model,
-        "feats_dir": feats_dir,
-    }
+    layers = utils.get_layers(model, "conv")
 
-    weights_and_grads = {layer: {"weight":[],"grad":[]} for layer in layers}
+    weights_and_grads = None
     steps = np.unique(steps)
     steps.sort()
-    for i in tqdm(range(1, len(steps))):
+    for i in range(len(steps)):
         step = steps[i]
-        extract_weights_and_grads(step, layers, load_kwargs, weights_and_grads, **kwargs)
+        if i > 0:
+            feats = reader.read(step, WEIGHTS_GRADS, layers=layers)
+            if weights_and_grads is None:
+                weights_and_grads = allocate(layers, feats, len(steps) - 1, out_dir)
+            extract_weights_and_grads(i - 1, layers, feats, weights_and_grads)
+        yield
 
-    print("Allocating numpy arrays")
+    if weights_and_grads is None:
+        empty = {"weight": np.array([]), "grad": np.array([])}
+        weights_and_grads = {layer: dict(empty) for layer in layers}
     weights_and_grads["steps"] = steps[1:]
-    for layer in layers:
-        weights_and_grads[layer]["weight"] = np.array(weights_and_grads[layer]["weight"])
-        weights_and_grads[layer]["grad"] = np.array(weights_and_grads[layer]["grad"])
 
-    return weights_and_grads
\ No newline at end of file
+    return weights_and_grads
+
+
+weights_grads = planner.metric_fn(weights_grads_kernel)
@@ -17,6 +17,14 @@ class SGD(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         dampening (float, optional): dampening for momentum (default: 0)
         nesterov (bool, optional): enables Nesterov momentum (default: False)
+        save_buffers (list, optional): buffers to track, any of "sgd", "mom",
+            "grad" and "grad_norm" (default: [])
+        reduce_buffers (bool, optional): keep only the per-neuron in/out sums
+            of each buffer instead of full-size tensors (default: False)
+        foreach (bool, optional): update all parameters of a group with
+            multi-tensor kernels instead of a per-parameter loop, with
+            identical results. None uses them for CUDA parameters only, where
+            they fuse into few kernel launches (default: None)
 
     Example:
         >>> optimizer = torch.optim.SGD(model.parameters(), lr=0.1, momentum=0.9)
@@ -62,6 +70,8 @@ class SGD(Optimizer):
         weight_decay=0,
         nesterov=False,
         save_buffers=[],
+        reduce_buffers=False,
+        foreach=None,
     ):
         if lr is not required and lr < 0.0:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -116,33 +126,85 @@ class SGD(Optimizer):
         self.scale = scale
         self.mom_scale = mom_scale
         self.save_buffers = save_buffers
+        self.reduce_buffers = reduce_buffers
+        self.foreach = foreach
 
     def __setstate__(self, state):
         super(SGD, self).__setstate__(state)
         for group in self.param_groups:
             group.setdefault("nesterov", False)
 
+    def _reduce(self, name, value):
+        """
+        Returns {key: tensor} to store for a buffer. In reduced mode, a buffer
+        of a weight is stored as its per-neuron in-synapse sum ("{name}.in")
+        and out-synapse sum ("{name}.out"); a buffer of a 1-d parameter is
+        already per-neuron and is stored as is under "{name}.in".
+        """
+        if not self.reduce_buffers:
+            return {name: value}
+        if value.dim() < 2:
+            return {f"{name}.in": value}
+        in_dims = tuple(range(1, value.dim()))
+        out_dims = (0,) + tuple(range(2, value.dim()))
+        return {f"{name}.in": value.sum(in_dims), f"{name}.out": value.sum(out_dims)}
+
+    def _accumulate(self, name, value, buffer_dict):
+        for key, reduced in self._reduce(name, value).items():
+            if key not in buffer_dict.keys():
+                buffer_dict[key] = reduced
+            else:
+                buffer_dict[key].add_(reduced)
+
     def _sgd_buffers(self, time, g, buffer_dict):
         scale = self.scale(time)
-        if "integral_buffer" not in buffer_dict.keys():
-            buffer_dict["integral_buffer"] = scale * g ** 2
-        else:
-            buffer_dict["integral_buffer"].add_(scale * g ** 2)
+        self._accumulate("integral_buffer", scale * g ** 2, buffer_dict)
 
     def _mom_buffers(self, time, g, buffer_dict):
         scale_1, scale_2 = self.mom_scale(time)
-        if "integral_buffer_1" not in buffer_dict.keys():
-            buffer_dict["integral_buffer_1"] = scale_1 * g ** 2
-            buffer_dict["integral_buffer_2"] = scale_2 * g ** 2
-        else:
-            buffer_dict["integral_buffer_1"].add_(scale_1 * g ** 2)
-            buffer_dict["integral_buffer_2"].add_(scale_2 * g ** 2)
+        self._accumulate("integral_buffer_1", scale_1 * g ** 2, buffer_dict)
+        self._accumulate("integral_buffer_2", scale_2 * g ** 2, buffer_dict)
 
     def _grad_buffers(self, time, g, buffer_dict):
-        buffer_dict["grad_buffer"] = g
+        buffer_dict.update(self._reduce("grad_buffer", g))
 
     def _grad_norm_buffers(self, time, g, buffer_dict):
-        buffer_dict["grad_norm_buffer"] = g ** 2
+        buffer_dict.update(self._reduce("grad_norm_buffer", g ** 2))
+
+    def _accumulate_multi(self, name, values, buffer_dicts):
+        if self.reduce_buffers:
+            for value, buffer_dict in zip(values, buffer_dicts):
+                self._accumulate(name, value, buffer_dict)
+            return
+        existing = [(v, d[name]) for v, d in zip(values, buffer_dicts) if name in d]
+        if len(existing) > 0:
+            torch._foreach_add_([b for _, b in existing], [v for v, _ in existing])
+        for value, buffer_dict in zip(values, buffer_dicts):
+            if name not in buffer_dict:
+                buffer_dict[name] = value
+
+    def _sgd_buffers_multi(self, time, gs, buffer_dicts):
+        scale = float(self.scale(time))
+        values = torch._foreach_mul(gs, gs)
+        torch._foreach_mul_(values, scale)
+        self._accumulate_multi("integral_buffer", values, buffer_dicts)
+
+    def _mom_buffers_multi(self, time, gs, buffer_dicts):
+        scale_1, scale_2 = self.mom_scale(time)
+        values_1 = torch._foreach_mul(gs, gs)
+        values_2 = torch._foreach_mul(gs, gs)
+        torch._foreach_mul_(values_1, float(scale_1))
+        torch._foreach_mul_(values_2, float(scale_2))
+        self._accumulate_multi("integral_buffer_1", values_1, buffer_dicts)
+        self._accumulate_multi("integral_buffer_2", values_2, buffer_dicts)
+
+    def _grad_buffers_multi(self, time, gs, buffer_dicts):
+        for g, buffer_dict in zip(gs, buffer_dicts):
+            self._grad_buffers(time, g, buffer_dict)
+
+    def _grad_norm_buffers_multi(self, time, gs, buffer_dicts):
+        for value, buffer_dict in zip(torch._foreach_mul(gs, gs), buffer_dicts):
+            buffer_dict.update(self._reduce("grad_norm_buffer", value))
 
     @torch.no_grad()
     def step(self, closure=None):
@@ -158,49 +220,121 @@ class SGD(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
-            lr = group["lr"]
-            weight_decay = group["weight_decay"]
-            momentum = group["momentum"]
-            dampening = group["dampening"]
-            nesterov = group["nesterov"]
-
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-                d_p = p.grad
-                if weight_decay != 0:
-                    d_p = d_p.add(p, alpha=weight_decay)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if "momentum_buffer" not in param_state:
-                        buf = param_state["momentum_buffer"] = torch.clone(d_p).detach()
-                        buf.mul_(1 - dampening)  # Added to scale buffer appropriately
-                    else:
-                        buf = param_state["momentum_buffer"]
-                        buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
-                    if nesterov:
-                        d_p = d_p.add(buf, alpha=momentum)
-                    else:
-                        d_p = buf
-
-                p.add_(d_p, alpha=-lr)
+            if self._use_foreach(group):
+                self._multi_tensor_step(group)
+            else:
+                self._single_tensor_step(group)
 
+        return loss
+
+    def _single_tensor_step(self, group):
+        lr = group["lr"]
+        weight_decay = group["weight_decay"]
+        momentum = group["momentum"]
+        dampening = group["dampening"]
+        nesterov = group["nesterov"]
+
+        for p in group["params"]:
+            if p.grad is None:
+                continue
+            d_p = p.grad
+            if weight_decay != 0:
+                d_p = d_p.add(p, alpha=weight_decay)
+            if momentum != 0:
                 param_state = self.state[p]
-                g = p.grad
-                if "step" not in param_state:
-                    param_state["step"] = 0
-                    param_state["buffers"] = {}
+                if "momentum_buffer" not in param_state:
+                    buf = param_state["momentum_buffer"] = torch.clone(d_p).detach()
+                    buf.mul_(1 - dampening)  # Added to scale buffer appropriately
                 else:
-                    param_state["step"] += 1
-                buffer_dict = param_state["buffers"]
-                time = lr * (1 - dampening) * param_state["step"]
-                if "sgd" in self.save_buffers:
-                    self._sgd_buffers(time, d_p, buffer_dict)
-                if "mom" in self.save_buffers:
-                    self._mom_buffers(time, d_p, buffer_dict)
-                if "grad" in self.save_buffers:
-                    self._grad_buffers(time, d_p, buffer_dict)
-                if "grad_norm" in self.save_buffers:
-                    self._grad_norm_buffers(time, d_p, buffer_dict)
-
-        return loss
+                    buf = param_state["momentum_buffer"]
+                    buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
+                if nesterov:
+                    d_p = d_p.add(buf, alpha=momentum)
+                else:
+                    d_p = buf
+
+            p.add_(d_p, alpha=-lr)
+
+            param_state = self.state[p]
+            if "step" not in param_state:
+                param_state["step"] = 0
+                param_state["buffers"] = {}
+            else:
+                param_state["step"] += 1
+            buffer_dict = param_state["buffers"]
+            time = lr * (1 - dampening) * param_state["step"]
+            if "sgd" in self.save_buffers:
+                self._sgd_buffers(time, d_p, buffer_dict)
+            if "mom" in self.save_buffers:
+                self._mom_buffers(time, d_p, buffer_dict)
+            if "grad" in self.save_buffers:
+                self._grad_buffers(time, d_p, buffer_dict)
+            if "grad_norm" in self.save_buffers:
+                self._grad_norm_buffers(time, d_p, buffer_dict)
+
+    def _use_foreach(self, group):
+        if self.foreach is None:
+            return all(p.is_cuda for p in group["params"])
+        return self.foreach
+
+    def _multi_tensor_step(self, group):
+        """
+        Same update as _single_tensor_step, with the elementwise ops of all
+        parameters in the group batched into multi-tensor (foreach) kernels
+        """
+        lr = group["lr"]
+        weight_decay = group["weight_decay"]
+        momentum = group["momentum"]
+        dampening = group["dampening"]
+        nesterov = group["nesterov"]
+
+        params = [p for p in group["params"] if p.grad is not None]
+        if len(params) == 0:
+            return
+        d_ps = [p.grad for p in params]
+        if weight_decay != 0:
+            d_ps = torch._foreach_add(d_ps, params, alpha=weight_decay)
+        if momentum != 0:
+            bufs, old_bufs, old_d_ps = [], [], []
+            for p, d_p in zip(params, d_ps):
+                param_state = self.state[p]
+                if "momentum_buffer" not in param_state:
+                    buf = param_state["momentum_buffer"] = torch.clone(d_p).detach()
+                    buf.mul_(1 - dampening)  # Added to scale buffer appropriately
+                else:
+                    buf = param_state["momentum_buffer"]
+                    old_bufs.append(buf)
+                    old_d_ps.append(d_p)
+                bufs.append(buf)
+            if len(old_bufs) > 0:
+                torch._foreach_mul_(old_bufs, momentum)
+                torch._foreach_add_(old_bufs, old_d_ps, alpha=1 - dampening)
+            if nesterov:
+                d_ps = torch._foreach_add(d_ps, bufs, alpha=momentum)
+            else:
+                d_ps = bufs
+
+        torch._foreach_add_(params, d_ps, alpha=-lr)
+
+        # parameters share a time unless some of them skipped steps
+        times = {}
+        for p, d_p in zip(params, d_ps):
+            param_state = self.state[p]
+            if "step" not in param_state:
+                param_state["step"] = 0
+                param_state["buffers"] = {}
+            else:
+                param_state["step"] += 1
+            time = lr * (1 - dampening) * param_state["step"]
+            gs, buffer_dicts = times.setdefault(time, ([], []))
+            gs.append(d_p)
+            buffer_dicts.append(param_state["buffers"])
+        for time, (gs, buffer_dicts) in times.items():
+            if "sgd" in self.save_buffers:
+                self._sgd_buffers_multi(time, gs, buffer_dicts)
+            if "mom" in self.save_buffers:
+                self._mom_buffers_multi(time, gs, buffer_dicts)
+            if "grad" in self.save_buffers:
+                self._grad_buffers_multi(time, gs, buffer_dicts)
+            if "grad_norm" in self.save_buffers:
+                self._grad_norm_buffers_multi(time, gs, buffer_dicts)
@@ -39,13 +39,24 @@ class Lamb(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         adam (bool, optional): always use trust ratio = 1, which turns this into
             Adam. Useful for comparison purposes.
+        foreach (bool, optional): update all parameters of a group with
+            multi-tensor kernels instead of a per-parameter loop, with
+            identical results. None uses them for CUDA parameters only, where
+            they fuse into few kernel launches (default: None)
 
     .. _Large Batch Optimization for Deep Learning: Training BERT in 76 minutes:
         https://arxiv.org/abs/1904.00962
     """
 
     def __init__(
-        self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-6, weight_decay=0, adam=False
+        self,
+        params,
+        lr=1e-3,
+        betas=(0.9, 0.999),
+        eps=1e-6,
+        weight_decay=0,
+        adam=False,
+        foreach=None,
     ):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -57,6 +68,7 @@ class Lamb(Optimizer):
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
         self.adam = adam
+        self.foreach = foreach
         super(Lamb, self).__init__(params, defaults)
 
     def step(self, closure=None):
@@ -71,6 +83,9 @@ class Lamb(Optimizer):
             loss = closure()
 
         for group in self.param_groups:
+            if self._use_foreach(group):
+                self._multi_tensor_step(group)
+                continue
             for p in group["params"]:
                 if p.grad is None:
                     continue
@@ -129,3 +144,76 @@ class Lamb(Optimizer):
                 p.data.add_(-step_size * trust_ratio, adam_step)
 
         return loss
+
+    def _use_foreach(self, group):
+        if self.foreach is None:
+            return all(p.is_cuda for p in group["params"])
+        return self.foreach
+
+    def _multi_tensor_step(self, group):
+        """
+        Same update as the per-parameter loop in step, with the elementwise
+        ops of all parameters in the group batched into multi-tensor (foreach)
+        kernels. Norms and trust ratios remain per parameter.
+        """
+        params = [p for p in group["params"] if p.grad is not None]
+        if len(params) == 0:
+            return
+        grads = [p.grad.data for p in params]
+        if any(grad.is_sparse for grad in grads):
+            raise RuntimeError(
+                "Lamb does not support sparse gradients, consider SparseAdam instad."
+            )
+        data = [p.data for p in params]
+
+        for p in params:
+            state = self.state[p]
+            # State initialization
+            if len(state) == 0:
+                state["step"] = 0
+                # Exponential moving average of gradient values
+                state["exp_avg"] = torch.zeros_like(p.data)
+                # Exponential moving average of squared gradient values
+                state["exp_avg_sq"] = torch.zeros_like(p.data)
+            state["step"] += 1
+        exp_avgs = [self.state[p]["exp_avg"] for p in params]
+        exp_avg_sqs = [self.state[p]["exp_avg_sq"] for p in params]
+        beta1, beta2 = group["betas"]
+
+        # Decay the first and second moment running average coefficient
+        # m_t
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        # v_t
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+        # Paper v3 does not use debiasing.
+        step_size = group["lr"]
+
+        weight_norms = [
+            norm.sum().sqrt().clamp(0, 10) for norm in torch._foreach_pow(data, 2)
+        ]
+
+        denoms = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denoms, group["eps"])
+        adam_steps = torch._foreach_div(exp_avgs, denoms)
+        if group["weight_decay"] != 0:
+            torch._foreach_add_(adam_steps, data, alpha=group["weight_decay"])
+
+        adam_norms = [norm.sum().sqrt() for norm in torch._foreach_pow(adam_steps, 2)]
+        for p, adam_step, weight_norm, adam_norm in zip(
+            params, adam_steps, weight_norms, adam_norms
+        ):
+            if weight_norm == 0 or adam_norm == 0:
+                trust_ratio = 1
+            else:
+                trust_ratio = weight_norm / adam_norm
+            state = self.state[p]
+            state["weight_norm"] = weight_norm
+            state["adam_norm"] = adam_norm
+            state["trust_ratio"] = trust_ratio
+            if self.adam:
+                trust_ratio = 1
+
+            p.data.add_(adam_step, alpha=-step_size * trust_ratio)
@@ -8,7 +8,6 @@ from utils import flags
 from metrics import helper
 from metrics.metrics import metric_fns
 from cache import main as cache
-from cache import extend_parser as cache_parser
 
 
 y_labels = {
@@ -54,10 +53,10 @@ def empirical_plot(args, axes, metrics):
             color_idx = 1
         else:
             color_idx = int(layer.split("conv")[1]) - 1
-        timesteps = list(empirical[layer].keys())
-        norm = list(empirical[layer].values())
+        # only the columns of the plotted layers are read from the cache
+        timesteps, norm = helper.column(empirical[layer])
         if args.layer_wise:
-            norm = [np.sum(i) for i in norm]
+            norm = norm.reshape(len(norm), -1).sum(axis=1)
         axes.plot(
             timesteps, norm, color=plt.cm.tab20(color_idx),
         )
@@ -65,20 +64,19 @@ def empirical_plot(args, axes, metrics):
     if "theoretical" in metrics.keys():
         theoretical = metrics["theoretical"]
         for layer in layers:
-            timesteps = list(theoretical[layer].keys())
-            norm = list(theoretical[layer].values())
+            timesteps, norm = helper.column(theoretical[layer])
             if args.layer_wise:
-                norm = [np.sum(i) for i in norm]
+                norm = norm.reshape(len(norm), -1).sum(axis=1)
             axes.plot(
                 timesteps, norm, color="k", ls="--",
             )
 
     # axes labels and title
     axes.set_xlabel("timestep")
-    axes.set_ylabel(y_labels[ARGS.viz])
-    axes.title.set_text(titles[ARGS.viz])
+    axes.set_ylabel(y_labels[args.viz])
+    axes.title.set_text(titles[args.viz])
     if args.use_tex:
-        axes.set_ylabel(y_labels_tex[ARGS.viz])
+        axes.set_ylabel(y_labels_tex[args.viz])
 
 
 def performance_plot(axes, steps, performance):
@@ -127,12 +125,11 @@ def network_plot(args, axes, empirical):
     handles = []
     layers = [l for l in layers if "conv" in l]
     for idx, layer in enumerate(layers):
-        timesteps = list(empirical[layer].keys())
-        norm = list(empirical[layer].values())
+        timesteps, norm = helper.column(empirical[layer])
         if args.norm:
-            norm = [i ** 2 for i in norm]
+            norm = norm ** 2
         if args.layer_wise:
-            norm = [np.sum(i) for i in norm]
+            norm = norm.reshape(len(norm), -1).sum(axis=1)
         axes.plot(
             timesteps, norm, color=plt.cm.tab20(idx), label=layer, lw=2, alpha=0.5,
         )
@@ -142,6 +139,7 @@ def network_plot(args, axes, empirical):
 def main(args=None, axes=None):
     if args is not None:
         ARGS = args
+    ARGS.metrics = [ARGS.viz]
     steps, metrics = cache(ARGS)
 
     # create plot
@@ -169,9 +167,17 @@ def main(args=None, axes=None):
     plot_file = f"{plot_path}/{ARGS.viz}{ARGS.suffix}.pdf"
     plt.savefig(plot_file)
     print(f">> Saving figure to {plot_file}")
+    helper.close_cache(metrics)
 
 
 def extend_parser(parser):
+    parser.add_argument(
+        "--viz",
+        type=str,
+        required=True,
+        choices=list(metric_fns.keys()),
+        help="metric to plot, computed and cached first if needed",
+    )
     parser.add_argument(
         "--plot-dir",
         type=str,
@@ -214,20 +220,11 @@ def extend_parser(parser):
         default=False,
         required=False,
     )
-    parser.add_argument(
-        "--subset",
-        type=int,
-        help="number of parameters to plot",
-        default=None,
-        required=False,
-    )
-    parser.add_argument("--seed", type=int, default=1, help="random seed i(default: 1)")
     return parser
 
 
 if __name__ == "__main__":
     parser = flags.cache()
-    parser = cache_parser(parser)
     parser = extend_parser(parser)
     # subparsers here?? Probably not, don't really need diferent options for each viz
 
@@ -21,3 +21,24 @@ if [ "$format_occurred" = true ]; then
     echo "At least one file was formatted, exiting before tests"
     exit 1
 fi
+
+echo "Checking compensated sums"
+echo ">>>>>>>>>>>>>>>>>>>>>>>"
+python benchmarks/reductions.py --check
+if [ $? -ne 0 ]; then
+    echo ">>> Failed, compensated sums differ from exact sums"
+    exit 1
+fi
+
+# performance regressions take minutes, so they are only checked when asked
+# for with CHECK_PERFORMANCE=1, against a baseline saved on this machine with
+# python benchmarks/pipeline.py --save-baseline
+if [ "$CHECK_PERFORMANCE" = 1 ] && [ -f benchmarks/baseline.json ]; then
+    echo "Checking performance"
+    echo ">>>>>>>>>>>>>>>>>>>>>>>"
+    python benchmarks/pipeline.py
+    if [ $? -ne 0 ]; then
+        echo ">>> Failed, a benchmark regressed against benchmarks/baseline.json"
+        exit 1
+    fi
+fi
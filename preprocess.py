@@ -0,0 +1,34 @@
+import os
+from torchvision import datasets
+from utils import flags
+from utils import custom_datasets
+
+
+def main():
+    size = ARGS.size
+    if size is None:
+        size = custom_datasets.MEMMAP_SIZES[ARGS.dataset]
+
+    for train in [True, False]:
+        prefix = custom_datasets.memmap_path(ARGS.data_dir, ARGS.dataset, train)
+        if os.path.isfile(f"{prefix}.images.bin") and not ARGS.overwrite:
+            print(f"\t{prefix}.images.bin already exists, skipping")
+            continue
+        if ARGS.dataset == "tiny-imagenet":
+            image_folder = custom_datasets.TINYIMAGENET(
+                ARGS.data_dir, train=train, download=True
+            )
+        if ARGS.dataset == "imagenet":
+            folder = f"{ARGS.data_dir}/imagenet_raw/{'train' if train else 'val'}"
+            image_folder = datasets.ImageFolder(folder)
+        print(f">> Writing {len(image_folder)} images of size {size} to {prefix}")
+        # training images keep their aspect ratio for the random crops
+        custom_datasets.write_memmap(
+            image_folder, prefix, size, crop=not train, workers=ARGS.workers
+        )
+
+
+if __name__ == "__main__":
+    parser = flags.preprocess()
+    ARGS = parser.parse_args()
+    main()
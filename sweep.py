@@ -0,0 +1,224 @@
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from utils import flags
+
+# Stages of an experiment, each depending on the previous one
+STAGES = ["train", "extract", "cache"]
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def expand(spec):
+    """
+    Returns the [(expid, train_args)] of a sweep spec: one run for every
+    combination of the values in spec["grid"], on top of spec["train"]
+    """
+    keys = list(spec.get("grid", {}).keys())
+    runs = []
+    for values in itertools.product(*[spec["grid"][key] for key in keys]):
+        point = dict(zip(keys, values))
+        if "expid" in spec:
+            fields = {key.replace("-", "_"): value for key, value in point.items()}
+            expid = spec["expid"].format(**fields)
+        else:
+            expid = "_".join(f"{key}{value}" for key, value in point.items())
+        runs.append((expid or "run", {**spec.get("train", {}), **point}))
+    return runs
+
+
+def arguments(args):
+    """
+    Converts a dict of {flag: value} to command line arguments, where True
+    is a switch, False is omitted and lists are comma separated
+    """
+    command = []
+    for key, value in args.items():
+        if value is False or value is None:
+            continue
+        command.append(f"--{key}")
+        if isinstance(value, list):
+            command.append(",".join(str(v) for v in value))
+        elif value is not True:
+            command.append(str(value))
+    return command
+
+
+def make_jobs(spec, save_dir, threads, stages):
+    """
+    Returns the jobs of a sweep in scheduling order, as dicts holding the
+    command of a stage of a run and the stage it depends on
+    """
+    experiment = spec["experiment"]
+    jobs = []
+    for expid, train_args in expand(spec):
+        common = ["--experiment", experiment, "--expid", expid, "--save-dir", save_dir]
+        commands = {
+            # restart an interrupted run from its last checkpoint and extract
+            # only the checkpoints an interrupted extraction did not get to
+            "train": ["train.py", "--resume"] + arguments(train_args),
+            "extract": ["extract.py", "--resume", "--jobs", str(threads)]
+            + arguments(spec.get("extract", {})),
+            "cache": ["cache.py"] + arguments(spec.get("cache", {})),
+        }
+        previous = None
+        for stage in STAGES:
+            if stage not in stages:
+                continue
+            jobs.append(
+                {
+                    "expid": expid,
+                    "stage": stage,
+                    "command": [sys.executable, f"{REPO_DIR}/{commands[stage][0]}"]
+                    + common
+                    + commands[stage][1:],
+                    "after": previous,
+                    "status": "pending",
+                }
+            )
+            previous = jobs[-1]
+    return jobs
+
+
+def cpus():
+    """
+    Returns the CPUs this process may run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def cpu_slots(slots, threads):
+    """
+    Returns the disjoint lists of CPUs the slots are pinned to, or None for
+    every slot if processes cannot be pinned
+    """
+    available = cpus()
+    if slots * threads > len(available):
+        print(
+            f"WARNING: {slots} slots of {threads} threads oversubscribe "
+            f"{len(available)} CPUs, not pinning jobs"
+        )
+        return [None] * slots
+    if not hasattr(os, "sched_setaffinity"):
+        return [None] * slots
+    return [available[i * threads : (i + 1) * threads] for i in range(slots)]
+
+
+def start(job, cores, threads, log_dir):
+    """
+    Starts a job in a subprocess limited to threads threads and pinned to
+    the CPUs in cores, logging its output to {log_dir}/{expid}.{stage}.log
+    """
+    env = dict(os.environ)
+    for variable in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        env[variable] = str(threads)
+
+    def pin():
+        if cores is not None:
+            os.sched_setaffinity(0, cores)
+
+    job["log"] = f"{log_dir}/{job['expid']}.{job['stage']}.log"
+    with open(job["log"], "w") as log:
+        job["process"] = subprocess.Popen(
+            job["command"],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            env=env,
+            preexec_fn=pin,
+        )
+    job["status"] = "running"
+    job["start"] = time.time()
+
+
+def run(jobs, slots, threads, log_dir, poll=1.0):
+    """
+    Runs jobs over a pool of slots, starting every job once the job it
+    depends on succeeded and skipping it if that job failed. Later stages are
+    started first, so that results come in while the rest of the sweep runs.
+    """
+    free = cpu_slots(slots, threads)
+    pending = sorted(jobs, key=lambda job: -STAGES.index(job["stage"]))
+    running = []
+    total = len(jobs)
+    finished = 0
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            for job in list(pending):
+                after = job["after"]
+                if after is not None and after["status"] in ["failed", "skipped"]:
+                    job["status"] = "skipped"
+                    pending.remove(job)
+                    finished += 1
+                    print(f"[{finished}/{total}] {job['stage']} {job['expid']} skipped")
+                elif len(free) > 0 and (after is None or after["status"] == "done"):
+                    job["cores"] = free.pop(0)
+                    start(job, job["cores"], threads, log_dir)
+                    pending.remove(job)
+                    running.append(job)
+            time.sleep(poll)
+            for job in list(running):
+                returncode = job["process"].poll()
+                if returncode is None:
+                    continue
+                running.remove(job)
+                free.append(job["cores"])
+                finished += 1
+                seconds = time.time() - job["start"]
+                if returncode == 0:
+                    job["status"] = "done"
+                    open(f"{log_dir}/{job['expid']}.{job['stage']}.done", "w").close()
+                    outcome = f"done in {seconds:.0f}s"
+                else:
+                    job["status"] = "failed"
+                    outcome = f"failed with exit code {returncode}, see {job['log']}"
+                print(
+                    f"[{finished}/{total}] {job['stage']} {job['expid']} {outcome} "
+                    f"({len(running)} running, {len(pending)} pending)"
+                )
+    finally:
+        for job in running:
+            job["process"].terminate()
+
+
+def main():
+    with open(ARGS.spec) as f:
+        spec = json.load(f)
+    slots = ARGS.slots
+    if slots is None:
+        slots = max(1, len(cpus()) // ARGS.threads)
+    # jobs do not necessarily run from the current directory
+    save_dir = os.path.abspath(ARGS.save_dir)
+    jobs = make_jobs(spec, save_dir, ARGS.threads, ARGS.stages)
+
+    log_dir = f"{save_dir}/{spec['experiment']}/.sweep"
+    os.makedirs(log_dir, exist_ok=True)
+    for job in jobs:
+        # stages that finished in a previous sweep are not run again
+        if os.path.isfile(f"{log_dir}/{job['expid']}.{job['stage']}.done"):
+            job["status"] = "done"
+    todo = [job for job in jobs if job["status"] == "pending"]
+    print(
+        f">> Sweep {spec['experiment']}: {len(jobs) // len(ARGS.stages)} runs, "
+        f"{len(jobs) - len(todo)} of {len(jobs)} jobs already done, "
+        f"{slots} slots of {ARGS.threads} threads"
+    )
+    if ARGS.dry_run:
+        for job in todo:
+            print(" ".join(job["command"]))
+        return
+
+    run(todo, slots, ARGS.threads, log_dir)
+    failed = [job for job in todo if job["status"] != "done"]
+    if len(failed) > 0:
+        print(f">> {len(failed)} jobs failed or were skipped")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = flags.sweep()
+    ARGS = parser.parse_args()
+    main()
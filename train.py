@@ -7,13 +7,19 @@ import torch.nn as nn
 from utils import load
 from utils import optimize
 from utils import flags
+from utils import checkpoint
+from utils import distributed
+from metrics import layers
+from metrics.online import OnlineMetrics
 
 
 def main(ARGS):
     if ARGS.tpu:
         print_fn = xm.master_print
     else:
-        print_fn = print
+        print_fn = distributed.master_print
+    # with --world-size, only rank 0 writes results
+    is_main = distributed.rank() == 0
 
     ## Construct Result Directory ##
     if ARGS.expid == "":
@@ -23,21 +29,26 @@ def main(ARGS):
     else:
         setattr(ARGS, "save", True)
         save_path = f"{ARGS.save_dir}/{ARGS.experiment}/{ARGS.expid}"
+    if ARGS.save and is_main:
         try:
             os.makedirs(save_path)
             os.makedirs(f"{save_path}/ckpt")
         except FileExistsError:
-            if not ARGS.overwrite:
+            if not ARGS.overwrite and not ARGS.resume:
                 print_fn(
-                    "Feature directory exists and no-overwrite specified. Rerun with --overwrite"
+                    "Feature directory exists and no-overwrite specified. Rerun with --overwrite or --resume"
                 )
                 quit()
-            shutil.rmtree(save_path)
-            os.makedirs(save_path)
-            os.makedirs(f"{save_path}/ckpt")
+            if ARGS.overwrite:
+                shutil.rmtree(save_path)
+                os.makedirs(save_path)
+                os.makedirs(f"{save_path}/ckpt")
+
+    if distributed.world_size() > 1:
+        distributed.barrier()
 
     ## Save Args ##
-    if ARGS.save:
+    if ARGS.save and is_main:
         filename = save_path + "/hyperparameters.json"
         with open(filename, "w") as f:
             json.dump(ARGS.__dict__, f, sort_keys=True, indent=4)
@@ -61,6 +72,9 @@ def main(ARGS):
         workers=ARGS.workers,
         datadir=ARGS.data_dir,
         tpu=ARGS.tpu,
+        in_memory=ARGS.in_memory,
+        memmap=ARGS.memmap,
+        seed=ARGS.seed,
     )
     test_loader = load.dataloader(
         dataset=ARGS.dataset,
@@ -69,6 +83,8 @@ def main(ARGS):
         workers=ARGS.workers,
         datadir=ARGS.data_dir,
         tpu=ARGS.tpu,
+        in_memory=ARGS.in_memory,
+        memmap=ARGS.memmap,
     )
 
     ## Model, Loss, Optimizer ##
@@ -76,6 +92,8 @@ def main(ARGS):
     model = load.model(ARGS.model, ARGS.model_class)(
         input_shape=input_shape, num_classes=num_classes, pretrained=ARGS.pretrained,
     ).to(device)
+    if ARGS.save and is_main:
+        layers.save(layers.layer_map(model), save_path)
 
     train_kwargs = {
         "batch_size": train_loader.batch_size,
@@ -89,7 +107,12 @@ def main(ARGS):
 
     loss = nn.CrossEntropyLoss()
     opt_class, opt_kwargs = load.optimizer(
-        ARGS.optimizer, ARGS.momentum, ARGS.dampening, ARGS.nesterov, ARGS.save_buffers,
+        ARGS.optimizer,
+        ARGS.momentum,
+        ARGS.dampening,
+        ARGS.nesterov,
+        ARGS.save_buffers,
+        ARGS.reduce_buffers,
     )
     opt_kwargs.update({"lr": ARGS.lr, "weight_decay": ARGS.wd})
     optimizer = opt_class(model.parameters(), **opt_kwargs)
@@ -97,6 +120,25 @@ def main(ARGS):
         optimizer, milestones=ARGS.lr_drops, gamma=ARGS.lr_drop_rate
     )
 
+    online = None
+    if ARGS.save and is_main and ARGS.online_metrics:
+        online = OnlineMetrics(save_path, model, optimizer)
+
+    start_step = 0
+    if ARGS.save and ARGS.resume:
+        filename = checkpoint.latest(save_path)
+        if filename is not None:
+            print_fn(f"Resuming from {filename}.")
+            start_step = checkpoint.restore(
+                filename, model, optimizer, scheduler, device
+            )
+    if distributed.world_size() > 1:
+        distributed.broadcast_model(model)
+
+    writer = None
+    if ARGS.save and is_main and ARGS.async_checkpoints:
+        writer = checkpoint.CheckpointWriter(ARGS.checkpoint_queue)
+
     ## Train ##
     print_fn("Training for {} epochs.".format(ARGS.epochs))
     optimize.train_eval_loop(
@@ -109,11 +151,18 @@ def main(ARGS):
         device,
         ARGS.epochs,
         ARGS.verbose,
-        ARGS.save,
+        ARGS.save and is_main,
         save_freq=ARGS.save_freq,
         save_path=save_path,
+        online=online,
+        writer=writer,
+        dynamics=ARGS.dynamics_checkpoints,
+        start_step=start_step,
+        precision=ARGS.precision,
         **train_kwargs,
     )
+    if writer is not None:
+        writer.close()
 
 
 if __name__ == "__main__":
@@ -130,5 +179,7 @@ if __name__ == "__main__":
             main(args)
 
         xmp.spawn(_mp_fn, args=(ARGS,), nprocs=None, start_method="fork")
+    elif ARGS.world_size > 1:
+        distributed.spawn(main, ARGS, ARGS.world_size, ARGS.dist_port)
     else:
         main(ARGS)
@@ -0,0 +1,143 @@
+import glob
+import os
+import queue
+import threading
+import h5py
+import numpy as np
+import torch
+
+# Groups of a dynamics checkpoint, the same as those of the feature files
+# written by extract.py
+DYNAMICS_GROUPS = ["metrics", "params", "buffers"]
+
+
+def snapshot(obj):
+    """
+    Returns a copy of a (nested) state dict with every tensor copied to host
+    memory, so that training can keep updating the original tensors
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def save_dynamics(save_dict, filename):
+    """
+    Writes a dynamics checkpoint: an HDF5 file holding the "metrics", "params"
+    and "buffers" dicts of save_dict as datasets, and its "epoch" and "step"
+    as attributes, which extract.py reads without unpickling anything
+    """
+    tmp_filename = f"{filename}.tmp"
+    with h5py.File(tmp_filename, "w") as open_file:
+        open_file.attrs["epoch"] = save_dict["epoch"]
+        open_file.attrs["step"] = save_dict["step"]
+        for group in DYNAMICS_GROUPS:
+            h5_group = open_file.create_group(group)
+            for name, value in save_dict[group].items():
+                if torch.is_tensor(value):
+                    value = value.detach().cpu().numpy()
+                h5_group.create_dataset(name, data=np.asarray(value))
+    os.replace(tmp_filename, filename)
+
+
+def load_dynamics(filename):
+    """
+    Returns the {group: {name: np.array}} features of a dynamics checkpoint
+    """
+    with h5py.File(filename, "r") as open_file:
+        return {
+            group: {name: dataset[:] for name, dataset in open_file[group].items()}
+            for group in DYNAMICS_GROUPS
+        }
+
+
+def latest(save_path):
+    """
+    Returns the filename of the full checkpoint with the highest step in
+    {save_path}/ckpt, or None if there is none
+    """
+    filenames = glob.glob(f"{save_path}/ckpt/step*.tar")
+    if len(filenames) == 0:
+        return None
+    return max(filenames, key=lambda f: int(f.split(".tar")[0].split("step")[-1]))
+
+
+def restore(filename, model, optimizer, scheduler, device):
+    """
+    Loads the model, optimizer (including custom_sgd buffers) and scheduler
+    states and the random number generator state of a full checkpoint, and
+    returns the step it was saved at
+    """
+    checkpoint = torch.load(filename, map_location=device)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+    scheduler.load_state_dict(checkpoint["scheduler_state_dict"])
+    if "rng_state" in checkpoint:
+        torch.set_rng_state(checkpoint["rng_state"].cpu())
+    return checkpoint["step"]
+
+
+class CheckpointWriter:
+    """
+    Serialises checkpoints with torch.save (or save_dynamics) on a background
+    thread, so that the training loop only pays for copying the state dicts
+    to host memory. At most max_pending checkpoints wait in memory: save
+    blocks while the queue is full, which bounds memory use when the disk
+    cannot keep up.
+    Checkpoints are written to a temporary file and renamed once complete.
+
+    Inputs
+        max_pending (int): number of checkpoints that can wait to be written
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def save(self, save_dict, filename, save_fn=torch.save):
+        """
+        Snapshots save_dict and queues it to be written to filename with
+        save_fn(save_dict, filename)
+        """
+        self._raise()
+        self.queue.put((snapshot(save_dict), filename, save_fn))
+
+    def flush(self):
+        """
+        Blocks until all queued checkpoints are written
+        """
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            save_dict, filename, save_fn = item
+            try:
+                if self.error is None:
+                    tmp_filename = f"{filename}.tmp"
+                    save_fn(save_dict, tmp_filename)
+                    os.replace(tmp_filename, filename)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -1,12 +1,21 @@
 import io
 import pandas as pd
 import glob
+import json
 import os
 from shutil import move
 from os.path import join
 from os import listdir, rmdir
 
-from torchvision import datasets
+import numpy as np
+import torch
+from torchvision import datasets, transforms
+from tqdm import tqdm
+
+# Shorter side of the images written by write_memmap by default: Tiny ImageNet
+# at its native resolution, ImageNet at the 256 the validation images are
+# resized to before their 224 center crop
+MEMMAP_SIZES = {"tiny-imagenet": 64, "imagenet": 256}
 
 # Based on https://github.com/tjmoon0104/pytorch-tiny-imagenet/blob/master/val_format.py
 def TINYIMAGENET(
@@ -58,3 +67,90 @@ def TINYIMAGENET(
     return datasets.ImageFolder(
         folder, transform=transform, target_transform=target_transform
     )
+
+
+def memmap_path(root, dataset, train):
+    """
+    Returns the path prefix of the memory-mapped arrays of a dataset split
+    """
+    return os.path.join(root, "memmap", dataset, "train" if train else "val")
+
+
+def write_memmap(image_folder, prefix, size, crop=True, workers=4, batch_size=256):
+    """
+    Decodes every image of an ImageFolder once, resizes its shorter side to
+    size and, if crop, center crops it to size x size. The (H, W, 3) uint8
+    images are written one after the other to {prefix}.images.bin, their
+    shapes to {prefix}.shapes.npy, the labels to {prefix}.labels.npy and the
+    class names to {prefix}.classes.json
+    """
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    transform = [transforms.Resize(size)]
+    if crop:
+        transform.append(transforms.CenterCrop(size))
+    image_folder.transform = transforms.Compose(transform + [transforms.PILToTensor()])
+    # images of different shapes are not stacked into batches
+    loader = torch.utils.data.DataLoader(
+        image_folder, batch_size=batch_size, num_workers=workers, collate_fn=_list
+    )
+    shapes, labels = [], []
+    with open(f"{prefix}.images.bin.tmp", "wb") as f:
+        for batch in tqdm(loader):
+            for image, target in batch:
+                image = image.permute(1, 2, 0).contiguous().numpy()
+                f.write(image.tobytes())
+                shapes.append(image.shape)
+                labels.append(target)
+    np.save(f"{prefix}.shapes.npy", np.array(shapes, dtype=np.int64))
+    np.save(f"{prefix}.labels.npy", np.array(labels, dtype=np.int64))
+    with open(f"{prefix}.classes.json", "w") as f:
+        json.dump(image_folder.classes, f)
+    os.replace(f"{prefix}.images.bin.tmp", f"{prefix}.images.bin")
+
+
+def _list(batch):
+    return batch
+
+
+class MemmapImages(torch.utils.data.Dataset):
+    """
+    Dataset of images written by write_memmap. Images are read with
+    zero-copy slicing of the copy-on-write memory-mapped file and returned
+    as (3, H, W) uint8 tensor views, so transforms have to operate on
+    tensors.
+
+    Inputs
+        prefix (str): path prefix returned by memmap_path
+        transform (callable): transform applied to the uint8 image tensors
+    """
+
+    def __init__(self, prefix, transform=None, target_transform=None):
+        self.prefix = prefix
+        self.transform = transform
+        self.target_transform = target_transform
+        self.targets = np.load(f"{prefix}.labels.npy")
+        self.shapes = np.load(f"{prefix}.shapes.npy")
+        self.offsets = np.concatenate([[0], np.cumsum(np.prod(self.shapes, axis=1))])
+        with open(f"{prefix}.classes.json") as f:
+            self.classes = json.load(f)
+        self.images = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            # opened lazily so that every DataLoader worker maps the file
+            # itself instead of inheriting the parent's mapping
+            self.images = np.memmap(
+                f"{self.prefix}.images.bin", dtype=np.uint8, mode="c"
+            )
+        start, stop = self.offsets[index], self.offsets[index + 1]
+        image = self.images[start:stop].reshape(self.shapes[index])
+        image = torch.from_numpy(image).permute(2, 0, 1)
+        target = int(self.targets[index])
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return image, target
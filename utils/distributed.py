@@ -0,0 +1,109 @@
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+# Multi-process CPU data parallelism with the gloo backend (--world-size). Every
+# process holds a full copy of the model and trains on its own shard of the
+# data. Gradients are averaged across processes before every optimizer step,
+# so that all copies of the weights and of the custom_sgd buffers stay the same
+# and the checkpoints written by rank 0 describe the whole run.
+
+
+def spawn(fn, args, world_size, port):
+    """
+    Runs fn(args) in world_size processes joined in a gloo process group
+    """
+    mp.spawn(_run, args=(fn, args, world_size, port), nprocs=world_size)
+
+
+def _run(rank, fn, args, world_size, port):
+    init(rank, world_size, port)
+    try:
+        fn(args)
+    finally:
+        close()
+
+
+def init(rank, world_size, port):
+    """
+    Joins the gloo process group of world_size processes on this machine and
+    splits the CPU threads between them
+    """
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, torch.get_num_threads() // world_size))
+
+
+def close():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+
+def world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def barrier():
+    dist.barrier()
+
+
+def master_print(*args, **kwargs):
+    """
+    Prints on rank 0 only, like torch_xla's xm.master_print
+    """
+    if rank() == 0:
+        print(*args, **kwargs)
+
+
+def all_reduce(tensors):
+    """
+    Sums a list of tensors across processes in place, in a single collective
+    """
+    flat = _flatten_dense_tensors(tensors)
+    dist.all_reduce(flat)
+    for tensor, reduced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+        tensor.copy_(reduced)
+
+
+def optimizer_step(optimizer):
+    """
+    Averages the gradients of all processes and takes an optimizer step, like
+    torch_xla's xm.optimizer_step
+    """
+    grads = [
+        p.grad
+        for group in optimizer.param_groups
+        for p in group["params"]
+        if p.grad is not None
+    ]
+    for dtype in set(grad.dtype for grad in grads):
+        same_dtype = [grad for grad in grads if grad.dtype == dtype]
+        all_reduce(same_dtype)
+        torch._foreach_div_(same_dtype, world_size())
+    optimizer.step()
+
+
+def broadcast_model(model):
+    """
+    Copies the parameters and buffers of rank 0 to every process
+    """
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        dist.broadcast(tensor.data, 0)
+
+
+def average_buffers(model):
+    """
+    Averages the floating point buffers of a model (the running statistics of
+    batch norm layers), which are updated from the local batches only
+    """
+    buffers = [b for b in model.buffers() if torch.is_floating_point(b)]
+    if len(buffers) > 0:
+        all_reduce(buffers)
+        torch._foreach_div_(buffers, world_size())
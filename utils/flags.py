@@ -120,6 +120,12 @@ def train():
         default=[],
         help="comma separated list of which buffers to save in custom optimizer (default: [])",
     )
+    train_args.add_argument(
+        "--reduce-buffers",
+        action="store_true",
+        default=False,
+        help="keep only per-neuron in/out sums of the custom optimizer buffers instead of full-size tensors",
+    )
     train_args.add_argument(
         "--train-batch-size",
         type=int,
@@ -175,6 +181,37 @@ def train():
         default="4",
         help="number of data loading workers (default: 4)",
     )
+    train_args.add_argument(
+        "--in-memory",
+        action="store_true",
+        default=False,
+        help="hold the dataset in memory as a uint8 tensor and augment whole batches with tensor ops instead of using DataLoader workers (mnist, cifar10 and cifar100 only)",
+    )
+    train_args.add_argument(
+        "--memmap",
+        action="store_true",
+        default=False,
+        help="read pre-resized images from the memory-mapped arrays written by preprocess.py instead of decoding JPEGs (tiny-imagenet and imagenet only)",
+    )
+    train_args.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16"],
+        help="precision of the forward pass: bf16 uses autocast while weights, gradients and optimizer buffers stay in fp32 (default: fp32)",
+    )
+    train_args.add_argument(
+        "--world-size",
+        type=int,
+        default=1,
+        help="number of CPU processes training data parallel on shards of the data, with gradients averaged over the gloo backend (default: 1)",
+    )
+    train_args.add_argument(
+        "--dist-port",
+        type=int,
+        default=29500,
+        help="local port used by the processes of --world-size to communicate (default: 29500)",
+    )
     train_args.add_argument(
         "--seed", type=int, default=1, help="random seed (default: 1)"
     )
@@ -191,6 +228,36 @@ def train():
         default=None,
         help="Frequency (in batches) to save model checkpoints at",
     )
+    train_args.add_argument(
+        "--online-metrics",
+        action="store_true",
+        default=False,
+        help="compute scale, rescale and translation quantities during training into online.h5, saving full checkpoints only at epoch ends",
+    )
+    train_args.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="resume training from the latest full checkpoint (ckpt/step*.tar) of an existing experiment instead of starting over",
+    )
+    train_args.add_argument(
+        "--dynamics-checkpoints",
+        action="store_true",
+        default=False,
+        help="save only weights, biases, optimizer buffers and metrics (ckpt/step{N}.h5) at mid-epoch save points, saving full checkpoints only at epoch ends",
+    )
+    train_args.add_argument(
+        "--async-checkpoints",
+        action="store_true",
+        default=False,
+        help="write checkpoints on a background thread instead of blocking the training loop",
+    )
+    train_args.add_argument(
+        "--checkpoint-queue",
+        type=int,
+        default=2,
+        help="maximum number of checkpoints waiting to be written with --async-checkpoints, training blocks when full (default: 2)",
+    )
     return parser
 
 
@@ -200,13 +267,104 @@ def validate_train(parsed_args):
             m in ["sgd", "mom", "grad", "grad_norm"],
             "--save-buffers must be a comma separated list of these options: sgd,mom,grad,grad_norm",
         )
+    assert not (
+        parsed_args.online_metrics and parsed_args.tpu
+    ), "--online-metrics is not supported on TPU"
+    assert not (
+        parsed_args.async_checkpoints and parsed_args.tpu
+    ), "--async-checkpoints is not supported on TPU"
+    assert not (
+        parsed_args.dynamics_checkpoints and parsed_args.tpu
+    ), "--dynamics-checkpoints is not supported on TPU"
+    assert not parsed_args.in_memory or parsed_args.dataset in [
+        "mnist",
+        "cifar10",
+        "cifar100",
+    ], "--in-memory is only supported for mnist, cifar10 and cifar100"
+    assert not (
+        parsed_args.in_memory and parsed_args.tpu
+    ), "--in-memory is not supported on TPU"
+    assert not (
+        parsed_args.precision == "bf16" and parsed_args.tpu
+    ), "--precision bf16 is not supported on TPU"
+    assert parsed_args.world_size >= 1, "--world-size must be at least 1"
+    assert not (
+        parsed_args.world_size > 1 and parsed_args.tpu
+    ), "--world-size is not supported on TPU, which runs one process per core"
+    assert not (
+        parsed_args.world_size > 1 and parsed_args.in_memory
+    ), "--world-size is not supported with --in-memory"
+    assert not parsed_args.memmap or parsed_args.dataset in [
+        "tiny-imagenet",
+        "imagenet",
+    ], "--memmap is only supported for tiny-imagenet and imagenet"
+    assert not (
+        parsed_args.resume and parsed_args.overwrite
+    ), "--resume and --overwrite are mutually exclusive"
+
+
+def preprocess():
+    parser = argparse.ArgumentParser(description="Neural Mechanics")
+    parser.add_argument(
+        "--dataset",
+        type=str,
+        default="tiny-imagenet",
+        choices=["tiny-imagenet", "imagenet"],
+        help="dataset (default: tiny-imagenet)",
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=str,
+        default="data",
+        help="Directory to store the datasets to be downloaded",
+    )
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=None,
+        help="side of the square images written, 64 for tiny-imagenet and 256 for imagenet if not specified",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="number of image decoding workers (default: 4)",
+    )
+    parser.add_argument(
+        "--overwrite", dest="overwrite", action="store_true", default=False
+    )
+    return parser
 
 
 def extract():
     parser = default()
+    parser.add_argument(
+        "--store",
+        action="store_true",
+        default=False,
+        help="write features to a single consolidated store (feats/store.h5) instead of one file per step",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes used to extract checkpoints in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="extract only the checkpoints without features in an existing feature directory, e.g. after an interrupted extraction",
+    )
     return parser
 
 
+def validate_extract(parsed_args):
+    assert not (
+        parsed_args.resume and parsed_args.overwrite
+    ), "--resume and --overwrite are mutually exclusive"
+
+
 def cache():
     parser = default()
     parser.add_argument(
@@ -222,4 +380,88 @@ def cache():
         default=[],
         help="comma separated list of which metrics to compute and cache. Caches all if not specified (default: [])",
     )
+    parser.add_argument(
+        "--follow",
+        action="store_true",
+        default=False,
+        help="watch the checkpoints of a running experiment, extracting new ones and updating the caches as they are written",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="seconds between checks for new checkpoints with --follow (default: 10)",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=None,
+        help="stop following once no new checkpoint was written for this many seconds, follows until interrupted if not specified",
+    )
+    # network metric
+    parser.add_argument(
+        "--subset",
+        type=int,
+        default=None,
+        help="number of parameters of each layer cached by the network metric, drawn once and gathered at every step. Caches all parameters if not specified, unless --quantiles or --bins are",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="random seed of the --subset of parameters, the training seed if not specified",
+    )
+    parser.add_argument(
+        "--quantiles",
+        type=int,
+        default=None,
+        help="number of evenly spaced quantiles of all parameters of each layer cached by the network metric at every step",
+    )
+    parser.add_argument(
+        "--bins",
+        type=int,
+        default=None,
+        help="number of histogram bins of all parameters of each layer cached by the network metric at every step",
+    )
+    return parser
+
+
+def sweep():
+    parser = argparse.ArgumentParser(description="Neural Mechanics")
+    parser.add_argument(
+        "--spec",
+        type=str,
+        required=True,
+        help="JSON file with the experiment name, the train flags shared by all runs, a grid of train flags to sweep over and the extract and cache flags",
+    )
+    parser.add_argument(
+        "--save-dir",
+        type=str,
+        default="results",
+        help='Directory to save checkpoints and features (default: "results")',
+    )
+    parser.add_argument(
+        "--slots",
+        type=int,
+        default=None,
+        help="number of jobs running at the same time, all available CPUs divided by --threads if not specified",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="number of threads of each job, which is pinned to as many CPUs (default: 1)",
+    )
+    parser.add_argument(
+        "--stages",
+        type=str_list,
+        default=["train", "extract", "cache"],
+        help="comma separated list of the stages to run (default: train,extract,cache)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="print the commands of the jobs left to run without running them",
+    )
     return parser
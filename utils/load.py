@@ -10,6 +10,9 @@ from models import imagenet_resnet
 from optimizers import custom_sgd
 from optimizers import lamb
 from utils import custom_datasets
+from utils import distributed
+from utils import samplers
+from utils import tensor_data
 
 
 def configure_tpu(tpu_name):
@@ -45,20 +48,35 @@ def dimension(dataset):
     return input_shape, num_classes
 
 
-def get_transform(size, padding, mean, std, preprocess):
+def get_transform(size, padding, mean, std, preprocess, tensor=False):
     transform = []
     if preprocess:
         transform.append(transforms.RandomCrop(size=size, padding=padding))
         transform.append(transforms.RandomHorizontalFlip())
-    transform.append(transforms.ToTensor())
+    if tensor:
+        # uint8 tensors, e.g. from custom_datasets.MemmapImages
+        transform.append(transforms.ConvertImageDtype(torch.float))
+    else:
+        transform.append(transforms.ToTensor())
     transform.append(transforms.Normalize(mean, std))
     return transforms.Compose(transform)
 
 
 def dataloader(
-    dataset, batch_size, train, workers, length=None, datadir="Data", tpu=False
+    dataset,
+    batch_size,
+    train,
+    workers,
+    length=None,
+    datadir="Data",
+    tpu=False,
+    in_memory=False,
+    memmap=False,
+    seed=0,
 ):
     # Dataset
+    # augmentation of datasets that can be held in memory (see in_memory)
+    tensor_augment = None
     if dataset == "mnist":
         mean, std = (0.1307,), (0.3081,)
         transform = get_transform(
@@ -67,6 +85,7 @@ def dataloader(
         dataset = datasets.MNIST(
             datadir, train=train, download=True, transform=transform
         )
+        tensor_augment = {"padding": 0, "flip": False}
     if dataset == "cifar10":
         mean, std = (0.491, 0.482, 0.447), (0.247, 0.243, 0.262)
         transform = get_transform(
@@ -75,6 +94,7 @@ def dataloader(
         dataset = datasets.CIFAR10(
             datadir, train=train, download=True, transform=transform
         )
+        tensor_augment = {"padding": 4 if train else 0, "flip": train}
     if dataset == "cifar100":
         mean, std = (0.507, 0.487, 0.441), (0.267, 0.256, 0.276)
         transform = get_transform(
@@ -83,16 +103,28 @@ def dataloader(
         dataset = datasets.CIFAR100(
             datadir, train=train, download=True, transform=transform
         )
+        tensor_augment = {"padding": 4 if train else 0, "flip": train}
     if dataset == "tiny-imagenet":
         mean, std = (0.480, 0.448, 0.397), (0.276, 0.269, 0.282)
         transform = get_transform(
-            size=64, padding=4, mean=mean, std=std, preprocess=train
-        )
-        dataset = custom_datasets.TINYIMAGENET(
-            datadir, train=train, download=True, transform=transform
+            size=64, padding=4, mean=mean, std=std, preprocess=train, tensor=memmap
         )
+        if memmap:
+            dataset = custom_datasets.MemmapImages(
+                custom_datasets.memmap_path(datadir, "tiny-imagenet", train),
+                transform=transform,
+            )
+        else:
+            dataset = custom_datasets.TINYIMAGENET(
+                datadir, train=train, download=True, transform=transform
+            )
     if dataset == "imagenet":
         mean, std = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+        # memory-mapped images are uint8 tensors whose shorter side is already
+        # resized to 256, center cropped for validation
+        to_tensor = transforms.ConvertImageDtype(torch.float)
+        if not memmap:
+            to_tensor = transforms.ToTensor()
         if train:
             transform = transforms.Compose(
                 [
@@ -100,29 +132,45 @@ def dataloader(
                     transforms.RandomGrayscale(p=0.2),
                     transforms.ColorJitter(0.4, 0.4, 0.4, 0.4),
                     transforms.RandomHorizontalFlip(),
-                    transforms.ToTensor(),
+                    to_tensor,
                     transforms.Normalize(mean, std),
                 ]
             )
         else:
             transform = transforms.Compose(
-                [
-                    transforms.Resize(256),
+                ([] if memmap else [transforms.Resize(256)])
+                + [
                     transforms.CenterCrop(224),
-                    transforms.ToTensor(),
+                    to_tensor,
                     transforms.Normalize(mean, std),
                 ]
             )
-        folder = f"{datadir}/imagenet_raw/{'train' if train else 'val'}"
-        dataset = datasets.ImageFolder(folder, transform=transform)
+        if memmap:
+            dataset = custom_datasets.MemmapImages(
+                custom_datasets.memmap_path(datadir, "imagenet", train),
+                transform=transform,
+            )
+        else:
+            folder = f"{datadir}/imagenet_raw/{'train' if train else 'val'}"
+            dataset = datasets.ImageFolder(folder, transform=transform)
 
     # Dataloader
     shuffle = train is True
+    if in_memory:
+        # whole dataset as one uint8 tensor, augmented by batch
+        assert tensor_augment is not None, "in_memory requires mnist or cifar"
+        data, targets = tensor_data.tensors(dataset)
+        if length is not None:
+            indices = torch.randperm(len(data))[:length]
+            data, targets = data[indices], targets[indices]
+        return tensor_data.TensorLoader(
+            data, targets, batch_size, shuffle, mean, std, seed=seed, **tensor_augment
+        )
     if length is not None:
         indices = torch.randperm(len(dataset))[:length]
         dataset = torch.utils.data.Subset(dataset, indices)
 
-    sampler = None
+    num_replicas, rank = 1, 0
     kwargs = {}
     if torch.cuda.is_available():
         kwargs = {"num_workers": workers, "pin_memory": True}
@@ -132,19 +180,16 @@ def dataloader(
         # TODO: might want to drop last to keep batches the same size and
         # speed up computation
         kwargs = {"num_workers": workers}  # , "drop_last": True}
-        if xm.xrt_world_size() > 1:
-            sampler = torch.utils.data.distributed.DistributedSampler(
-                dataset,
-                num_replicas=xm.xrt_world_size(),
-                rank=xm.get_ordinal(),
-                shuffle=shuffle,
-            )
+        num_replicas, rank = xm.xrt_world_size(), xm.get_ordinal()
+    if distributed.world_size() > 1:
+        # every process of --world-size loads its own shard
+        num_replicas, rank = distributed.world_size(), distributed.rank()
+    # shuffled with a per epoch seed, so that training can resume mid-epoch
+    sampler = samplers.EpochSampler(
+        dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed
+    )
     dataloader = torch.utils.data.DataLoader(
-        dataset=dataset,
-        batch_size=batch_size,
-        shuffle=False if sampler else shuffle,
-        sampler=sampler,
-        **kwargs,
+        dataset=dataset, batch_size=batch_size, sampler=sampler, **kwargs
     )
 
     return dataloader
@@ -212,7 +257,14 @@ def model(model_architecture, model_class):
     return models[model_class][model_architecture]
 
 
-def optimizer(optimizer, momentum=0.0, dampening=0.0, nesterov=False, save_buffers=[]):
+def optimizer(
+    optimizer,
+    momentum=0.0,
+    dampening=0.0,
+    nesterov=False,
+    save_buffers=[],
+    reduce_buffers=False,
+):
     optimizers = {
         "custom_sgd": (
             custom_sgd.SGD,
@@ -221,6 +273,7 @@ def optimizer(optimizer, momentum=0.0, dampening=0.0, nesterov=False, save_buffe
                 "dampening": dampening,
                 "nesterov": nesterov,
                 "save_buffers": save_buffers,
+                "reduce_buffers": reduce_buffers,
             },
         ),
         "sgd": (optim.SGD, {}),
@@ -1,6 +1,12 @@
+import contextlib
+import itertools
+import os
 import torch
 import numpy as np
 from tqdm import tqdm
+from utils import distributed
+from utils import samplers
+from utils.checkpoint import save_dynamics
 
 
 def checkpoint(
@@ -13,6 +19,7 @@ def checkpoint(
     verbose,
     metric_dict={},
     tpu=False,
+    writer=None,
 ):
     save_lib = torch
     print_fn = print
@@ -30,12 +37,23 @@ def checkpoint(
         "model_state_dict": model.state_dict(),
         "optimizer_state_dict": optimizer.state_dict(),
         "scheduler_state_dict": scheduler.state_dict(),
+        "rng_state": torch.get_rng_state(),
     }
     save_dict.update(metric_dict)
     filename = f"{save_path}/ckpt/step{curr_step}.tar"
-    save_lib.save(
-        save_dict, filename,
-    )
+    if writer is not None:
+        # serialised in the background, see utils.checkpoint
+        writer.save(save_dict, filename)
+        return
+    if tpu:
+        save_lib.save(
+            save_dict, filename,
+        )
+    else:
+        # renamed once complete, so that readers of ckpt/ (see cache.py
+        # --follow) never see a partially written checkpoint
+        save_lib.save(save_dict, f"{filename}.tmp")
+        os.replace(f"{filename}.tmp", filename)
     if tpu:
         if xm.get_ordinal() == 0 and filename[0:5] == "gs://":
             from utils.gcloud import post_file_to_bucket
@@ -43,6 +61,55 @@ def checkpoint(
             post_file_to_bucket(filename, verbose)
 
 
+def dynamics_checkpoint(
+    model, optimizer, epoch, curr_step, save_path, verbose, metric_dict={}, writer=None,
+):
+    """
+    Saves a lean checkpoint with only what extract.py consumes: the weights
+    and biases, the optimizer buffers and the evaluation metrics, in the
+    HDF5 layout of utils.checkpoint.save_dynamics. It cannot be resumed from.
+    """
+    if verbose:
+        print(f"Saving dynamics checkpoint for step {curr_step}")
+    params = {
+        name: tensor
+        for name, tensor in model.state_dict().items()
+        if "weight" in name or "bias" in name
+    }
+    buffers = {}
+    for name, param in model.named_parameters():
+        for k, v in optimizer.state[param].get("buffers", {}).items():
+            buffers[f"{name}.{k}"] = v
+    metrics = {
+        m: np.array([metric_dict[m]], dtype=np.float64)
+        for m in ["train_loss", "test_loss", "accuracy1", "accuracy5"]
+        if m in metric_dict
+    }
+    save_dict = {
+        "epoch": epoch,
+        "step": curr_step,
+        "metrics": metrics,
+        "params": params,
+        "buffers": buffers,
+    }
+    filename = f"{save_path}/ckpt/step{curr_step}.h5"
+    if writer is not None:
+        writer.save(save_dict, filename, save_fn=save_dynamics)
+        return
+    save_dynamics(save_dict, filename)
+
+
+def autocast(device, precision):
+    """
+    Returns the context running forward passes in the given precision: fp32,
+    or bf16 with autocast, where parameters, gradients and optimizer buffers
+    stay in fp32
+    """
+    if precision == "bf16":
+        return torch.autocast(device.type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
 # TODO: we maybe don't want to have the scheduler inside the train function
 def train(
     model,
@@ -57,13 +124,18 @@ def train(
     save_freq,
     save_path,
     log_interval=10,
+    online=None,
+    writer=None,
+    dynamics=False,
+    start_batch=0,
+    precision="fp32",
     **kwargs,
 ):
     batch_size = kwargs.get("batch_size")  # per core batch size
     num_batches = kwargs.get("num_batches")  #  len(dataloader)
     dataset_size = kwargs.get("dataset_size")  # len(dataloader.dataset)
 
-    print_fn = print
+    print_fn = distributed.master_print
     if device.type == "xla":
         import torch_xla.core.xla_model as xm
 
@@ -74,22 +146,40 @@ def train(
             print_fn = xm.master_print
 
     model.train()
-    total_loss = 0
+    # accumulated on the device and only read at the end of the epoch, so that
+    # steps do not wait for the device (float64 is not supported on XLA)
+    dtype = torch.float32 if device.type == "xla" else torch.float64
+    total_loss = torch.zeros((), dtype=dtype, device=device)
     total_samples = 0
-    for batch_idx, (data, target) in enumerate(dataloader):
+    sampler = getattr(dataloader, "sampler", None)
+    if isinstance(sampler, torch.utils.data.distributed.DistributedSampler):
+        # reshuffles the shards of every process each epoch
+        sampler.set_epoch(epoch)
+    # batches before start_batch were already trained on before resuming. The
+    # permutation of an EpochSampler only depends on the seed and the epoch, so
+    # they are skipped by index without being loaded
+    batches = dataloader
+    if isinstance(sampler, samplers.EpochSampler):
+        sampler.set_start(start_batch * batch_size)
+    elif start_batch > 0:
+        batches = itertools.islice(dataloader, start_batch, None)
+    for batch_idx, (data, target) in enumerate(batches, start_batch):
         if device.type != "xla":
             data, target = data.to(device), target.to(device)
         curr_step = epoch * num_batches + batch_idx
 
         optimizer.zero_grad()
-        output = model(data)
-        train_loss = loss(output, target)
-        total_loss += train_loss.item() * data.size(0)
+        with autocast(device, precision):
+            output = model(data)
+            train_loss = loss(output, target)
+        total_loss += train_loss.detach().to(dtype) * data.size(0)
         total_samples += data.size(0)
         train_loss.backward()
         if device.type == "xla":
             xm.optimizer_step(optimizer)
             tracker.add(batch_size)
+        elif distributed.world_size() > 1:
+            distributed.optimizer_step(optimizer)
         else:
             optimizer.step()
         curr_step += 1
@@ -117,7 +207,24 @@ def train(
         #       for a cleaner codebase and can include test metrics
         # TODO: additionally, could integrate tfutils.DBInterface here
         if save and save_path is not None and save_freq is not None:
-            if curr_step % save_freq == 0:
+            last_batch = batch_idx + 1 == num_batches
+            # full checkpoints are only needed at epoch ends for resuming, so
+            # save steps within an epoch update the online metrics if they are
+            # computed during training, or else write lean dynamics
+            # checkpoints if requested, and full checkpoints otherwise
+            if curr_step % save_freq == 0 and online is not None:
+                online.update(curr_step)
+            elif curr_step % save_freq == 0 and dynamics and not last_batch:
+                dynamics_checkpoint(
+                    model,
+                    optimizer,
+                    epoch,
+                    curr_step,
+                    save_path,
+                    verbose,
+                    writer=writer,
+                )
+            elif curr_step % save_freq == 0:
                 checkpoint(
                     model,
                     optimizer,
@@ -127,36 +234,51 @@ def train(
                     save_path,
                     verbose,
                     tpu=(device.type == "xla"),
+                    writer=writer,
                 )
-    average_loss = 1.0 * total_loss / total_samples
+    if distributed.world_size() > 1:
+        distributed.average_buffers(model)
+        totals = torch.stack([total_loss, torch.tensor(total_samples, dtype=dtype)])
+        distributed.all_reduce([totals])
+        total_loss, total_samples = totals[0], int(totals[1])
+    average_loss = 1.0 * total_loss.item() / total_samples
     if device.type == "xla":
         average_loss = xm.mesh_reduce("train_average_loss", average_loss, np.mean)
     return average_loss
 
 
-def eval(model, loss, dataloader, device, verbose, epoch, **kwargs):
-    print_fn = print
+def eval(model, loss, dataloader, device, verbose, epoch, precision="fp32", **kwargs):
+    print_fn = distributed.master_print
     if device.type == "xla":
         import torch_xla.core.xla_model as xm
 
         print_fn = xm.master_print
 
     model.eval()
-    total = 0
-    correct1 = 0
-    correct5 = 0
+    # accumulated on the device and only read once all batches are evaluated
+    dtype = torch.float32 if device.type == "xla" else torch.float64
+    total = torch.zeros((), dtype=dtype, device=device)
+    correct1 = torch.zeros((), dtype=torch.int64, device=device)
+    correct5 = torch.zeros((), dtype=torch.int64, device=device)
     total_samples = 0
 
     with torch.no_grad():
         for data, target in dataloader:
             data, target = data.to(device), target.to(device)
-            output = model(data)
-            total += loss(output, target).item() * data.size(0)
+            with autocast(device, precision):
+                output = model(data)
+                total += loss(output, target).to(dtype) * data.size(0)
             _, pred = output.topk(5, dim=1)
             correct = pred.eq(target.view(-1, 1).expand_as(pred))
-            correct1 += correct[:, :1].sum().item()
-            correct5 += correct[:, :5].sum().item()
+            correct1 += correct[:, :1].sum()
+            correct5 += correct[:, :5].sum()
             total_samples += data.size()[0]
+    if distributed.world_size() > 1:
+        # every process evaluates its own shard of the test set
+        counts = torch.stack([correct1, correct5, torch.tensor(total_samples)])
+        distributed.all_reduce([total, counts])
+        correct1, correct5, total_samples = counts[0], counts[1], int(counts[2])
+    total, correct1, correct5 = total.item(), correct1.item(), correct5.item()
     average_loss = 1.0 * total / total_samples
     accuracy1 = 100.0 * correct1 / total_samples
     accuracy5 = 100.0 * correct5 / total_samples
@@ -185,9 +307,14 @@ def train_eval_loop(
     save,
     save_freq=None,
     save_path=None,
+    online=None,
+    writer=None,
+    dynamics=False,
+    start_step=0,
+    precision="fp32",
     **kwargs,
 ):
-    print_fn = print
+    print_fn = distributed.master_print
     if device.type == "xla":
         import torch_xla.distributed.parallel_loader as pl
         import torch_xla.core.xla_model as xm
@@ -196,26 +323,41 @@ def train_eval_loop(
         train_loader = pl.MpDeviceLoader(train_loader, device)
         test_loader = pl.MpDeviceLoader(test_loader, device)
 
-    test_loss, accuracy1, accuracy5 = eval(model, loss, test_loader, device, verbose, 0)
-    metric_dict = {
-        "train_loss": 0,
-        "test_loss": test_loss,
-        "accuracy1": accuracy1,
-        "accuracy5": accuracy5,
-    }
-    if save:
-        checkpoint(
-            model,
-            optimizer,
-            scheduler,
-            0,
-            0,
-            save_path,
-            verbose,
-            metric_dict,
-            tpu=(device.type == "xla"),
+    # when resuming, start_step is the step of the restored checkpoint
+    start_epoch, start_batch = divmod(start_step, kwargs.get("num_batches"))
+    if start_epoch >= epochs:
+        print_fn(f"Training already finished at step {start_step}")
+        return
+    if start_step > 0 and start_batch == 0:
+        # epoch end checkpoints are saved before the scheduler steps
+        scheduler.step()
+
+    if start_step == 0:
+        test_loss, accuracy1, accuracy5 = eval(
+            model, loss, test_loader, device, verbose, 0, precision
         )
-    for epoch in tqdm(range(epochs)):
+        metric_dict = {
+            "train_loss": 0,
+            "test_loss": test_loss,
+            "accuracy1": accuracy1,
+            "accuracy5": accuracy5,
+        }
+        if save:
+            checkpoint(
+                model,
+                optimizer,
+                scheduler,
+                0,
+                0,
+                save_path,
+                verbose,
+                metric_dict,
+                tpu=(device.type == "xla"),
+                writer=writer,
+            )
+            if online is not None:
+                online.update(0, metric_dict)
+    for epoch in tqdm(range(start_epoch, epochs), disable=distributed.rank() > 0):
         train_loss = train(
             model,
             loss,
@@ -228,10 +370,15 @@ def train_eval_loop(
             save,
             save_freq=save_freq,
             save_path=save_path,
+            online=online,
+            writer=writer,
+            dynamics=dynamics,
+            start_batch=start_batch if epoch == start_epoch else 0,
+            precision=precision,
             **kwargs,
         )
         test_loss, accuracy1, accuracy5 = eval(
-            model, loss, test_loader, device, verbose, epoch + 1
+            model, loss, test_loader, device, verbose, epoch + 1, precision
         )
         metric_dict = {
             "train_loss": train_loss,
@@ -251,8 +398,13 @@ def train_eval_loop(
                 verbose,
                 metric_dict,
                 tpu=(device.type == "xla"),
+                writer=writer,
             )
+            if online is not None:
+                online.update(curr_step, metric_dict)
         scheduler.step()
+    if writer is not None:
+        writer.flush()
     print_fn(
         f"Final performance: "
         f"\tTrain Loss: {train_loss:.4f}"
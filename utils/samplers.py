@@ -0,0 +1,35 @@
+import torch
+
+
+class EpochSampler(torch.utils.data.distributed.DistributedSampler):
+    """
+    DistributedSampler, of a single process by default, that can start an
+    epoch part way through. The permutation of every epoch is drawn from a
+    generator seeded with seed + epoch (see set_epoch) rather than from the
+    torch random number generator, so that a run resumed mid-epoch sees the
+    remaining batches of the interrupted run in the same order, and the batches
+    it already trained on are skipped by index without being loaded.
+
+    Inputs
+        dataset (Dataset): dataset to sample from
+        num_replicas (int): number of processes sharing the dataset
+        rank (int): shard of this process
+        shuffle (bool): draw a new permutation of the dataset every epoch
+        seed (int): seed of the permutations
+    """
+
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+        super().__init__(
+            dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed
+        )
+        self.start = 0
+
+    def set_start(self, start):
+        """
+        Skips the first start indices of this process in the following epochs
+        """
+        self.start = start
+
+    def __iter__(self):
+        indices = list(super().__iter__())
+        return iter(indices[self.start :])
@@ -0,0 +1,100 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from utils import samplers
+
+
+def tensors(dataset):
+    """
+    Returns the images of a torchvision MNIST or CIFAR dataset as a single
+    (N, C, H, W) uint8 tensor and its labels as an int64 tensor
+    """
+    data = torch.as_tensor(np.asarray(dataset.data))
+    if data.dim() == 3:
+        # MNIST: (N, H, W)
+        data = data.unsqueeze(1)
+    else:
+        # CIFAR: (N, H, W, C)
+        data = data.permute(0, 3, 1, 2)
+    targets = torch.as_tensor(np.asarray(dataset.targets), dtype=torch.int64)
+    return data.contiguous(), targets
+
+
+class TensorLoader:
+    """
+    Iterates over a dataset held in memory as one uint8 tensor, applying the
+    random padding-crop, horizontal flip and normalisation of
+    load.get_transform to whole batches with tensor ops in the main process,
+    instead of to single PIL images in DataLoader workers. Random crops and
+    flips are drawn from the torch random number generator.
+
+    Inputs
+        data (Tensor): (N, C, H, W) uint8 images
+        targets (Tensor): (N,) labels
+        batch_size (int): number of images per batch
+        shuffle (bool): draw a new permutation of the images every epoch, from
+            the seeded samplers.EpochSampler
+        mean, std (tuple): per-channel normalisation
+        padding (int): zero padding before random crops, 0 for no crops
+        flip (bool): flip images horizontally with probability 0.5
+        seed (int): seed of the permutations
+    """
+
+    def __init__(
+        self,
+        data,
+        targets,
+        batch_size,
+        shuffle,
+        mean,
+        std,
+        padding=0,
+        flip=False,
+        seed=0,
+    ):
+        self.dataset = torch.utils.data.TensorDataset(data, targets)
+        self.sampler = samplers.EpochSampler(self.dataset, shuffle=shuffle, seed=seed)
+        self.data = data
+        self.targets = targets
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+        self.padding = padding
+        self.flip = flip
+
+    def __len__(self):
+        return (len(self.data) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        order = torch.tensor(list(self.sampler), dtype=torch.int64)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start : start + self.batch_size]
+            yield self.transform(self.data[indices]), self.targets[indices]
+
+    def transform(self, batch):
+        """
+        Augments and normalises a (B, C, H, W) uint8 batch
+        """
+        if self.padding > 0:
+            batch = self.crop(batch)
+        if self.flip:
+            flipped = torch.rand(len(batch)) < 0.5
+            batch = torch.where(flipped.view(-1, 1, 1, 1), batch.flip(3), batch)
+        batch = batch.float().div(255)
+        return batch.sub(self.mean).div(self.std)
+
+    def crop(self, batch):
+        """
+        Zero pads a batch by self.padding on every side and takes a random crop
+        of the original size from every image
+        """
+        B, _, H, W = batch.shape
+        padded = F.pad(batch, [self.padding] * 4)
+        top = torch.randint(2 * self.padding + 1, (B, 1))
+        left = torch.randint(2 * self.padding + 1, (B, 1))
+        rows = (top + torch.arange(H)).view(B, 1, H, 1)
+        cols = (left + torch.arange(W)).view(B, 1, 1, W)
+        images = torch.arange(B).view(B, 1, 1, 1)
+        channels = torch.arange(batch.shape[1]).view(1, -1, 1, 1)
+        return padded[images, channels, rows, cols]